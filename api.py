@@ -1,17 +1,27 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, validator
 import json
 import os
 import uuid
 import time
+import random
 import logging
+from itertools import islice
 from typing import List, Dict, Optional
 from transaction import Transaction, get_balance, verify_signature
 from stealth import generate_stealth_keys
-from block import load_chain
-from p2p import node
+from block import get_store, get_state, find_transaction, iter_chain
+from mempool import open_mempool, MempoolError, MempoolFull, InsufficientFunds
+from verify import LRUCache, cache_stats
+from ratelimit import RateLimiter
+from metrics import (generate_latest, CONTENT_TYPE, HTTP_REQUESTS, HTTP_LATENCY, HTTP_IN_FLIGHT,
+                     HTTP_RATE_LIMITED, CHAIN_HEIGHT, MEMPOOL_SIZE, MEMPOOL_BYTES, ENABLE_METRICS)
+from offload import io_pool, scan_pool, offload_stats, chain_summary, balances
+from codec import MEDIA_TYPE, encode_block, encode_blocks
+from httpcache import TipCache, etag, etag_matches, CACHE_FINAL_DEPTH, BLOCK_CACHE_SIZE, IMMUTABLE, REVALIDATE
+from p2p import node, pack_message
 
 # Configure logging
 logging.basicConfig(
@@ -39,32 +49,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Rate limiting
-class RateLimiter:
-    def __init__(self, requests_per_minute: int = 60):
-        self.requests_per_minute = requests_per_minute
-        self.requests = {}
-    
-    def is_allowed(self, client_ip: str) -> bool:
-        now = time.time()
-        minute_ago = now - 60
-        
-        # Clean old requests
-        if client_ip in self.requests:
-            self.requests[client_ip] = [req_time for req_time in self.requests[client_ip] if req_time > minute_ago]
-        else:
-            self.requests[client_ip] = []
-        
-        # Check if limit exceeded
-        if len(self.requests[client_ip]) >= self.requests_per_minute:
-            return False
-        
-        # Add current request
-        self.requests[client_ip].append(now)
-        return True
+# Fraction of requests logged; per-request file logging costs throughput,
+# and /metrics carries the counts and latencies
+REQUEST_LOG_SAMPLE = float(os.environ.get("REQUEST_LOG_SAMPLE", "0"))
 
+# Token buckets per client IP, shared by all workers on this host
 rate_limiter = RateLimiter()
 
+# Pending transactions indexed by txid
+mempool = open_mempool()
+
+# Most blocks per /blockchain page when a limit is given; without one the
+# whole range is returned, as before paging existed
+BLOCKS_PAGE_MAX = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NDJSON_CHUNK = 256
+
+# Chain-derived responses for the current tip, and serialized final blocks
+tip_cache = TipCache(get_store)
+final_blocks = LRUCache(BLOCK_CACHE_SIZE)
+
 # Request models with validation
 class SendRequest(BaseModel):
     sender: str
@@ -102,6 +106,18 @@ class SendRequest(BaseModel):
             raise ValueError('Invalid private key format')
         return v
 
+class BalancesRequest(BaseModel):
+    addresses: List[str]
+    
+    @validator('addresses')
+    def validate_addresses(cls, v):
+        if len(v) > 10000:
+            raise ValueError('Too many addresses (max 10000)')
+        for address in v:
+            if not address.startswith('shadow1'):
+                raise ValueError(f'Invalid address format: {address}')
+        return v
+
 class WalletCreateRequest(BaseModel):
     pass
 
@@ -114,28 +130,96 @@ class WalletRecoverRequest(BaseModel):
             raise ValueError('Mnemonic must be 12 words')
         return v
 
-# Middleware for rate limiting and logging
+def blocks_page(start: int, stop: Optional[int], limit: Optional[int], reverse: bool, binary: bool) -> bytes:
+    """Body of one /blockchain page; at most limit blocks (all if None) are read"""
+    height = get_store().height()
+    blocks = list(islice(iter_chain(start, stop, reverse), limit))
+    if binary:
+        return encode_blocks(blocks)
+
+    end = height if stop is None else min(stop, height)
+    next_page = None
+    if len(blocks) == limit:
+        last = blocks[-1]["index"]
+        if reverse and last > start:
+            next_page = {"from": start, "to": last}
+        elif not reverse and last + 1 < end:
+            next_page = {"from": last + 1, "to": stop}
+    return json.dumps({"length": height, "blocks": blocks, "next": next_page}).encode()
+
+def ndjson_blocks(start: int, stop: Optional[int], limit: Optional[int], reverse: bool):
+    """Yield JSON lines, one per block, reading NDJSON_CHUNK blocks from storage at a time.
+    
+    Each window is read within a single step because Starlette may run
+    every step on a different threadpool thread, and store cursors (SQLite
+    ones in particular) must not cross threads.
+    """
+    height = get_store().height()
+    end = height if stop is None else min(stop, height)
+    windows = range(start, end, NDJSON_CHUNK)
+    remaining = limit
+    for low in (reversed(windows) if reverse else windows):
+        blocks = list(iter_chain(low, min(low + NDJSON_CHUNK, end), reverse))
+        if remaining is not None:
+            blocks = blocks[:remaining]
+            remaining -= len(blocks)
+        yield "".join(json.dumps(block) + "\n" for block in blocks)
+        if remaining == 0:
+            return
+
+def wants_binary(request: Request) -> bool:
+    """True if the client asked for the compact binary codec"""
+    return MEDIA_TYPE in request.headers.get("accept", "")
+
+def block_entry(block: Dict, binary: bool):
+    """(ETag, body) of a block in the requested encoding"""
+    if binary:
+        return etag(block["hash"], "bin"), encode_block(block)
+    return etag(block["hash"], "json"), json.dumps(block).encode()
+
+def cached_response(request: Request, entry, binary: bool, cache_control: str = REVALIDATE) -> Response:
+    """Serve an (ETag, body) entry, or 304 if the client already holds it"""
+    tag, body = entry
+    headers = {"ETag": tag, "Cache-Control": cache_control, "Vary": "Accept"}
+    if etag_matches(request.headers.get("if-none-match"), tag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type=MEDIA_TYPE if binary else "application/json", headers=headers)
+
+async def chain_tip() -> Optional[str]:
+    """Hash of the current tip; costs a store stamp() unless the chain changed"""
+    if not tip_cache.current():
+        await io_pool.run(tip_cache.refresh)
+    return tip_cache.tip_hash
+
+# Middleware for rate limiting, metrics and logging
 @app.middleware("http")
 async def rate_limit_and_log(request: Request, call_next):
     client_ip = request.client.host
     
     # Rate limiting
     if not rate_limiter.is_allowed(client_ip):
-        logger.warning(f"Rate limit exceeded for {client_ip}")
+        HTTP_RATE_LIMITED.inc()
         return JSONResponse(
             status_code=429,
             content={"error": "Rate limit exceeded. Try again later."}
         )
     
-    # Log request
-    start_time = time.time()
-    logger.info(f"{request.method} {request.url.path} from {client_ip}")
+    start_time = time.perf_counter()
+    HTTP_IN_FLIGHT.inc()
+    try:
+        response = await call_next(request)
+    finally:
+        HTTP_IN_FLIGHT.dec()
+    process_time = time.perf_counter() - start_time
     
-    response = await call_next(request)
+    # Route templates rather than paths keep the label set bounded
+    route = request.scope.get("route")
+    route = route.path if route else "unmatched"
+    HTTP_REQUESTS.labels(request.method, route, response.status_code).inc()
+    HTTP_LATENCY.labels(request.method, route).observe(process_time)
     
-    # Log response
-    process_time = time.time() - start_time
-    logger.info(f"{request.method} {request.url.path} - {response.status_code} - {process_time:.3f}s")
+    if REQUEST_LOG_SAMPLE and random.random() < REQUEST_LOG_SAMPLE:
+        logger.info(f"{request.method} {request.url.path} from {client_ip} - {response.status_code} - {process_time:.3f}s")
     
     return response
 
@@ -144,13 +228,11 @@ async def rate_limit_and_log(request: Request, call_next):
 async def health_check():
     """Health check endpoint for monitoring"""
     try:
-        # Check if blockchain file exists
-        chain = load_chain()
-        
+        await chain_tip()
         return {
             "status": "healthy",
             "timestamp": time.time(),
-            "blockchain_length": len(chain),
+            "blockchain_length": tip_cache.height,
             "peers_count": len(node.peers) if node else 0
         }
     except Exception as e:
@@ -162,33 +244,24 @@ async def health_check():
 async def get_status():
     """Get detailed system status"""
     try:
-        chain = load_chain()
-        
-        # Calculate some statistics
-        total_transactions = sum(len(block.get('txs', [])) for block in chain)
-        total_rewards = sum(block.get('reward', 0) for block in chain)
-        
-        # Get mempool size
-        mempool_size = 0
-        if os.path.exists("mempool.json"):
-            with open("mempool.json", "r") as f:
-                mempool = json.load(f)
-                mempool_size = len(mempool)
+        await chain_tip()
+        blockchain = tip_cache.get("summary")
+        if blockchain is None:
+            blockchain = await scan_pool.run(chain_summary)
+            tip_cache.put("summary", blockchain, blockchain["last_block_hash"])
+        mempool_stats = await io_pool.run(mempool.stats)
         
         return {
-            "blockchain": {
-                "length": len(chain),
-                "total_transactions": total_transactions,
-                "total_rewards": total_rewards,
-                "last_block_hash": chain[-1]["hash"] if chain else None
-            },
+            "blockchain": blockchain,
             "network": {
                 "peers_count": len(node.peers) if node else 0,
                 "peers": list(node.peers) if node else []
             },
-            "mempool": {
-                "size": mempool_size
-            },
+            "mempool": mempool_stats,
+            "verification": cache_stats(),
+            "offload": offload_stats(),
+            "response_cache": {"tip": tip_cache.stats(), "final_blocks": final_blocks.stats()},
+            "rate_limit": rate_limiter.stats(),
             "system": {
                 "uptime": time.time() - getattr(app.state, 'start_time', time.time()),
                 "version": "1.0.0"
@@ -198,6 +271,23 @@ async def get_status():
         logger.error(f"Status check failed: {e}")
         raise HTTPException(status_code=500, detail="Failed to get status")
 
+# Prometheus metrics
+@app.get("/metrics")
+async def get_metrics():
+    """Metrics of all API workers, the P2P node and miners on this host"""
+    if not ENABLE_METRICS:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    try:
+        await chain_tip()
+        CHAIN_HEIGHT.set(tip_cache.height)
+        mempool_stats = await io_pool.run(mempool.stats)
+        MEMPOOL_SIZE.set(mempool_stats["size"])
+        MEMPOOL_BYTES.set(mempool_stats["bytes"])
+        return Response(content=await io_pool.run(generate_latest), media_type=CONTENT_TYPE)
+    except Exception as e:
+        logger.error(f"Error collecting metrics: {e}")
+        raise HTTPException(status_code=500, detail="Failed to collect metrics")
+
 # Wallet endpoints
 @app.get("/wallet/{address}/balance")
 async def get_balance_endpoint(address: str):
@@ -206,12 +296,41 @@ async def get_balance_endpoint(address: str):
         if not address.startswith('shadow1'):
             raise HTTPException(status_code=400, detail="Invalid address format")
         
-        balance = get_balance(address)
+        balance = await io_pool.run(get_balance, address)
         return {"address": address, "balance": balance}
     except Exception as e:
         logger.error(f"Error getting balance for {address}: {e}")
         raise HTTPException(status_code=500, detail="Failed to get balance")
 
+@app.post("/wallet/balances")
+async def get_balances_endpoint(request: BalancesRequest):
+    """Get balances for many wallet addresses in one request"""
+    try:
+        return {"balances": await scan_pool.run(balances, request.addresses)}
+    except Exception as e:
+        logger.error(f"Error getting balances for {len(request.addresses)} addresses: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get balances")
+
+@app.get("/wallet/{address}/history")
+async def get_history_endpoint(address: str, cursor: Optional[str] = None,
+                               limit: int = Query(50, ge=1, le=500)):
+    """Get one page of transaction history for a wallet address, newest first"""
+    try:
+        if not address.startswith('shadow1'):
+            raise HTTPException(status_code=400, detail="Invalid address format")
+        
+        try:
+            history, next_cursor = await io_pool.run(lambda: get_state().history(address, cursor, limit))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        
+        return {"address": address, "history": history, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting history for {address}: {e}")
+        raise HTTPException(status_code=500, detail="Failed to get history")
+
 @app.post("/wallet/create")
 async def create_wallet():
     """Create a new wallet"""
@@ -223,7 +342,7 @@ async def create_wallet():
         mnemonic = mnemo.generate(strength=128)
         
         # Generate stealth keys
-        stealth_keys = generate_stealth_keys(mnemonic)
+        stealth_keys = await io_pool.run(generate_stealth_keys, mnemonic)
         
         logger.info(f"New wallet created: {stealth_keys['stealth_address'][:16]}...")
         
@@ -243,7 +362,7 @@ async def recover_wallet(request: WalletRecoverRequest):
     """Recover wallet from mnemonic"""
     try:
         # Generate stealth keys from mnemonic
-        stealth_keys = generate_stealth_keys(request.mnemonic)
+        stealth_keys = await io_pool.run(generate_stealth_keys, request.mnemonic)
         
         logger.info(f"Wallet recovered: {stealth_keys['stealth_address'][:16]}...")
         
@@ -263,7 +382,7 @@ async def send_transaction(request: SendRequest):
     """Send a transaction"""
     try:
         # Validate sender has sufficient balance
-        sender_balance = get_balance(request.sender)
+        sender_balance = await io_pool.run(get_balance, request.sender)
         if sender_balance < request.amount:
             raise HTTPException(
                 status_code=400, 
@@ -278,29 +397,29 @@ async def send_transaction(request: SendRequest):
             private_key=request.private_key,
         )
         
-        if not tx.is_valid():
+        if not await io_pool.run(tx.is_valid):
             raise HTTPException(status_code=400, detail="Invalid transaction")
         
         # Add to mempool
-        if not os.path.exists("mempool.json"):
-            mempool = []
-        else:
-            with open("mempool.json", "r") as f:
-                mempool = json.load(f)
-        
         tx_dict = tx.to_dict()
-        mempool.append(tx_dict)
-        
-        with open("mempool.json", "w") as f:
-            json.dump(mempool, f, indent=2)
+        try:
+            # Checked against confirmed balance minus the sender's pending spends
+            await io_pool.run(mempool.add, tx_dict, balance=sender_balance)
+        except InsufficientFunds:
+            pending = await io_pool.run(mempool.pending_debit, request.sender)
+            raise HTTPException(
+                status_code=400,
+                detail=f"Insufficient balance. Available: {sender_balance - pending}"
+            )
+        except MempoolFull:
+            raise HTTPException(status_code=503, detail="Mempool is full")
+        except MempoolError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         # Broadcast to network if P2P is available
         if node and node.peers:
             try:
-                node._broadcast_to_peers({
-                    "type": "new_tx",
-                    "data": tx_dict
-                })
+                await io_pool.run(node._broadcast_to_peers, pack_message("new_tx", tx_dict))
             except Exception as e:
                 logger.warning(f"Failed to broadcast transaction: {e}")
         
@@ -323,30 +442,24 @@ async def send_transaction(request: SendRequest):
 async def get_transaction(txid: str):
     """Get transaction details by TXID"""
     try:
-        chain = load_chain()
-        
-        for block in chain:
-            for tx in block.get("txs", []):
-                if tx.get("txid") == txid:
-                    return {
-                        "txid": txid,
-                        "block_index": block["index"],
-                        "block_hash": block["hash"],
-                        "transaction": tx
-                    }
+        found = await io_pool.run(find_transaction, txid)
+        if found:
+            block, tx = found
+            return {
+                "txid": txid,
+                "block_index": block["index"],
+                "block_hash": block["hash"],
+                "transaction": tx
+            }
         
         # Check mempool
-        if os.path.exists("mempool.json"):
-            with open("mempool.json", "r") as f:
-                mempool = json.load(f)
-            
-            for tx in mempool:
-                if tx.get("txid") == txid:
-                    return {
-                        "txid": txid,
-                        "status": "pending",
-                        "transaction": tx
-                    }
+        tx = await io_pool.run(mempool.get, txid)
+        if tx:
+            return {
+                "txid": txid,
+                "status": "pending",
+                "transaction": tx
+            }
         
         raise HTTPException(status_code=404, detail="Transaction not found")
     except HTTPException:
@@ -357,27 +470,47 @@ async def get_transaction(txid: str):
 
 # Blockchain endpoints
 @app.get("/blockchain")
-async def get_blockchain():
-    """Get the entire blockchain"""
+async def get_blockchain(request: Request,
+                         start: int = Query(0, alias="from", ge=0),
+                         stop: Optional[int] = Query(None, alias="to", ge=0),
+                         limit: Optional[int] = Query(None, ge=1),
+                         reverse: bool = False,
+                         format: Optional[str] = None):
+    """Get blocks with from <= index < to, oldest first unless reversed.
+    
+    Without a limit the whole range is returned, so a bare /blockchain is
+    still the entire chain. With one, pages hold at most BLOCKS_PAGE_MAX
+    blocks and link to the next one. format=ndjson (or Accept:
+    application/x-ndjson) streams the range instead, one block per line.
+    """
     try:
-        chain = load_chain()
-        return {
-            "length": len(chain),
-            "blocks": chain
-        }
+        if format == "ndjson" or NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+            # Sync generators are iterated on Starlette's threadpool
+            return StreamingResponse(ndjson_blocks(start, stop, limit, reverse), media_type=NDJSON_MEDIA_TYPE)
+        
+        if limit is not None:
+            limit = min(limit, BLOCKS_PAGE_MAX)
+        binary = wants_binary(request)
+        body = await io_pool.run(blocks_page, start, stop, limit, reverse, binary)
+        return Response(content=body, media_type=MEDIA_TYPE if binary else "application/json")
     except Exception as e:
         logger.error(f"Error getting blockchain: {e}")
         raise HTTPException(status_code=500, detail="Failed to get blockchain")
 
 @app.get("/blockchain/latest")
-async def get_latest_block():
+async def get_latest_block(request: Request):
     """Get the latest block"""
     try:
-        chain = load_chain()
-        if not chain:
-            raise HTTPException(status_code=404, detail="No blocks found")
-        
-        return chain[-1]
+        binary = wants_binary(request)
+        await chain_tip()
+        entry = tip_cache.get(("latest", binary))
+        if entry is None:
+            block = await io_pool.run(lambda: get_store().tip())
+            if not block:
+                raise HTTPException(status_code=404, detail="No blocks found")
+            entry = block_entry(block, binary)
+            tip_cache.put(("latest", binary), entry, block["hash"])
+        return cached_response(request, entry, binary)
     except HTTPException:
         raise
     except Exception as e:
@@ -385,15 +518,29 @@ async def get_latest_block():
         raise HTTPException(status_code=500, detail="Failed to get latest block")
 
 @app.get("/blockchain/{block_index}")
-async def get_block(block_index: int):
-    """Get a specific block by index"""
+async def get_block(block_index: int, request: Request):
+    """Get a specific block by index.
+    
+    Blocks CACHE_FINAL_DEPTH or more below the tip are final: they are
+    served as immutable and kept serialized. Newer ones may still be
+    reorged away, so clients revalidate them against the block hash ETag.
+    """
     try:
-        chain = load_chain()
-        
-        if block_index < 0 or block_index >= len(chain):
-            raise HTTPException(status_code=404, detail="Block not found")
-        
-        return chain[block_index]
+        binary = wants_binary(request)
+        tip_hash = await chain_tip()
+        final = 0 <= block_index <= tip_cache.height - CACHE_FINAL_DEPTH
+        key = (block_index, binary)
+        entry = final_blocks.get(key) if final else tip_cache.get(key)
+        if entry is None:
+            block = await io_pool.run(lambda: get_store().get_block(block_index))
+            if block is None:
+                raise HTTPException(status_code=404, detail="Block not found")
+            entry = block_entry(block, binary)
+            if final:
+                final_blocks.put(key, entry)
+            else:
+                tip_cache.put(key, entry, tip_hash)
+        return cached_response(request, entry, binary, IMMUTABLE if final else REVALIDATE)
     except HTTPException:
         raise
     except Exception as e:
@@ -423,7 +570,7 @@ async def sync_network():
         if not node:
             raise HTTPException(status_code=503, detail="P2P node not available")
         
-        node.sync_with_network()
+        await io_pool.run(node.sync_with_network)
         return {"status": "Sync completed"}
     except Exception as e:
         logger.error(f"Error syncing network: {e}")
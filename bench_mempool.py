@@ -0,0 +1,72 @@
+"""Admission throughput of the mempool daemon.
+
+Starts a daemon on a temporary socket and admits transactions through
+MempoolClient, one request per tx and in batches. The daemon's pool is
+sized to hold every tx of both runs:
+
+    python bench_mempool.py --count 50000
+"""
+import os
+import time
+import tempfile
+import argparse
+from mempool import MempoolClient, MempoolState
+from mempoold import MempoolDaemon
+
+
+def make_txs(count: int, offset: int = 0):
+    # Txids are derived from the signed fields, so every tx gets its own
+    # timestamp to keep them from being deduplicated
+    now = time.time()
+    return [
+        {
+            "from": f"shadow1{i % 1000:032x}",
+            "to": f"shadow1{(i + 1) % 1000:032x}",
+            "amount": 1 + i % 50,
+            "timestamp": now - (offset + i) / 1e6,
+            "signature": "ab" * 64
+        }
+        for i in range(count)
+    ]
+
+
+def run(count: int, batch: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        daemon = MempoolDaemon(os.path.join(tmp, "mempool.sock"), os.path.join(tmp, "mempool.json"))
+        # Room for both runs, so the pool limits do not evict or refuse txs
+        daemon.state = MempoolState(max_txs=2 * count, max_bytes=2 * count * 1024)
+        daemon.start()
+        try:
+            client = MempoolClient(daemon.socket_path)
+
+            txs = make_txs(count)
+            start = time.perf_counter()
+            for tx in txs:
+                client.add(tx)
+            single = count / (time.perf_counter() - start)
+
+            txs = make_txs(count, offset=count)
+            start = time.perf_counter()
+            for i in range(0, count, batch):
+                client.add_many(txs[i:i + batch])
+            batched = count / (time.perf_counter() - start)
+
+            assert len(client) == 2 * count
+            start = time.perf_counter()
+            daemon.snapshot()
+            snapshot_time = time.perf_counter() - start
+        finally:
+            daemon.stop()
+
+    print(f"add:        {single:10.0f} tx/s")
+    print(f"add_many:   {batched:10.0f} tx/s (batches of {batch})")
+    print(f"snapshot:   {snapshot_time * 1000:10.1f} ms for {2 * count} txs")
+    return single, batched
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mempool daemon admission benchmark")
+    parser.add_argument("--count", type=int, default=50000, help="Transactions per run")
+    parser.add_argument("--batch", type=int, default=500, help="Transactions per add_many")
+    args = parser.parse_args()
+    run(args.count, args.batch)
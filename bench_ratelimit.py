@@ -0,0 +1,59 @@
+"""Per-request overhead of the shared rate limiter.
+
+Times RateLimiter.is_allowed on a temporary table: one client over and
+over, many distinct clients, and several processes at once contending
+for the same table as gunicorn workers would:
+
+    python bench_ratelimit.py --count 200000 --processes 4
+"""
+import os
+import time
+import tempfile
+import argparse
+import multiprocessing
+from ratelimit import RateLimiter
+
+
+def timed(limiter: RateLimiter, clients) -> float:
+    """Seconds per is_allowed call"""
+    start = time.perf_counter()
+    for client in clients:
+        limiter.is_allowed(client)
+    return (time.perf_counter() - start) / len(clients)
+
+
+def worker(path: str, clients, results):
+    results.put(timed(RateLimiter(path=path), clients))
+
+
+def run(count: int, processes: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "ratelimit.bin")
+        limiter = RateLimiter(path=path)
+        limiter.is_allowed("warmup")
+
+        same = timed(limiter, ["10.0.0.1"] * count)
+        distinct = timed(limiter, [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(count)])
+
+        ctx = multiprocessing.get_context("fork")
+        results = ctx.Queue()
+        clients = [f"172.16.{i >> 8 & 255}.{i & 255}" for i in range(count)]
+        workers = [ctx.Process(target=worker, args=(path, clients, results)) for _ in range(processes)]
+        for p in workers:
+            p.start()
+        contended = sum(results.get() for _ in workers) / processes
+        for p in workers:
+            p.join()
+
+    print(f"one client:       {same * 1e6:8.2f} us/request")
+    print(f"distinct clients: {distinct * 1e6:8.2f} us/request ({count} clients)")
+    print(f"{processes} processes:      {contended * 1e6:8.2f} us/request each")
+    return same, distinct, contended
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared rate limiter benchmark")
+    parser.add_argument("--count", type=int, default=200000, help="Requests per run")
+    parser.add_argument("--processes", type=int, default=4, help="Processes sharing the table")
+    args = parser.parse_args()
+    run(args.count, args.processes)
@@ -1,14 +1,77 @@
 import time
 import os
 import json
+import struct
 import hashlib
+from storage import JsonChainStore, BlockLogStore, SQLiteChainStore, MmapBlockStore, migrate_json_chain, file_lock
+from chainstate import ChainState, KnownTxids
+from mempool import MempoolState, MempoolClient, open_mempool, tx_key, tx_fee, tx_size, fill_template
+from verify import verify_transactions
 
 BLOCKCHAIN_FILE = "blockchain.json"
 DIFFICULTY = 4
 REWARD = 10
 
+# Block template limits; txs beyond them wait for the next block
+MAX_BLOCK_TXS = int(os.environ.get("MAX_BLOCK_TXS", "2000"))
+MAX_BLOCK_BYTES = int(os.environ.get("MAX_BLOCK_BYTES", "1000000"))
+
+# Version 1 blocks hash their whole JSON body, txs included. Version 2
+# blocks hash a fixed-size header that commits to the txs through a
+# Merkle root, so the cost of a nonce does not depend on block size.
+BLOCK_VERSION = 2
+
+# version, index, timestamp, previous_hash, tx_root, reward, sha256(address); the nonce follows
+HEADER = struct.Struct(">IQd32s32sq32s")
+NONCE = struct.Struct(">Q")
+MAX_NONCE = 2 ** 64
+
+# Chain storage: "json" (single blockchain.json, fine for dev), "log"
+# (append-only segmented block log), "sqlite" (indexed chain.db) or
+# "mmap" (binary block file with offset index), the latter three under
+# DATA_DIR
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+
+_store = None
+_state = None
+_known_txids = None
+
+def tx_commitment(txs):
+    """Merkle root over the full (signed) transactions"""
+    level = [hashlib.sha256(json.dumps(tx, sort_keys=True).encode()).digest() for tx in txs]
+    if not level:
+        return hashlib.sha256(b"").hexdigest()
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [hashlib.sha256(level[i] + level[i + 1]).digest() for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+def difficulty_target(difficulty):
+    """Digests below this have at least `difficulty` leading zero hex digits"""
+    return (1 << (256 - 4 * difficulty)).to_bytes(32, "big") if difficulty else b"\xff" * 33
+
+def search_nonces(prefix, difficulty, start, stop):
+    """Search nonces in [start, stop) after a v2 header prefix.
+
+    The SHA-256 state over the prefix is computed once and copied for
+    every nonce. Returns (nonce, hash) for the first solution, or None.
+    """
+    base = hashlib.sha256(prefix)
+    target = difficulty_target(difficulty)
+    pack = NONCE.pack
+    for nonce in range(start, stop):
+        header = base.copy()
+        header.update(pack(nonce))
+        digest = header.digest()
+        if digest < target:
+            return nonce, digest.hex()
+    return None
+
 class Block:
-    def __init__(self, index, timestamp, previous_hash, nonce, reward, address, txs=None, hash=None):
+    def __init__(self, index, timestamp, previous_hash, nonce, reward, address, txs=None, hash=None,
+                 version=1, tx_root=None):
         self.index = index
         self.timestamp = timestamp
         self.previous_hash = previous_hash
@@ -16,9 +79,34 @@ class Block:
         self.reward = reward
         self.address = address
         self.txs = txs or []
+        self.version = version
+        self.tx_root = tx_root or (tx_commitment(self.txs) if version >= 2 else None)
         self.hash = hash or self.calculate_hash()
 
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["index"], data["timestamp"], data["previous_hash"], data["nonce"],
+                   data["reward"], data["address"], data.get("txs"), data.get("hash"),
+                   data.get("version", 1), data.get("tx_root"))
+
+    def header_prefix(self):
+        """Serialized v2 header without the trailing nonce"""
+        return HEADER.pack(
+            self.version,
+            self.index,
+            self.timestamp,
+            bytes.fromhex(self.previous_hash),
+            bytes.fromhex(self.tx_root),
+            self.reward,
+            hashlib.sha256(self.address.encode()).digest()
+        )
+
     def calculate_hash(self):
+        if self.version >= 2:
+            header = hashlib.sha256(self.header_prefix())
+            header.update(NONCE.pack(self.nonce))
+            return header.hexdigest()
+
         block_data = {
             'index': self.index,
             'timestamp': self.timestamp,
@@ -31,7 +119,7 @@ class Block:
         return hashlib.sha256(json.dumps(block_data, sort_keys=True).encode()).hexdigest()
 
     def to_dict(self):
-        return {
+        data = {
             'index': self.index,
             'timestamp': self.timestamp,
             'previous_hash': self.previous_hash,
@@ -41,98 +129,207 @@ class Block:
             'txs': self.txs,
             'hash': self.hash
         }
+        if self.version >= 2:
+            data['version'] = self.version
+            data['tx_root'] = self.tx_root
+        return data
+
+    def is_valid(self, difficulty=DIFFICULTY):
+        """Check the tx commitment, the hash and the proof of work"""
+        if self.version >= 2 and self.tx_root != tx_commitment(self.txs):
+            return False
+        return self.hash == self.calculate_hash() and self.hash.startswith("0" * difficulty)
+
+    def mine(self, difficulty=DIFFICULTY, start=0, stop=MAX_NONCE):
+        """Search nonces in [start, stop); sets nonce and hash and returns True on success"""
+        if self.version < 2:
+            for nonce in range(start, stop):
+                self.nonce = nonce
+                self.hash = self.calculate_hash()
+                if self.hash.startswith("0" * difficulty):
+                    return True
+            return False
+
+        found = search_nonces(self.header_prefix(), difficulty, start, stop)
+        if found is None:
+            return False
+        self.nonce, self.hash = found
+        return True
+
+def open_store(backend):
+    if backend == "json":
+        return JsonChainStore(BLOCKCHAIN_FILE)
+    if backend == "log":
+        return BlockLogStore(os.path.join(DATA_DIR, "blocks"))
+    if backend == "sqlite":
+        return SQLiteChainStore(os.path.join(DATA_DIR, "chain.db"))
+    if backend == "mmap":
+        return MmapBlockStore(os.path.join(DATA_DIR, "blockfile"))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = open_store(STORAGE_BACKEND)
+    return _store
+
+def _chain_state():
+    global _state
+    if _state is None:
+        _state = ChainState(os.path.join(DATA_DIR, "state.db"))
+    return _state
+
+def get_state():
+    """Return the derived chain state (balances), synced with the store"""
+    state = _chain_state()
+    state.sync(get_store())
+    return state
+
+def get_balance(address):
+    return get_state().balance(address)
+
+def get_balances(addresses):
+    return get_state().balances(addresses)
+
+def get_known_txids():
+    """Return the known-txid set (Bloom filter + txid index), synced with the chain"""
+    global _known_txids
+    state = get_state()
+    if _known_txids is None:
+        _known_txids = KnownTxids(state, os.path.join(DATA_DIR, "txids.bloom"))
+    _known_txids.sync()
+    return _known_txids
+
+def find_transaction(txid):
+    """Return (block, tx) for a confirmed transaction via the txid index, or None"""
+    location = get_state().locate_tx(txid)
+    if location is None:
+        return None
+    height, position = location
+    block = get_store().get_block(height)
+    return block, block["txs"][position]
 
 def load_chain():
-    if not os.path.exists(BLOCKCHAIN_FILE):
-        return []
-    with open(BLOCKCHAIN_FILE, "r") as f:
-        return json.load(f)
+    return get_store().load_chain()
+
+def iter_chain(start=0, stop=None, reverse=False):
+    """Yield blocks with start <= index < stop from storage, oldest or newest first"""
+    if reverse:
+        return get_store().iter_blocks_reversed(start, stop)
+    return get_store().iter_blocks(start, stop)
 
 def save_block(block):
-    chain = load_chain()
-    chain.append(block.to_dict())
-    with open(BLOCKCHAIN_FILE, "w") as f:
-        json.dump(chain, f, indent=2)
+    """Append a block on top of the tip; raises ValueError if it does not extend it"""
+    if isinstance(block, Block):
+        block = block.to_dict()
+    os.makedirs(DATA_DIR, exist_ok=True)
+    # The miner and the P2P node append from separate processes
+    with file_lock(os.path.join(DATA_DIR, "chain.lock")):
+        store = get_store()
+        height = store.height()
+        tip = store.tip()
+        if block["index"] != height or block["previous_hash"] != (tip["hash"] if tip else "0" * 64):
+            raise ValueError(f"Block #{block['index']} does not extend the tip at height {height}")
+        store.append(block)
+    if not _chain_state().apply_block(block):
+        get_state()
 
-def mine_block(address, txs=None):
-    # VALIDATION START
-    def calculate_balance(chain, addr):
-        bal = 0
-        for blk in chain:
-            if blk["address"] == addr:
-                bal += blk["reward"]
-            for tx in blk.get("txs", []):
-                if tx["from"] == addr:
-                    bal -= tx["amount"]
-                if tx["to"] == addr:
-                    bal += tx["amount"]
-        return bal
-
-    def txid(tx):
-        from hashlib import sha256
-        return sha256(json.dumps(tx, sort_keys=True).encode()).hexdigest()
-
-    chain = load_chain()
-    known_txids = {txid(tx) for blk in chain for tx in blk.get("txs", [])}
+def remove_last_block():
+    """Remove the tip block (e.g. on a reorg) and roll back the chain state"""
+    block = get_store().pop()
+    if block and not _chain_state().revert_block(block):
+        get_state()
+    return block
 
-    if txs is None:
-        # Load mempool
-        if os.path.exists("mempool.json"):
-            with open("mempool.json", "r") as f:
-                txs = json.load(f)
-            # Clear mempool
-            with open("mempool.json", "w") as f:
-                json.dump([], f)
-        else:
-            txs = []
+def rebuild_state():
+    return _chain_state().rebuild(get_store().iter_blocks())
+
+def migrate_chain(backend):
+    """Copy blockchain.json into a freshly created store of the given backend"""
+    return migrate_json_chain(BLOCKCHAIN_FILE, open_store(backend))
+
+def select_transactions(candidates, max_txs=None, max_bytes=None, max_clock_skew=None):
+    """Pick the transactions for a new block.
 
-    # Validate txs
-    valid_txs = []
-    temp_balances = {}
+    candidates is a mempool (taken in fee-rate, then arrival, order) or a
+    plain list of txs (taken in list order). Each sender's spends in the
+    template are tracked incrementally against one confirmed-balance
+    lookup, and selection stops once the tx or byte limit is reached.
+    The signatures of the selected txs are then checked in one batch;
+    txs that fail are dropped from the mempool and the template is
+    selected again without them, so they neither spend their sender's
+    balance nor take the room of valid txs.
+    """
+    known_txids = get_known_txids()
+    selected_txids = set()
+    rejected_txids = set()
+    confirmed = {}
+    balances = {}
+    now = time.time()
 
-    for tx in txs:
-        # TIMESTAMP VALIDATION
-        now = time.time()
-        if abs(now - tx.get("timestamp", now)) > 300:
-            continue  # reject tx if timestamp is older/newer than 5 min
+    def accept(tx):
+        if not all(k in tx for k in ("from", "to", "amount", "signature")):
+            return False
+        amount = tx["amount"]
+        if isinstance(amount, bool) or not isinstance(amount, (int, float)) or amount <= 0:
+            return False
+        if max_clock_skew is not None and abs(now - tx.get("timestamp", now)) > max_clock_skew:
+            return False
+        tid = tx_key(tx)
+        if tid in selected_txids or tid in rejected_txids or tid in known_txids:
+            return False  # already exists in chain or in this block, or failed verification
 
-        tid = txid(tx)
         sender = tx["from"]
-        amt = tx["amount"]
-        if tid in known_txids:
-            continue  # already exists in chain
+        if sender not in balances:
+            if sender not in confirmed:
+                confirmed[sender] = get_balance(sender)
+            balances[sender] = confirmed[sender]
+        cost = amount + tx_fee(tx)
+        if balances[sender] < cost:
+            return False
+        balances[sender] -= cost
+        selected_txids.add(tid)
+        return True
 
-        if sender not in temp_balances:
-            temp_balances[sender] = calculate_balance(chain, sender)
+    max_txs = MAX_BLOCK_TXS if max_txs is None else max_txs
+    max_bytes = MAX_BLOCK_BYTES if max_bytes is None else max_bytes
+    is_mempool = isinstance(candidates, (MempoolState, MempoolClient))
+    if not is_mempool:
+        candidates = list(candidates)
+    while True:
+        selected_txids.clear()
+        balances.clear()
+        if is_mempool:
+            selected = candidates.select(max_txs, max_bytes, accept)
+        else:
+            selected = fill_template(((tx, tx_size(tx)) for tx in candidates), max_txs, max_bytes, accept)
 
-        if temp_balances[sender] >= amt:
-            valid_txs.append(tx)
-            temp_balances[sender] -= amt
-    txs = valid_txs
-    # VALIDATION END
+        # Txs that passed are cached, so a refill only checks the newcomers
+        results = verify_transactions(selected)
+        invalid = [tx for tx, ok in zip(selected, results) if not ok]
+        if not invalid:
+            return selected
+        rejected_txids.update(tx_key(tx) for tx in invalid)
+        if is_mempool:
+            candidates.remove(tx_key(tx) for tx in invalid)
 
+def mine_block(address, txs=None):
     if txs is None:
-        # Load mempool
-        if os.path.exists("mempool.json"):
-            with open("mempool.json", "r") as f:
-                txs = json.load(f)
-            # Clear mempool
-            with open("mempool.json", "w") as f:
-                json.dump([], f)
-        else:
-            txs = []
+        mempool = open_mempool()
+        # Reject txs whose timestamp is older/newer than 5 min
+        txs = select_transactions(mempool, max_clock_skew=300)
+        mempool.remove(tx_key(tx) for tx in txs)
+    else:
+        txs = select_transactions(txs, max_clock_skew=300)
 
-    chain = load_chain()
-    index = len(chain)
-    previous_hash = chain[-1]["hash"] if chain else "0" * 64
-    nonce = 0
+    tip = get_store().tip()
+    index = tip["index"] + 1 if tip else 0
+    previous_hash = tip["hash"] if tip else "0" * 64
     timestamp = time.time()
 
-    while True:
-        blk = Block(index, timestamp, previous_hash, nonce, REWARD, address, txs)
-        if blk.hash.startswith("0" * DIFFICULTY):
-            return blk
-        nonce += 1
+    blk = Block(index, timestamp, previous_hash, 0, REWARD, address, txs, version=BLOCK_VERSION)
+    blk.mine(DIFFICULTY)
+    return blk
 
 def handle_block_commands(args):
     if args.action == "mine":
@@ -148,14 +345,11 @@ def handle_block_commands(args):
             print(f"  TXs     : {len(blk.get('txs', []))}\n")
     elif args.action == "balance":
         addr = args.address
-        chain = load_chain()
-        balance = 0
-        for block in chain:
-            if block["address"] == addr:
-                balance += block["reward"]
-            for tx in block.get("txs", []):
-                if tx["from"] == addr:
-                    balance -= tx["amount"]
-                if tx["to"] == addr:
-                    balance += tx["amount"]
+        balance = get_balance(addr)
         print(f"💰 Balance for {addr[:16]}...: {balance} ShadowCoin")
+    elif args.action == "migrate":
+        count = migrate_chain(args.backend)
+        print(f"✅ Migrated {count} blocks from {BLOCKCHAIN_FILE} to the {args.backend} store")
+    elif args.action == "reindex":
+        count = rebuild_state()
+        print(f"✅ Chain state rebuilt from {count} blocks")
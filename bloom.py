@@ -0,0 +1,33 @@
+import math
+from hashlib import sha256
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings.
+
+    ``k`` bit positions per item are derived from one SHA-256 digest by
+    double hashing. Membership tests never give false negatives.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001, bits: bytes = None, num_hashes: int = None):
+        if bits is None:
+            num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+            bits = bytes((num_bits + 7) // 8)
+            num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        self.bits = bytearray(bits)
+        self.num_bits = len(self.bits) * 8
+        self.num_hashes = num_hashes
+
+    def _positions(self, item: str):
+        digest = sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
@@ -0,0 +1,366 @@
+import os
+import struct
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+from bloom import BloomFilter
+from mempool import tx_key, tx_fee
+from storage import ChainStore, SQLiteDatabase
+
+logger = logging.getLogger(__name__)
+
+
+class ChainState:
+    """Derived chain state kept next to the block store.
+
+    Holds an address -> balance table, a per-address history index and a
+    txid -> (height, position) index that are updated as blocks are
+    appended and rolled back as they are removed, so balance, history and
+    transaction lookups no longer replay the chain. Everything
+    here can be rebuilt from the blocks at any time with ``rebuild``.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value
+        );
+        CREATE TABLE IF NOT EXISTS balances (
+            address TEXT PRIMARY KEY,
+            balance NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS history (
+            address TEXT NOT NULL,
+            height INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            direction TEXT NOT NULL,
+            amount NOT NULL,
+            counterparty TEXT,
+            txid TEXT,
+            timestamp REAL,
+            PRIMARY KEY (address, height, position, direction)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS history_height ON history(height);
+        CREATE TABLE IF NOT EXISTS txids (
+            txid TEXT PRIMARY KEY,
+            height INTEGER NOT NULL,
+            position INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS txids_height ON txids(height);
+    """
+
+    # Bumped whenever a table is added or re-keyed, or the balance rules
+    # change, forcing a rebuild of older state files
+    VERSION = 6
+
+    # Position used for the block reward in the history index
+    REWARD_POSITION = -1
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = SQLiteDatabase(path, self.SCHEMA)
+        # (store, store.stamp()) as of the last sync, to skip re-checking an unchanged store
+        self._synced = None
+
+    def _meta(self, conn, key: str, default=None):
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, conn, key: str, value):
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _credit(self, conn, address: str, amount):
+        conn.execute(
+            "INSERT INTO balances (address, balance) VALUES (?, ?) "
+            "ON CONFLICT(address) DO UPDATE SET balance = balance + excluded.balance",
+            (address, amount)
+        )
+
+    def _bump_generation(self, conn):
+        # Lets caches built on top of the state notice rebuilds and rollbacks
+        self._set_meta(conn, "generation", self._meta(conn, "generation", 0) + 1)
+
+    def height(self) -> int:
+        return self._meta(self.db.connect(), "height", 0)
+
+    def generation(self) -> int:
+        return self._meta(self.db.connect(), "generation", 0)
+
+    def tip_hash(self) -> Optional[str]:
+        return self._meta(self.db.connect(), "tip_hash")
+
+    def _apply(self, conn, block: Dict):
+        height = block["index"]
+        # Same order as a full replay so float balances come out identical
+        self._credit(conn, block["address"], block["reward"])
+        rows = [(block["address"], height, self.REWARD_POSITION, "reward", block["reward"],
+                 None, None, block["timestamp"])]
+
+        for position, tx in enumerate(block.get("txs", [])):
+            txid = tx_key(tx)
+            self._credit(conn, tx["from"], -tx["amount"])
+            self._credit(conn, tx["to"], tx["amount"])
+            rows.append((tx["from"], height, position, "out", tx["amount"],
+                         tx["to"], txid, tx.get("timestamp")))
+            rows.append((tx["to"], height, position, "in", tx["amount"],
+                         tx["from"], txid, tx.get("timestamp")))
+            # The fee goes from the sender to the block's miner
+            fee = tx_fee(tx)
+            if fee:
+                self._credit(conn, tx["from"], -fee)
+                self._credit(conn, block["address"], fee)
+                rows.append((tx["from"], height, position, "fee_out", fee,
+                             block["address"], txid, tx.get("timestamp")))
+                rows.append((block["address"], height, position, "fee_in", fee,
+                             tx["from"], txid, tx.get("timestamp")))
+
+        # The first confirmation of a txid wins, like a front-to-back scan
+        conn.executemany(
+            "INSERT OR IGNORE INTO txids (txid, height, position) VALUES (?, ?, ?)",
+            [(tx_key(tx), height, position) for position, tx in enumerate(block.get("txs", []))]
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO history "
+            "(address, height, position, direction, amount, counterparty, txid, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+
+    def _revert(self, conn, block: Dict):
+        for tx in reversed(block.get("txs", [])):
+            fee = tx_fee(tx)
+            if fee:
+                self._credit(conn, block["address"], -fee)
+                self._credit(conn, tx["from"], fee)
+            self._credit(conn, tx["to"], -tx["amount"])
+            self._credit(conn, tx["from"], tx["amount"])
+        self._credit(conn, block["address"], -block["reward"])
+        conn.execute("DELETE FROM history WHERE height = ?", (block["index"],))
+        conn.execute("DELETE FROM txids WHERE height = ?", (block["index"],))
+
+    def apply_block(self, block: Dict) -> bool:
+        """Apply a newly appended block; returns False if it was already applied"""
+        self._synced = None
+        with self.db.transaction() as conn:
+            # Another process may have caught up on this block already
+            if block["index"] != self._meta(conn, "height", 0):
+                return False
+            self._apply(conn, block)
+            self._set_meta(conn, "height", block["index"] + 1)
+            self._set_meta(conn, "tip_hash", block["hash"])
+        return True
+
+    def revert_block(self, block: Dict) -> bool:
+        """Undo a block removed from the tip; returns False if it is not the tip"""
+        self._synced = None
+        with self.db.transaction() as conn:
+            if block["hash"] != self._meta(conn, "tip_hash"):
+                return False
+            self._revert(conn, block)
+            self._bump_generation(conn)
+            self._set_meta(conn, "height", block["index"])
+            self._set_meta(conn, "tip_hash", block["previous_hash"] if block["index"] else None)
+        return True
+
+    def rebuild(self, blocks: Iterable[Dict]) -> int:
+        """Recompute all state from scratch; returns the number of blocks applied"""
+        self._synced = None
+        count = 0
+        tip_hash = None
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM balances")
+            conn.execute("DELETE FROM history")
+            conn.execute("DELETE FROM txids")
+            for block in blocks:
+                self._apply(conn, block)
+                count += 1
+                tip_hash = block["hash"]
+            self._set_meta(conn, "height", count)
+            self._set_meta(conn, "tip_hash", tip_hash)
+            self._set_meta(conn, "version", self.VERSION)
+            self._bump_generation(conn)
+        logger.info(f"Chain state rebuilt from {count} blocks")
+        return count
+
+    def sync(self, store: ChainStore):
+        """Bring the state in line with the store, catching up or rebuilding"""
+        # Taken before reading the chain, so an append racing with this
+        # sync changes the stamp and is picked up by the next one
+        stamp = store.stamp()
+        if self._synced == (store, stamp):
+            return
+        self._sync(store)
+        self._synced = (store, stamp)
+
+    def _sync(self, store: ChainStore):
+        height = store.height()
+        tip = store.tip()
+        tip_hash = tip["hash"] if tip else None
+        state_height = self.height()
+
+        if self._meta(self.db.connect(), "version") != self.VERSION:
+            self.rebuild(store.iter_blocks())
+            return
+        if state_height == height and self.tip_hash() == tip_hash:
+            return
+        if state_height < height:
+            # Catch up if our tip is still on the stored chain
+            anchor = store.get_block(state_height - 1) if state_height else None
+            if (anchor["hash"] if anchor else None) == self.tip_hash():
+                for block in store.iter_blocks(state_height, height):
+                    self.apply_block(block)
+                return
+        self.rebuild(store.iter_blocks())
+
+    def balance(self, address: str):
+        row = self.db.connect().execute(
+            "SELECT balance FROM balances WHERE address = ?", (address,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def balances(self, addresses: Iterable[str]) -> Dict[str, object]:
+        """Return balances for many addresses with one indexed query per chunk"""
+        addresses = list(dict.fromkeys(addresses))
+        result = dict.fromkeys(addresses, 0)
+        conn = self.db.connect()
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(addresses), 500):
+            chunk = addresses[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for address, balance in conn.execute(
+                f"SELECT address, balance FROM balances WHERE address IN ({placeholders})", chunk
+            ):
+                result[address] = balance
+        return result
+
+    def locate_tx(self, txid: str) -> Optional[Tuple[int, int]]:
+        """Return (height, position) of a confirmed transaction, or None"""
+        row = self.db.connect().execute(
+            "SELECT height, position FROM txids WHERE txid = ?", (txid,)
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def txids_since(self, height: int) -> List[str]:
+        """Return the indexed txids confirmed at or above height"""
+        return [row[0] for row in self.db.connect().execute(
+            "SELECT txid FROM txids WHERE height >= ?", (height,)
+        )]
+
+    def history(self, address: str, cursor: Optional[str] = None,
+                limit: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """Return one page of an address's history, newest first.
+
+        The cursor is the opaque ``next_cursor`` of the previous page, and
+        each page is a single index range scan regardless of chain length.
+        """
+        query = ("SELECT height, position, direction, amount, counterparty, txid, timestamp "
+                 "FROM history WHERE address = ?")
+        params = [address]
+        if cursor:
+            height, position, direction = cursor.split(":", 2)
+            query += " AND (height, position, direction) < (?, ?, ?)"
+            params += [int(height), int(position), direction]
+        query += " ORDER BY height DESC, position DESC, direction DESC LIMIT ?"
+        params.append(limit)
+
+        entries = [
+            {
+                "height": row[0],
+                "position": row[1],
+                "direction": row[2],
+                "amount": row[3],
+                "counterparty": row[4],
+                "txid": row[5],
+                "timestamp": row[6]
+            }
+            for row in self.db.connect().execute(query, params)
+        ]
+        next_cursor = None
+        if len(entries) == limit:
+            last = entries[-1]
+            next_cursor = f"{last['height']}:{last['position']}:{last['direction']}"
+        return entries, next_cursor
+
+
+class KnownTxids:
+    """Known-txid set: a Bloom filter in front of the exact txid index.
+
+    Most candidate transactions are new, and for those the filter answers
+    without touching the database; only filter hits are confirmed against
+    ``ChainState.locate_tx``. The filter is snapshotted to disk so a miner
+    starts without rehashing the chain, and ``sync`` folds in blocks
+    appended since. A state rebuild or rollback reloads it from the index.
+    """
+
+    HEADER = struct.Struct(">4sQQQQI")
+    MAGIC = b"TXBF"
+    MIN_CAPACITY = 100000
+
+    def __init__(self, state: ChainState, path: str):
+        self.state = state
+        self.path = path
+        self.filter = None
+        self.generation = None
+        self.height = 0
+        self.count = 0
+        self.capacity = 0
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.path, "rb") as f:
+                magic, generation, height, count, capacity, num_hashes = self.HEADER.unpack(
+                    f.read(self.HEADER.size)
+                )
+                bits = f.read()
+        except (OSError, struct.error):
+            return
+        if magic != self.MAGIC:
+            return
+        self.filter = BloomFilter(0, bits=bits, num_hashes=num_hashes)
+        self.generation = generation
+        self.height = height
+        self.count = count
+        self.capacity = capacity
+
+    def _save_snapshot(self):
+        # Several processes may snapshot at once, so each writes its own temp file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.generation, self.height, self.count,
+                                     self.capacity, self.filter.num_hashes))
+            f.write(self.filter.bits)
+        os.replace(tmp_path, self.path)
+
+    def _reload(self, txids: List[str]):
+        self.capacity = max(self.MIN_CAPACITY, 2 * len(txids))
+        self.filter = BloomFilter(self.capacity)
+        for txid in txids:
+            self.filter.add(txid)
+        self.count = len(txids)
+
+    def sync(self):
+        """Fold in blocks appended since the last sync"""
+        generation = self.state.generation()
+        height = self.state.height()
+        if height == self.height and generation == self.generation:
+            return
+
+        if self.filter is None or generation != self.generation or height < self.height:
+            self._reload(self.state.txids_since(0))
+        else:
+            new_txids = self.state.txids_since(self.height)
+            if self.count + len(new_txids) > self.capacity:
+                self._reload(self.state.txids_since(0))
+            else:
+                for txid in new_txids:
+                    self.filter.add(txid)
+                self.count += len(new_txids)
+
+        self.generation = generation
+        self.height = height
+        self._save_snapshot()
+
+    def __contains__(self, txid: str) -> bool:
+        if self.filter is not None and txid not in self.filter:
+            return False
+        return self.state.locate_tx(txid) is not None
@@ -9,6 +9,7 @@ import sys
 import os
 import time
 from typing import Optional
+from urllib.parse import quote
 import requests
 from mnemonic import Mnemonic
 from ecdsa import SigningKey, VerifyingKey, SECP256k1
@@ -90,6 +91,59 @@ class ShadowLedgerCLI:
             print(f"❌ Failed to get balance: {e}")
             sys.exit(1)
     
+    def get_balances(self, path: str):
+        """Get balances for every address listed in a file (one per line)"""
+        try:
+            with open(path, "r") as f:
+                addresses = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        except OSError as e:
+            print(f"❌ Failed to read {path}: {e}")
+            sys.exit(1)
+        
+        print(f"💰 Getting balances for {len(addresses)} addresses...")
+        
+        try:
+            result = self._make_request("POST", "/wallet/balances", {"addresses": addresses})
+            
+            for address, balance in result['balances'].items():
+                print(f"  {address}: {balance} ShadowCoin")
+            return result['balances']
+        except Exception as e:
+            print(f"❌ Failed to get balances: {e}")
+            sys.exit(1)
+    
+    def get_history(self, address: str, limit: int = 20, cursor: Optional[str] = None, fetch_all: bool = False):
+        """Get transaction history for an address, newest first"""
+        print(f"📜 Getting history for {address[:16]}...")
+        
+        try:
+            entries = []
+            while True:
+                endpoint = f"/wallet/{address}/history?limit={limit}"
+                if cursor:
+                    endpoint += f"&cursor={quote(cursor)}"
+                result = self._make_request("GET", endpoint)
+                
+                for entry in result['history']:
+                    icon = {"in": "📥", "out": "📤", "reward": "⛏️ ", "fee_in": "💰", "fee_out": "💸"}[entry['direction']]
+                    counterparty = f" {entry['counterparty'][:16]}..." if entry['counterparty'] else ""
+                    print(f"  {icon} Block #{entry['height']}: {entry['direction']} {entry['amount']} ShadowCoin{counterparty}")
+                entries.extend(result['history'])
+                
+                cursor = result['next_cursor']
+                if not fetch_all or not cursor:
+                    break
+            
+            if not entries:
+                print("📭 No history found")
+            elif cursor:
+                print(f"➡️  More entries: --cursor {cursor}")
+            
+            return entries
+        except Exception as e:
+            print(f"❌ Failed to get history: {e}")
+            sys.exit(1)
+    
     def send_transaction(self, sender: str, recipient: str, amount: float, private_key: str):
         """Send a transaction"""
         print(f"📤 Sending {amount} ShadowCoin from {sender[:16]}... to {recipient[:16]}...")
@@ -169,14 +223,15 @@ class ShadowLedgerCLI:
         print(f"📦 Getting latest {count} blocks...")
         
         try:
-            result = self._make_request("GET", "/blockchain")
+            result = self._make_request("GET", f"/blockchain?reverse=true&limit={count}")
             blocks = result['blocks']
             
             if not blocks:
                 print("📭 No blocks found")
                 return
             
-            latest_blocks = blocks[-count:] if len(blocks) >= count else blocks
+            # Newest first from the API; shown oldest to newest
+            latest_blocks = list(reversed(blocks))
             
             print(f"✅ Latest {len(latest_blocks)} blocks:")
             for block in latest_blocks:
@@ -223,6 +278,12 @@ Examples:
   # Get balance
   python cli.py wallet balance shadow1abc123...
   
+  # Get balances for a list of addresses (one per line)
+  python cli.py wallet balances --file addresses.txt
+  
+  # Get transaction history
+  python cli.py wallet history shadow1abc123... --limit 20
+  
   # Send transaction
   python cli.py tx send --from shadow1abc123... --to shadow1def456... --amount 10 --key abc123...
   
@@ -253,6 +314,15 @@ Examples:
     balance_parser = wallet_subparsers.add_parser("balance", help="Get wallet balance")
     balance_parser.add_argument("address", help="Wallet address")
     
+    balances_parser = wallet_subparsers.add_parser("balances", help="Get balances for many addresses")
+    balances_parser.add_argument("--file", required=True, help="File with one address per line")
+    
+    history_parser = wallet_subparsers.add_parser("history", help="Get wallet transaction history")
+    history_parser.add_argument("address", help="Wallet address")
+    history_parser.add_argument("--limit", type=int, default=20, help="Entries per page")
+    history_parser.add_argument("--cursor", help="Cursor from a previous page")
+    history_parser.add_argument("--all", dest="fetch_all", action="store_true", help="Fetch every page")
+    
     # Transaction commands
     tx_parser = subparsers.add_parser("tx", help="Transaction operations")
     tx_subparsers = tx_parser.add_subparsers(dest="tx_action")
@@ -298,6 +368,10 @@ Examples:
             cli.recover_wallet(args.mnemonic)
         elif args.wallet_action == "balance":
             cli.get_balance(args.address)
+        elif args.wallet_action == "balances":
+            cli.get_balances(args.file)
+        elif args.wallet_action == "history":
+            cli.get_history(args.address, args.limit, args.cursor, args.fetch_all)
     
     elif args.command == "tx":
         if args.tx_action == "send":
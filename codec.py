@@ -0,0 +1,249 @@
+import re
+import json
+import struct
+from typing import Dict, List
+
+# Leading bytes of every encoded record. The magic byte can never start a
+# JSON document, so readers can tell codec records from legacy JSON ones.
+MAGIC = b"\xb5"
+VERSION = 1
+
+# Content type for codec payloads served by the API
+MEDIA_TYPE = "application/x-shadowledger"
+
+# Known fields in to_dict() order; anything else travels in the extras section
+# (new fields are only ever appended, so older records keep decoding)
+BLOCK_FIELDS = ("index", "timestamp", "previous_hash", "nonce", "reward", "address", "txs", "hash",
+                "version", "tx_root")
+TX_FIELDS = ("from", "to", "amount", "timestamp", "signature", "txid")
+
+# Address prefixes stored as a one-byte id plus the raw bytes of the hex part
+ADDRESS_PREFIXES = ("shadow1", "stealth1")
+
+# Value tags
+T_NONE = 0
+T_INT = 1
+T_FLOAT = 2
+T_STR = 3
+T_HEX = 4
+T_ADDRESS = 5
+T_TRUE = 6
+T_FALSE = 7
+T_JSON = 8
+
+FLOAT = struct.Struct(">d")
+HEX_RE = re.compile(r"(?:[0-9a-f]{2})+")
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _write_varint(out: bytearray, value: int):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data, pos: int):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _write_bytes(out: bytearray, raw: bytes):
+    _write_varint(out, len(raw))
+    out += raw
+
+
+def _read_bytes(data, pos: int):
+    length, pos = _read_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise CodecError("Truncated record")
+    return bytes(data[pos:end]), end
+
+
+def _write_value(out: bytearray, value):
+    """Encode one value losslessly, so json.dumps of the decoded dict is unchanged"""
+    if value is None:
+        out.append(T_NONE)
+    elif value is True:
+        out.append(T_TRUE)
+    elif value is False:
+        out.append(T_FALSE)
+    elif isinstance(value, int):
+        out.append(T_INT)
+        # Zigzag so small negative amounts stay short
+        _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        out.append(T_FLOAT)
+        out += FLOAT.pack(value)
+    elif isinstance(value, str):
+        for prefix_id, prefix in enumerate(ADDRESS_PREFIXES):
+            rest = value[len(prefix):]
+            if value.startswith(prefix) and HEX_RE.fullmatch(rest):
+                out.append(T_ADDRESS)
+                out.append(prefix_id)
+                _write_bytes(out, bytes.fromhex(rest))
+                return
+        if HEX_RE.fullmatch(value):
+            out.append(T_HEX)
+            _write_bytes(out, bytes.fromhex(value))
+        else:
+            out.append(T_STR)
+            _write_bytes(out, value.encode())
+    else:
+        out.append(T_JSON)
+        _write_bytes(out, json.dumps(value, separators=(",", ":")).encode())
+
+
+def _read_value(data, pos: int):
+    tag = data[pos]
+    pos += 1
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_INT:
+        raw, pos = _read_varint(data, pos)
+        return (raw >> 1) if not raw & 1 else -((raw + 1) >> 1), pos
+    if tag == T_FLOAT:
+        return FLOAT.unpack_from(data, pos)[0], pos + FLOAT.size
+    if tag == T_ADDRESS:
+        prefix = ADDRESS_PREFIXES[data[pos]]
+        raw, pos = _read_bytes(data, pos + 1)
+        return prefix + raw.hex(), pos
+    if tag == T_HEX:
+        raw, pos = _read_bytes(data, pos)
+        return raw.hex(), pos
+    if tag == T_STR:
+        raw, pos = _read_bytes(data, pos)
+        return raw.decode(), pos
+    if tag == T_JSON:
+        raw, pos = _read_bytes(data, pos)
+        return json.loads(raw), pos
+    raise CodecError(f"Unknown value tag {tag}")
+
+
+def _write_record(out: bytearray, record: Dict, fields, nested=None):
+    """Write a presence bitmask, the known fields in order, then any extras"""
+    mask = 0
+    for bit, field in enumerate(fields):
+        if field in record:
+            mask |= 1 << bit
+    _write_varint(out, mask)
+
+    for field in fields:
+        if field not in record:
+            continue
+        if field == nested:
+            items = record[field]
+            _write_varint(out, len(items))
+            for item in items:
+                _write_record(out, item, TX_FIELDS)
+        else:
+            _write_value(out, record[field])
+
+    extras = [key for key in record if key not in fields]
+    _write_varint(out, len(extras))
+    for key in extras:
+        _write_bytes(out, key.encode())
+        _write_value(out, record[key])
+
+
+def _read_record(data, pos: int, fields, nested=None):
+    mask, pos = _read_varint(data, pos)
+    record = {}
+
+    for bit, field in enumerate(fields):
+        if not mask & (1 << bit):
+            continue
+        if field == nested:
+            count, pos = _read_varint(data, pos)
+            items = []
+            for _ in range(count):
+                item, pos = _read_record(data, pos, TX_FIELDS)
+                items.append(item)
+            record[field] = items
+        else:
+            record[field], pos = _read_value(data, pos)
+
+    count, pos = _read_varint(data, pos)
+    for _ in range(count):
+        key, pos = _read_bytes(data, pos)
+        record[key.decode()], pos = _read_value(data, pos)
+    return record, pos
+
+
+def _header() -> bytearray:
+    return bytearray(MAGIC + bytes([VERSION]))
+
+
+def _check_header(data) -> int:
+    if len(data) < 2 or bytes(data[:1]) != MAGIC:
+        raise CodecError("Not a codec record")
+    if data[1] != VERSION:
+        raise CodecError(f"Unsupported codec version {data[1]}")
+    return 2
+
+
+def is_encoded(data) -> bool:
+    """True if data starts with the codec magic byte"""
+    return len(data) > 0 and bytes(data[:1]) == MAGIC
+
+
+def encode_block(block: Dict) -> bytes:
+    """Encode a Block.to_dict() dict"""
+    out = _header()
+    _write_record(out, block, BLOCK_FIELDS, nested="txs")
+    return bytes(out)
+
+
+def decode_block(data) -> Dict:
+    block, _ = _read_record(data, _check_header(data), BLOCK_FIELDS, nested="txs")
+    return block
+
+
+def encode_tx(tx: Dict) -> bytes:
+    """Encode a transaction dict"""
+    out = _header()
+    _write_record(out, tx, TX_FIELDS)
+    return bytes(out)
+
+
+def decode_tx(data) -> Dict:
+    tx, _ = _read_record(data, _check_header(data), TX_FIELDS)
+    return tx
+
+
+def encode_blocks(blocks: List[Dict]) -> bytes:
+    """Encode a list of blocks (a chain or chain segment)"""
+    out = _header()
+    _write_varint(out, len(blocks))
+    for block in blocks:
+        _write_record(out, block, BLOCK_FIELDS, nested="txs")
+    return bytes(out)
+
+
+def decode_blocks(data) -> List[Dict]:
+    pos = _check_header(data)
+    count, pos = _read_varint(data, pos)
+    blocks = []
+    for _ in range(count):
+        block, pos = _read_record(data, pos, BLOCK_FIELDS, nested="txs")
+        blocks.append(block)
+    return blocks
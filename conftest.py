@@ -0,0 +1,15 @@
+import pytest
+
+
+@pytest.fixture
+def empty_chain(tmp_path, monkeypatch):
+    """Run in a scratch directory with block.py's store, state and txid set unopened.
+
+    The block module caches them on first use, so without the reset a test
+    would keep reading the chain of whichever test opened them first.
+    """
+    import block
+    monkeypatch.chdir(tmp_path)
+    for name in ("_store", "_state", "_known_txids"):
+        monkeypatch.setattr(block, name, None)
+    return tmp_path
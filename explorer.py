@@ -1,9 +1,10 @@
-from flask import Flask, render_template_string, jsonify
-import json
-import os
+from flask import Flask, render_template_string, jsonify, request
+from block import load_chain, get_store
 
 app = Flask(__name__)
-BLOCKCHAIN_FILE = "blockchain.json"
+
+# Number of most recent blocks shown on the index page
+EXPLORER_BLOCKS = 50
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -32,19 +33,20 @@ HTML_TEMPLATE = """
 
 @app.route("/")
 def index():
-    if os.path.exists(BLOCKCHAIN_FILE):
-        with open(BLOCKCHAIN_FILE, "r") as f:
-            chain = json.load(f)
+    store = get_store()
+    query = request.args.get("q", "").strip()
+    if query:
+        # Point lookup by height or block hash
+        block = store.get_block(int(query)) if query.isdigit() else store.get_block_by_hash(query)
+        chain = [block] if block else []
     else:
-        chain = []
+        height = store.height()
+        chain = list(store.iter_blocks(max(height - EXPLORER_BLOCKS, 0), height))
     return render_template_string(open("explorer_template.html").read(), chain=chain)
 
 @app.route("/api/chain")
 def api_chain():
-    if os.path.exists(BLOCKCHAIN_FILE):
-        with open(BLOCKCHAIN_FILE, "r") as f:
-            return jsonify(json.load(f))
-    return jsonify([])
+    return jsonify(load_chain())
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,90 @@
+import os
+import threading
+from typing import Callable, Dict, Optional
+
+# Blocks at least this far below the tip are treated as final: served with
+# long-lived cache headers and kept serialized across new blocks
+CACHE_FINAL_DEPTH = int(os.environ.get("CACHE_FINAL_DEPTH", "100"))
+
+# Serialized final blocks kept per process
+BLOCK_CACHE_SIZE = int(os.environ.get("BLOCK_CACHE_SIZE", "4096"))
+
+# Cache-Control for final blocks, and for everything that can still change
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+_UNSEEN = object()
+
+
+def etag(*parts) -> str:
+    """Strong ETag built from a content hash and the representation"""
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+
+def etag_matches(if_none_match: Optional[str], tag: str) -> bool:
+    """True if an If-None-Match header value names tag (weak comparison, as RFC 9110 asks)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == tag:
+            return True
+    return False
+
+
+class TipCache:
+    """Values derived from the chain, kept for as long as the tip stays the same.
+
+    ``current()`` only compares the store's stamp() with the one seen at
+    the last refresh, a stat or a PRAGMA; the tip block is read again by
+    ``refresh()`` once the stamp moves. Entries belong to the tip hash
+    they were computed at and are dropped when it changes, reorgs included.
+    """
+
+    def __init__(self, get_store: Callable):
+        self._get_store = get_store
+        self._stamp = _UNSEEN
+        self.tip_hash: Optional[str] = None
+        self.height = 0
+        self.entries: Dict = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def current(self) -> bool:
+        """True if the chain has not changed since the last refresh"""
+        return self._stamp is not _UNSEEN and self._get_store().stamp() == self._stamp
+
+    def refresh(self):
+        """Read the tip again; blocking, so async callers should offload it"""
+        store = self._get_store()
+        # Taken before the read: a block landing in between moves the stamp
+        # again, so it is picked up by the next refresh
+        stamp = store.stamp()
+        tip = store.tip()
+        with self._lock:
+            tip_hash = tip["hash"] if tip else None
+            if tip_hash != self.tip_hash:
+                self.entries.clear()
+            self.tip_hash = tip_hash
+            self.height = tip["index"] + 1 if tip else 0
+            self._stamp = stamp
+
+    def get(self, key):
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value, tip_hash: Optional[str]):
+        """Keep value if it was computed at the tip this cache holds"""
+        with self._lock:
+            if tip_hash == self.tip_hash:
+                self.entries[key] = value
+
+    def stats(self) -> Dict:
+        return {"tip": self.tip_hash, "height": self.height, "size": len(self.entries),
+                "hits": self.hits, "misses": self.misses}
@@ -13,6 +13,8 @@ def main():
     block_sub.add_parser("mine", help="Rudarenje bloka").add_argument("--address", required=True, help="Stealth adresa rudara")
     block_sub.add_parser("view", help="Prikaz svih blokova")
     block_sub.add_parser("balance", help="Prikaz balansa").add_argument("--address", required=True)
+    block_sub.add_parser("reindex", help="Ponovna izgradnja stanja balansa iz lanca")
+    block_sub.add_parser("migrate", help="Migracija blockchain.json u novi storage").add_argument("--backend", default="log", help="Ciljni storage backend")
 
     # Wallet module
     wallet_parser = subparsers.add_parser("wallet", help="Upravljanje walletom")
@@ -0,0 +1,568 @@
+import os
+import json
+import time
+import heapq
+import bisect
+import socket
+import logging
+import threading
+from itertools import chain, islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from codec import encode_tx
+from verify import tx_hash
+
+logger = logging.getLogger(__name__)
+
+# Pending transactions on disk: the file backend's mempool, and the daemon's
+# snapshot, so switching between the two keeps what is pending
+MEMPOOL_FILE = os.environ.get("MEMPOOL_FILE", "mempool.json")
+
+# Unix socket of the shared mempool daemon (mempoold.py). When unset, each
+# process works on MEMPOOL_FILE directly, which is fine for a single process.
+MEMPOOL_SOCKET = os.environ.get("MEMPOOL_SOCKET")
+
+# Candidates fetched per round trip when a client fills a block template
+CANDIDATE_PAGE = 512
+
+# Bounds: past them the lowest-priority txs are evicted, and txs older than
+# the TTL (by their timestamp) expire, matching the 5 minute window in which
+# block.mine_block still accepts them
+MEMPOOL_MAX_TXS = int(os.environ.get("MEMPOOL_MAX_TXS", "50000"))
+MEMPOOL_MAX_BYTES = int(os.environ.get("MEMPOOL_MAX_BYTES", "32000000"))
+MEMPOOL_TTL = float(os.environ.get("MEMPOOL_TTL", "300"))
+
+# How far ahead of our clock a tx's timestamp may be, the same skew
+# block.mine_block allows; later ones are turned away at admission
+MEMPOOL_MAX_FUTURE = float(os.environ.get("MEMPOOL_MAX_FUTURE", "300"))
+
+
+def tx_key(tx: Dict) -> str:
+    """Return the txid of a transaction, derived from its signed fields.
+
+    The sender-supplied "txid" is ignored: it is not covered by the
+    signature, and trusting it would let a copy of a confirmed tx with a
+    fresh txid be replayed.
+    """
+    return tx_hash(tx)
+
+
+def tx_fee(tx: Dict):
+    """Optional fee offered by a transaction; anything but a positive number counts as none"""
+    fee = tx.get("fee")
+    if isinstance(fee, bool) or not isinstance(fee, (int, float)) or fee < 0:
+        return 0
+    return fee
+
+
+def tx_debit(tx: Dict):
+    """Amount a transaction takes from its sender, fee included"""
+    amount = tx.get("amount")
+    if isinstance(amount, bool) or not isinstance(amount, (int, float)) or amount < 0:
+        amount = 0
+    return amount + tx_fee(tx)
+
+
+def tx_size(tx: Dict) -> int:
+    """Size of a transaction in a block, in codec bytes"""
+    return len(encode_tx(tx))
+
+
+def fill_template(candidates: Iterable[Tuple[Dict, int]], max_txs: int, max_bytes: int,
+                  accept: Callable[[Dict], bool]) -> List[Dict]:
+    """Take (tx, size) candidates in order until the tx or byte limit is reached.
+
+    Stops at the first candidate that does not fit, so the work done is
+    bounded by the size of the template rather than by the candidates.
+    """
+    selected = []
+    used = 0
+    for tx, size in candidates:
+        if len(selected) >= max_txs or used + size > max_bytes:
+            break
+        if accept(tx):
+            selected.append(tx)
+            used += size
+    return selected
+
+
+class MempoolError(Exception):
+    pass
+
+
+class MempoolFull(MempoolError):
+    pass
+
+
+class InsufficientFunds(MempoolError):
+    pass
+
+
+class MempoolState:
+    """Pending transactions held in memory with txid, sender and priority indexes.
+
+    Fee-less transactions sit in an arrival-ordered dict, so admitting and
+    removing them is O(1); fee-paying ones are kept sorted by fee rate and
+    come first when a block template is filled.
+
+    The pool is bounded by ``max_txs`` and ``max_bytes``; when a new tx
+    pushes it over, the lowest-priority entries (the newest fee-less ones,
+    then the lowest fee rates) are evicted. A heap keyed by expiry time
+    drops txs once they are ``ttl`` seconds old, popping only the expired
+    entries instead of rescanning the pool. Age counts from the tx's
+    timestamp or its arrival, whichever is earlier, and txs dated more
+    than ``max_future`` seconds ahead are not admitted.
+
+    Each sender's pending debits (amounts plus fees) are kept as a running
+    total, so an over-spend can be turned away at admission in O(1).
+    """
+
+    def __init__(self, max_txs: int = MEMPOOL_MAX_TXS, max_bytes: int = MEMPOOL_MAX_BYTES,
+                 ttl: Optional[float] = MEMPOOL_TTL, max_future: Optional[float] = MEMPOOL_MAX_FUTURE):
+        self.max_txs = max_txs
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_future = max_future
+        # txid -> tx, in arrival order
+        self.txs: Dict[str, Dict] = {}
+        self.sizes: Dict[str, int] = {}
+        # sender -> txids (ordered set)
+        self.senders: Dict[str, Dict[str, None]] = {}
+        # sender -> total pending debit
+        self.debits: Dict[str, float] = {}
+        # Fee-less txids in arrival order (ordered set)
+        self.arrival: Dict[str, None] = {}
+        # Sorted (-fee rate, seq, txid) of fee-paying txs, and txid -> entry
+        self.fee_order: List[Tuple[float, int, str]] = []
+        self.fee_entries: Dict[str, Tuple[float, int, str]] = {}
+        # (expires at, seq, txid); entries of txs that already left are skipped lazily
+        self.expiry: List[Tuple[float, int, str]] = []
+        self.seqs: Dict[str, int] = {}
+        self.bytes = 0
+        self.evictions = {"expired": 0, "full": 0, "rejected": 0}
+        self._seq = 0
+        self.version = 0
+        self._lock = threading.RLock()
+
+    def _timestamp(self, tx: Dict, now: float) -> float:
+        timestamp = tx.get("timestamp")
+        if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+            return now
+        return timestamp
+
+    def _expires_at(self, tx: Dict, now: float) -> float:
+        # Counted from arrival at the latest, so a future-dated tx cannot
+        # outstay the TTL
+        return min(self._timestamp(tx, now), now) + self.ttl
+
+    def _insert(self, txid: str, tx: Dict, now: float):
+        size = tx_size(tx)
+        self.txs[txid] = tx
+        self.sizes[txid] = size
+        self.bytes += size
+        self.seqs[txid] = self._seq
+        if self.ttl is not None:
+            heapq.heappush(self.expiry, (self._expires_at(tx, now), self._seq, txid))
+        sender = tx.get("from")
+        self.senders.setdefault(sender, {})[txid] = None
+        self.debits[sender] = self.debits.get(sender, 0) + tx_debit(tx)
+        fee = tx_fee(tx)
+        if fee:
+            # Highest fee rate first, then arrival
+            entry = (-fee / size, self._seq, txid)
+            self.fee_entries[txid] = entry
+            bisect.insort(self.fee_order, entry)
+        else:
+            self.arrival[txid] = None
+        self._seq += 1
+
+    def _discard(self, txid: str) -> Optional[Dict]:
+        tx = self.txs.pop(txid, None)
+        if tx is None:
+            return None
+        self.bytes -= self.sizes.pop(txid)
+        del self.seqs[txid]
+        sender = tx.get("from")
+        pending = self.senders[sender]
+        del pending[txid]
+        if pending:
+            self.debits[sender] -= tx_debit(tx)
+        else:
+            # Dropping the total resets any float drift
+            del self.senders[sender]
+            del self.debits[sender]
+        entry = self.fee_entries.pop(txid, None)
+        if entry is None:
+            del self.arrival[txid]
+        else:
+            del self.fee_order[bisect.bisect_left(self.fee_order, entry)]
+        return tx
+
+    def _reset(self, txs: Iterable[Dict]):
+        self.txs, self.sizes, self.senders, self.debits, self.seqs = {}, {}, {}, {}, {}
+        self.arrival, self.fee_order, self.fee_entries, self.expiry = {}, [], {}, []
+        self.bytes = 0
+        self._seq = 0
+        now = time.time()
+        for tx in txs:
+            txid = tx_key(tx)
+            if txid not in self.txs:
+                self._insert(txid, tx, now)
+        self._expire(now)
+        self._make_room()
+
+    def _lowest(self) -> str:
+        """txid that is evicted first"""
+        if self.arrival:
+            return next(reversed(self.arrival))
+        return self.fee_order[-1][2]
+
+    def _make_room(self) -> int:
+        """Evict lowest-priority txs until the pool is within its bounds"""
+        evicted = 0
+        while self.txs and (len(self.txs) > self.max_txs or self.bytes > self.max_bytes):
+            self._discard(self._lowest())
+            evicted += 1
+        return evicted
+
+    def _expire(self, now: float) -> int:
+        """Drop txs whose TTL has passed; O(log n) per expired entry"""
+        expired = 0
+        expiry = self.expiry
+        while expiry and expiry[0][0] <= now:
+            _, seq, txid = heapq.heappop(expiry)
+            if self.seqs.get(txid) == seq:
+                self._discard(txid)
+                expired += 1
+        # Stale heap entries of removed txs are dropped once they dominate
+        if len(expiry) > 2 * len(self.txs) + 1024:
+            self.expiry = [entry for entry in expiry if self.seqs.get(entry[2]) == entry[1]]
+            heapq.heapify(self.expiry)
+        self.evictions["expired"] += expired
+        return expired
+
+    def expire(self) -> int:
+        """Drop expired txs now; returns how many were dropped"""
+        with self._lock:
+            self.refresh()
+            expired = self._expire(time.time())
+            if expired:
+                self._changed()
+            return expired
+
+    def _priority(self) -> Iterator[str]:
+        return chain((entry[2] for entry in self.fee_order), self.arrival)
+
+    def refresh(self):
+        """Pick up changes made elsewhere (nothing to do for in-memory state)"""
+
+    def _changed(self):
+        self.version += 1
+
+    def stamp(self):
+        """Token that changes whenever the pending set changes"""
+        return self.version
+
+    def get(self, txid: str) -> Optional[Dict]:
+        self.refresh()
+        return self.txs.get(txid)
+
+    def get_many(self, txids: Iterable[str]) -> List[Optional[Dict]]:
+        self.refresh()
+        return [self.txs.get(txid) for txid in txids]
+
+    def __contains__(self, txid: str) -> bool:
+        return self.get(txid) is not None
+
+    def __len__(self) -> int:
+        self.refresh()
+        return len(self.txs)
+
+    def all(self) -> List[Dict]:
+        with self._lock:
+            self.refresh()
+            return list(self.txs.values())
+
+    def by_sender(self, sender: str) -> List[Dict]:
+        """Pending transactions of one sender, in arrival order"""
+        with self._lock:
+            self.refresh()
+            return [self.txs[txid] for txid in self.senders.get(sender, ())]
+
+    def pending_debit(self, sender: str):
+        """Total amount plus fees of a sender's pending transactions"""
+        with self._lock:
+            self.refresh()
+            return self.debits.get(sender, 0)
+
+    def candidates(self, start: int = 0, count: Optional[int] = None) -> List[Tuple[Dict, int]]:
+        """(tx, size) pairs in template priority order"""
+        with self._lock:
+            self.refresh()
+            if start == 0 and self._expire(time.time()):
+                self._changed()
+            stop = None if count is None else start + count
+            return [(self.txs[txid], self.sizes[txid]) for txid in islice(self._priority(), start, stop)]
+
+    def select(self, max_txs: int, max_bytes: int, accept: Callable[[Dict], bool]) -> List[Dict]:
+        """Fill a block template in priority order; see fill_template"""
+        with self._lock:
+            self.refresh()
+            if self._expire(time.time()):
+                self._changed()
+            candidates = ((self.txs[txid], self.sizes[txid]) for txid in self._priority())
+            return fill_template(candidates, max_txs, max_bytes, accept)
+
+    def _admit(self, tx: Dict, now: float, balance=None) -> str:
+        """Insert one tx and enforce the bounds; returns added, duplicate, overspend, expired, future or full"""
+        txid = tx_key(tx)
+        if txid in self.txs:
+            return "duplicate"
+        if tx.get("txid") != txid:
+            # Stored and mined with the txid it really has
+            tx = dict(tx, txid=txid)
+        if balance is not None and self.debits.get(tx.get("from"), 0) + tx_debit(tx) > balance:
+            return "overspend"
+        if self.ttl is not None and self._expires_at(tx, now) <= now:
+            return "expired"
+        if self.max_future is not None and self._timestamp(tx, now) > now + self.max_future:
+            return "future"
+        self._insert(txid, tx, now)
+        evicted = self._make_room()
+        if txid not in self.txs:
+            # The newcomer itself had the lowest priority
+            self.evictions["full"] += evicted - 1
+            self.evictions["rejected"] += 1
+            return "full"
+        self.evictions["full"] += evicted
+        return "added"
+
+    def add(self, tx: Dict, balance=None) -> bool:
+        """Add a transaction; returns False if it is already pending.
+
+        With the sender's confirmed ``balance``, raises InsufficientFunds if
+        the tx plus the sender's pending debits would exceed it. Raises
+        MempoolFull if it ranks below everything in a full pool and
+        MempoolError if its timestamp is past the TTL or more than
+        ``max_future`` seconds ahead.
+        """
+        with self._lock:
+            self.refresh()
+            now = time.time()
+            changed = self._expire(now)
+            status = self._admit(tx, now, balance)
+            if changed or status in ("added", "full"):
+                self._changed()
+        if status == "overspend":
+            raise InsufficientFunds(f"Pending transactions of {tx.get('from')} exceed its balance")
+        if status == "full":
+            raise MempoolFull("Mempool is full")
+        if status == "expired":
+            raise MempoolError("Transaction has expired")
+        if status == "future":
+            raise MempoolError("Transaction timestamp is too far in the future")
+        return status == "added"
+
+    def add_many(self, txs: Iterable[Dict], balances: Optional[Dict[str, float]] = None) -> int:
+        """Add transactions, skipping pending, expired, future-dated and unfitting ones; returns how many were added.
+
+        With ``balances`` (sender -> confirmed balance), txs that would take
+        a sender's pending debits past its balance are skipped as well;
+        senders missing from it count as having nothing.
+        """
+        with self._lock:
+            self.refresh()
+            now = time.time()
+            changed = self._expire(now)
+            added = 0
+            for tx in txs:
+                balance = None if balances is None else balances.get(tx.get("from"), 0)
+                status = self._admit(tx, now, balance)
+                if status == "added":
+                    added += 1
+                elif status == "full":
+                    changed += 1
+            if added or changed:
+                self._changed()
+            return added
+
+    def stats(self) -> Dict:
+        """Size, bounds and eviction counters"""
+        with self._lock:
+            self.refresh()
+            return {
+                "size": len(self.txs),
+                "bytes": self.bytes,
+                "max_txs": self.max_txs,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "evicted_expired": self.evictions["expired"],
+                "evicted_full": self.evictions["full"],
+                "rejected_full": self.evictions["rejected"]
+            }
+
+    def remove(self, txids: Iterable[str]) -> int:
+        """Drop transactions (e.g. once confirmed); returns how many were removed"""
+        with self._lock:
+            self.refresh()
+            removed = sum(1 for txid in txids if self._discard(txid) is not None)
+            if removed:
+                self._changed()
+            return removed
+
+
+class Mempool(MempoolState):
+    """Pending transactions backed by mempool.json.
+
+    The file is only re-read when its mtime or size changes, so lookups
+    against an unchanged mempool are a dict access. Every change rewrites
+    the file, so this suits a single process; deployments with several
+    workers share one mempool daemon instead (see open_mempool).
+    """
+
+    def __init__(self, path: str = MEMPOOL_FILE, **limits):
+        super().__init__(**limits)
+        self.path = path
+        self._stamp = None
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def stamp(self):
+        return self._file_stamp()
+
+    def refresh(self):
+        """Reload the index if another process changed the file"""
+        with self._lock:
+            stamp = self._file_stamp()
+            if stamp == self._stamp:
+                return
+            txs = []
+            if stamp is not None:
+                try:
+                    with open(self.path, "r") as f:
+                        txs = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.error(f"Error loading mempool: {e}")
+                    return
+            self._reset(txs)
+            self._stamp = stamp
+
+    def _changed(self):
+        super()._changed()
+        with open(self.path, "w") as f:
+            json.dump(list(self.txs.values()), f, indent=2)
+        self._stamp = self._file_stamp()
+
+
+class MempoolClient:
+    """Client for the mempool daemon, with the same interface as Mempool.
+
+    Requests are newline-delimited JSON over the daemon's Unix socket, one
+    connection per thread.
+    """
+
+    def __init__(self, path: str = MEMPOOL_SOCKET):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            conn = sock.makefile("rwb")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _call(self, op: str, **args):
+        request = (json.dumps({"op": op, **args}) + "\n").encode()
+        for attempt in range(2):
+            try:
+                conn = self._connect()
+                conn.write(request)
+                conn.flush()
+                line = conn.readline()
+                if line:
+                    break
+            except OSError:
+                if attempt:
+                    raise
+            # The daemon restarted; reconnect once
+            self._local.conn = None
+        else:
+            raise MempoolError("Mempool daemon closed the connection")
+
+        response = json.loads(line)
+        if "error" in response:
+            for error in (MempoolFull, InsufficientFunds):
+                if response["error"].startswith(error.__name__ + ":"):
+                    raise error(response["error"])
+            raise MempoolError(response["error"])
+        return response["result"]
+
+    def stamp(self):
+        return self._call("stamp")
+
+    def get(self, txid: str) -> Optional[Dict]:
+        return self._call("get", txid=txid)
+
+    def get_many(self, txids: Iterable[str]) -> List[Optional[Dict]]:
+        return self._call("get_many", txids=list(txids))
+
+    def __contains__(self, txid: str) -> bool:
+        return self.get(txid) is not None
+
+    def __len__(self) -> int:
+        return self._call("len")
+
+    def all(self) -> List[Dict]:
+        return self._call("all")
+
+    def by_sender(self, sender: str) -> List[Dict]:
+        return self._call("by_sender", sender=sender)
+
+    def candidates(self, start: int = 0, count: Optional[int] = None) -> List[Tuple[Dict, int]]:
+        return [tuple(pair) for pair in self._call("candidates", start=start, count=count)]
+
+    def _iter_candidates(self) -> Iterator[Tuple[Dict, int]]:
+        start = 0
+        while True:
+            page = self.candidates(start, CANDIDATE_PAGE)
+            yield from page
+            if len(page) < CANDIDATE_PAGE:
+                return
+            start += len(page)
+
+    def select(self, max_txs: int, max_bytes: int, accept: Callable[[Dict], bool]) -> List[Dict]:
+        """Fill a block template, fetching candidates a page at a time"""
+        return fill_template(self._iter_candidates(), max_txs, max_bytes, accept)
+
+    def pending_debit(self, sender: str):
+        return self._call("pending_debit", sender=sender)
+
+    def add(self, tx: Dict, balance=None) -> bool:
+        return self._call("add", tx=tx, balance=balance)
+
+    def add_many(self, txs: Iterable[Dict], balances: Optional[Dict[str, float]] = None) -> int:
+        return self._call("add_many", txs=list(txs), balances=balances)
+
+    def remove(self, txids: Iterable[str]) -> int:
+        return self._call("remove", txids=list(txids))
+
+    def expire(self) -> int:
+        return self._call("expire")
+
+    def stats(self) -> Dict:
+        return self._call("stats")
+
+
+def open_mempool():
+    """The shared mempool daemon if MEMPOOL_SOCKET is set, else mempool.json"""
+    if MEMPOOL_SOCKET:
+        return MempoolClient(MEMPOOL_SOCKET)
+    return Mempool(MEMPOOL_FILE)
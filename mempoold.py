@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import signal
+import logging
+import threading
+import socketserver
+from mempool import MempoolState, MEMPOOL_FILE, MEMPOOL_SOCKET
+
+logger = logging.getLogger(__name__)
+
+# Seconds between snapshots of a changed mempool to disk
+SNAPSHOT_INTERVAL = float(os.environ.get("MEMPOOL_SNAPSHOT_INTERVAL", "5"))
+
+DEFAULT_SOCKET = "mempool.sock"
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.mempool
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                response = {"result": daemon.dispatch(request.pop("op"), request)}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode())
+            self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MempoolDaemon:
+    """Owns the node's mempool and serves it to API workers, P2P and miners.
+
+    State lives in memory (see MempoolState) and is written to the snapshot
+    file every SNAPSHOT_INTERVAL seconds when it changed, and on shutdown.
+    The snapshot is plain mempool.json, so the file backend can read it too.
+    Expired transactions are dropped on the same schedule.
+    """
+
+    OPS = ("stamp", "get", "get_many", "len", "all", "by_sender", "pending_debit", "candidates",
+           "add", "add_many", "remove", "expire", "stats")
+
+    def __init__(self, socket_path: str = MEMPOOL_SOCKET or DEFAULT_SOCKET,
+                 snapshot_path: str = MEMPOOL_FILE, interval: float = SNAPSHOT_INTERVAL):
+        self.socket_path = socket_path
+        self.snapshot_path = snapshot_path
+        self.interval = interval
+        self.state = MempoolState()
+        self.saved_version = 0
+        self._snapshot_lock = threading.Lock()
+        self.server = None
+        self.is_running = False
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, "r") as f:
+                self.state._reset(json.load(f))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading mempool snapshot: {e}")
+            return
+        logger.info(f"Loaded {len(self.state)} pending transactions from {self.snapshot_path}")
+
+    def snapshot(self):
+        """Write the mempool to disk if it changed since the last snapshot"""
+        with self._snapshot_lock:
+            with self.state._lock:
+                version = self.state.version
+                if version == self.saved_version:
+                    return
+                txs = self.state.all()
+            # Serialized outside the state lock so admission is not blocked
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                # dumps uses the C encoder; json.dump streams through the slow one
+                f.write(json.dumps(txs))
+            os.replace(tmp_path, self.snapshot_path)
+            self.saved_version = version
+
+    def _snapshot_loop(self):
+        while self.is_running:
+            time.sleep(self.interval)
+            try:
+                # Expiry also happens on admission; this catches an idle pool
+                self.state.expire()
+                self.snapshot()
+            except Exception as e:
+                logger.error(f"Error writing mempool snapshot: {e}")
+
+    def dispatch(self, op: str, args: dict):
+        if op not in self.OPS:
+            raise ValueError(f"Unknown op {op}")
+        if op == "len":
+            return len(self.state)
+        return getattr(self.state, op)(**args)
+
+    def start(self):
+        """Bind the socket and start serving in background threads"""
+        if os.path.exists(self.socket_path):
+            # Left behind by a previous run
+            os.unlink(self.socket_path)
+        self.server = _Server(self.socket_path, _Handler)
+        self.server.mempool = self
+        self.is_running = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._snapshot_loop, daemon=True).start()
+        logger.info(f"Mempool daemon listening on {self.socket_path}")
+
+    def stop(self):
+        self.is_running = False
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.snapshot()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="ShadowLedger mempool daemon")
+    parser.add_argument("--socket", default=MEMPOOL_SOCKET or DEFAULT_SOCKET, help="Unix socket path")
+    parser.add_argument("--snapshot", default=MEMPOOL_FILE, help="Snapshot file")
+    args = parser.parse_args()
+
+    # Snapshot on Ctrl-C and on docker stop alike
+    stopping = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+
+    daemon = MempoolDaemon(args.socket, args.snapshot)
+    daemon.start()
+    while not stopping.wait(1):
+        pass
+    daemon.stop()
@@ -0,0 +1,424 @@
+import os
+import glob
+import json
+import mmap
+import uuid
+import fcntl
+import socket
+import struct
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from storage import file_lock
+
+# Every process of the node (API workers, P2P node, miners) keeps its
+# samples in a file here; /metrics adds them up
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(os.environ.get("DATA_DIR", "data"), "metrics"))
+ENABLE_METRICS = os.environ.get("ENABLE_METRICS", "true").lower() != "false"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Request latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Bytes in use; entries follow as key length, key, padding to 8 bytes, value
+HEADER = struct.Struct("<Q")
+KEY_LEN = struct.Struct("<I")
+VALUE = struct.Struct("<d")
+INITIAL_SIZE = 1 << 16
+
+ARCHIVE_FILE = "archive.db"
+
+
+def _entry_size(key_len: int) -> int:
+    return (KEY_LEN.size + key_len + 7) // 8 * 8 + VALUE.size
+
+
+def _entries(data, used: int) -> Iterator[Tuple[str, float, int]]:
+    """(key, value, value offset) of each entry in a value file's bytes"""
+    pos = HEADER.size
+    while pos < used:
+        key_len = KEY_LEN.unpack_from(data, pos)[0]
+        key = bytes(data[pos + KEY_LEN.size:pos + KEY_LEN.size + key_len]).decode()
+        offset = pos + _entry_size(key_len) - VALUE.size
+        yield key, VALUE.unpack_from(data, offset)[0], offset
+        pos = offset + VALUE.size
+
+
+def read_samples(path: str) -> Dict[str, float]:
+    """Samples of a value file, read without locking"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    if len(data) < HEADER.size:
+        return {}
+    # The header is written after the entry it covers, so a file caught
+    # mid-append just reads without the new entry
+    used = min(HEADER.unpack_from(data, 0)[0], len(data))
+    return {key: value for key, value, _ in _entries(data, used)}
+
+
+class ValueFile:
+    """One process's samples in a memory-mapped file.
+
+    Only the owning process writes to it, so updates are a struct write
+    with no file lock; other processes read the whole file when collecting.
+    An owned file is flocked for as long as it is open, which is how
+    collectors tell it from the file of a process that has exited.
+    """
+
+    def __init__(self, path: str, owned: bool = False):
+        self.path = path
+        self.offsets: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if owned:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        size = os.fstat(self._fd).st_size
+        if size < INITIAL_SIZE:
+            os.ftruncate(self._fd, INITIAL_SIZE)
+            size = INITIAL_SIZE
+        self._map = mmap.mmap(self._fd, size)
+        self.used = HEADER.unpack_from(self._map, 0)[0] or HEADER.size
+        for key, _, offset in _entries(self._map, self.used):
+            self.offsets[key] = offset
+
+    def offset(self, key: str) -> int:
+        """Offset of key's value, appending a zero entry for a new key"""
+        with self._lock:
+            offset = self.offsets.get(key)
+            if offset is None:
+                raw = key.encode()
+                size = _entry_size(len(raw))
+                if self.used + size > len(self._map):
+                    self._grow(self.used + size)
+                KEY_LEN.pack_into(self._map, self.used, len(raw))
+                self._map[self.used + KEY_LEN.size:self.used + KEY_LEN.size + len(raw)] = raw
+                offset = self.used + size - VALUE.size
+                VALUE.pack_into(self._map, offset, 0.0)
+                self.used += size
+                HEADER.pack_into(self._map, 0, self.used)
+                self.offsets[key] = offset
+            return offset
+
+    def _grow(self, needed: int):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        os.ftruncate(self._fd, size)
+        self._map.close()
+        self._map = mmap.mmap(self._fd, size)
+
+    def add(self, offset: int, amount: float):
+        with self._lock:
+            VALUE.pack_into(self._map, offset, VALUE.unpack_from(self._map, offset)[0] + amount)
+
+    def set(self, offset: int, value: float):
+        with self._lock:
+            VALUE.pack_into(self._map, offset, value)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+_metrics: List["Metric"] = []
+# Sample names of gauges, whose values die with their process
+_gauge_samples = set()
+_values: Optional[ValueFile] = None
+_values_pid = None
+_values_lock = threading.Lock()
+
+
+def _dir_lock():
+    return file_lock(os.path.join(METRICS_DIR, ".lock"))
+
+
+def _alive(path: str) -> bool:
+    """True while the process that owns a value file still holds it open.
+
+    Pids say nothing here: containers sharing METRICS_DIR all have a pid 1.
+    The owner's flock is released by the kernel however the process ends.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        # Closing our own descriptor drops our lock, never the owner's
+        os.close(fd)
+    return False
+
+
+def _archive(paths: Sequence[str]):
+    """Fold the counters and histograms of exited processes into the archive file.
+
+    Keeps a node that recycles workers (gunicorn --max-requests) from
+    piling up files, without its counters going backwards. Call with the
+    directory lock held.
+    """
+    archive = ValueFile(os.path.join(METRICS_DIR, ARCHIVE_FILE))
+    try:
+        for path in paths:
+            for key, value in read_samples(path).items():
+                if json.loads(key)[0] not in _gauge_samples:
+                    archive.add(archive.offset(key), value)
+            os.unlink(path)
+    finally:
+        archive.close()
+
+
+def _process_values() -> ValueFile:
+    global _values, _values_pid
+    values = _values
+    if values is not None and _values_pid == os.getpid():
+        return values
+    with _values_lock:
+        # Forked children (gunicorn workers) get a file of their own
+        if _values is None or _values_pid != os.getpid():
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            # Unique across containers that share the directory, which may
+            # run processes with the same pid
+            name = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:12]}.metrics"
+            # Locked before a collector can see it unlocked and archive it
+            with _dir_lock():
+                _values = ValueFile(os.path.join(METRICS_DIR, name), owned=True)
+            _values_pid = os.getpid()
+        return _values
+
+
+def _after_fork():
+    # Drop the parent's value file in the child: the inherited descriptor
+    # would keep the parent's file locked, and so counted as live, after
+    # the parent exits
+    global _values, _values_lock
+    if _values is not None:
+        _values.close()
+        _values = None
+    _values_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def collect() -> Dict[str, float]:
+    """Samples summed over processes: counters and histograms over every
+    process since the directory was created, gauges over live ones"""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    totals: Dict[str, float] = {}
+    with _dir_lock():
+        paths = glob.glob(os.path.join(METRICS_DIR, "*.metrics"))
+        dead = [path for path in paths if not _alive(path)]
+        if dead:
+            _archive(dead)
+        for path in set(paths) - set(dead) | {os.path.join(METRICS_DIR, ARCHIVE_FILE)}:
+            for key, value in read_samples(path).items():
+                totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def _sample_key(name: str, labels: Sequence[Tuple[str, str]]) -> str:
+    return json.dumps([name, [list(pair) for pair in labels]])
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+class _Value:
+    """A single sample, in this process's value file or, if not shared, in memory"""
+
+    def __init__(self, key: str, shared: bool):
+        self.key = key
+        self.shared = shared
+        self.value = 0.0
+        self._file = None
+        self._offset = None
+
+    def _slot(self) -> Tuple[ValueFile, int]:
+        values = _process_values()
+        if self._file is not values:
+            self._offset = values.offset(self.key)
+            self._file = values
+        return values, self._offset
+
+    def inc(self, amount: float = 1.0):
+        if not ENABLE_METRICS:
+            return
+        if self.shared:
+            values, offset = self._slot()
+            values.add(offset, amount)
+        else:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        if not ENABLE_METRICS:
+            return
+        if self.shared:
+            values, offset = self._slot()
+            values.set(offset, value)
+        else:
+            self.value = value
+
+
+class Metric:
+    """Base class for metrics: a name, help text and label names.
+
+    ``labels(*values)`` returns the child for one combination of label
+    values; metrics without labels are updated directly.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), shared: bool = True):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.shared = shared
+        self._children: Dict[Tuple[str, ...], object] = {}
+        _metrics.append(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children.setdefault(values, self._child(tuple(zip(self.labelnames, values))))
+        return child
+
+    def _child(self, labels):
+        return _Value(_sample_key(self.name, labels), self.shared)
+
+    def render(self, samples: Dict[str, List]) -> List[str]:
+        if self.shared:
+            found = samples.get(self.name, [])
+        else:
+            found = [(tuple(zip(self.labelnames, values)), child.value)
+                     for values, child in self._children.items()]
+        return [f"{self.name}{_format_labels(labels)} {_format_value(value)}" for labels, value in sorted(found)]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """Gauge; shared ones add up the values of live processes, others
+    are only reported by the process that set them"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), shared: bool = True):
+        super().__init__(name, documentation, labelnames, shared)
+        _gauge_samples.add(name)
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramChild:
+    def __init__(self, name: str, labels, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.bucket_values = [_Value(_sample_key(name + "_bucket", labels + (("le", _format_value(bound)),)), True)
+                              for bound in buckets]
+        self.sum = _Value(_sample_key(name + "_sum", labels), True)
+
+    def observe(self, value: float):
+        # Buckets are stored per bucket; render() makes them cumulative
+        self.bucket_values[bisect_left(self.buckets, value)].inc()
+        self.sum.inc(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def _child(self, labels):
+        return _HistogramChild(self.name, labels, self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def render(self, samples: Dict[str, List]) -> List[str]:
+        series: Dict[Tuple, Dict] = {}
+        for labels, value in samples.get(self.name + "_bucket", []):
+            series.setdefault(labels[:-1], {})[labels[-1][1]] = value
+        sums = dict(samples.get(self.name + "_sum", []))
+        lines = []
+        for labels in sorted(series):
+            count = 0.0
+            for bound in self.buckets:
+                le = _format_value(bound)
+                count += series[labels].get(le, 0.0)
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', le),))} {_format_value(count)}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(sums.get(labels, 0.0))}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {_format_value(count)}")
+        return lines
+
+
+def generate_latest() -> bytes:
+    """All metrics in the Prometheus text format; reads every process's file"""
+    samples: Dict[str, List] = {}
+    for key, value in collect().items():
+        name, labels = json.loads(key)
+        samples.setdefault(name, []).append((tuple(tuple(pair) for pair in labels), value))
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render(samples))
+    return ("\n".join(lines) + "\n").encode()
+
+
+# The node's metrics, defined here so that every process knows all of them
+
+HTTP_REQUESTS = Counter("shadowledger_http_requests_total", "API requests by route and status",
+                        ("method", "route", "status"))
+HTTP_LATENCY = Histogram("shadowledger_http_request_duration_seconds", "API request latency by route",
+                         ("method", "route"))
+HTTP_IN_FLIGHT = Gauge("shadowledger_http_requests_in_flight", "API requests being handled")
+HTTP_RATE_LIMITED = Counter("shadowledger_http_rate_limited_total", "API requests refused by the rate limiter")
+OFFLOAD_IN_FLIGHT = Gauge("shadowledger_offload_in_flight", "Blocking jobs handed to an offload pool, queued or running",
+                          ("pool",))
+CHAIN_HEIGHT = Gauge("shadowledger_chain_height", "Blocks in the chain", shared=False)
+MEMPOOL_SIZE = Gauge("shadowledger_mempool_transactions", "Pending transactions", shared=False)
+MEMPOOL_BYTES = Gauge("shadowledger_mempool_bytes", "Encoded size of pending transactions", shared=False)
+P2P_PEERS = Gauge("shadowledger_p2p_peers", "Connected P2P peers")
+P2P_MESSAGES = Counter("shadowledger_p2p_messages_total", "P2P messages by direction and type",
+                       ("direction", "type"))
+MINER_HASHRATE = Gauge("shadowledger_miner_hashrate", "Hashes per second over all mining workers")
+MINER_BLOCKS = Counter("shadowledger_miner_blocks_total", "Blocks mined by this node")
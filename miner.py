@@ -2,174 +2,280 @@ import time
 import json
 import os
 import logging
+import queue
 import threading
-from typing import Optional, List, Dict
-from block import Block, load_chain, save_block, DIFFICULTY, REWARD
-from p2p import send_to_peer, PEERS
+import multiprocessing
+from typing import Optional, List, Dict, Tuple
+from block import (Block, get_store, save_block, select_transactions, search_nonces,
+                   DIFFICULTY, REWARD, BLOCK_VERSION, MAX_NONCE)
+from mempool import open_mempool, tx_key
+from p2p import send_to_peer, pack_message, PEERS
+from metrics import MINER_HASHRATE, MINER_BLOCKS
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('miner.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Nonces tried between checks for a new tip (a few milliseconds of hashing)
+NONCE_BATCH = 10000
+
+# Minimum template age before new mempool transactions trigger a rebuild
+TEMPLATE_REFRESH = float(os.getenv("TEMPLATE_REFRESH", "1.0"))
+
+def _mining_worker(worker_id: int, jobs, results, stop, hashes):
+    """Hash the nonce ranges handed to this worker until told to exit"""
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        prefix, difficulty, start, end = job
+        found = None
+        nonce = start
+        while nonce < end and not stop.is_set():
+            batch_end = min(nonce + NONCE_BATCH, end)
+            found = search_nonces(prefix, difficulty, nonce, batch_end)
+            hashes[worker_id] += (found[0] + 1 if found else batch_end) - nonce
+            if found:
+                # First winner stops everyone else
+                stop.set()
+                break
+            nonce = batch_end
+        results.put((worker_id, found))
+
+class MiningPoolError(RuntimeError):
+    """A mining worker process exited in the middle of a search"""
+
+
+class MiningPool:
+    """Worker processes that split the nonce space of one block header"""
+    
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.results = multiprocessing.Queue()
+        self.stop = multiprocessing.Event()
+        # Hashes done by each worker on the current header, written only by that worker
+        self.hashes = multiprocessing.Array('Q', workers, lock=False)
+        self.started = None
+        self.jobs = []
+        self.processes = []
+        for worker_id in range(workers):
+            jobs = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_mining_worker,
+                args=(worker_id, jobs, self.results, self.stop, self.hashes),
+                daemon=True
+            )
+            process.start()
+            self.jobs.append(jobs)
+            self.processes.append(process)
+    
+    def search(self, prefix: bytes, difficulty: int, keep_going,
+               start: int = 0, end: int = MAX_NONCE) -> Optional[Tuple[int, str]]:
+        """Search nonces in [start, end); returns (nonce, hash) or None if stopped or exhausted.
+
+        Raises MiningPoolError if a worker dies (killed, out of memory)
+        before reporting, since its share of the range would never finish.
+        """
+        self.stop.clear()
+        for worker_id in range(self.workers):
+            self.hashes[worker_id] = 0
+        self.started = time.time()
+        
+        span = -(-(end - start) // self.workers)
+        for worker_id, jobs in enumerate(self.jobs):
+            jobs.put((prefix, difficulty, start + worker_id * span, min(start + (worker_id + 1) * span, end)))
+        
+        # Every worker reports once per search, so no stale result leaks into the next one
+        found = None
+        pending = self.workers
+        while pending:
+            try:
+                _, result = self.results.get(timeout=0.005)
+            except queue.Empty:
+                if not keep_going():
+                    self.stop.set()
+                dead = [process for process in self.processes if not process.is_alive()]
+                if dead:
+                    self.stop.set()
+                    raise MiningPoolError(", ".join(
+                        f"worker pid {process.pid} exited with code {process.exitcode}" for process in dead))
+                continue
+            pending -= 1
+            if result and found is None:
+                found = result
+        return found
+    
+    def hashrates(self) -> List[float]:
+        """Per-worker hashrate on the current (or last) header"""
+        elapsed = time.time() - self.started if self.started else 0
+        return [hashes / elapsed if elapsed > 0 else 0 for hashes in self.hashes]
+    
+    def close(self):
+        self.stop.set()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
 class Miner:
-    def __init__(self, address: str, peers: List[str] = None):
+    def __init__(self, address: str, peers: List[str] = None, workers: int = 1):
         self.address = address
         self.peers = peers or []
         self.is_mining = False
         self.current_block = None
+        self.workers = workers
+        self.pool = None
+        self.mempool = open_mempool()
         self.stats = {
             'blocks_mined': 0,
             'total_hashrate': 0,
+            'worker_hashrates': [],
+            # Seconds spent hashing on a tip that had already been replaced
+            'stale_work_time': 0.0,
+            'stale_templates': 0,
+            'template_rebuilds': 0,
             'start_time': time.time()
         }
         
     def load_mempool(self) -> List[Dict]:
         """Load transactions from mempool"""
-        if not os.path.exists("mempool.json"):
-            return []
         try:
-            with open("mempool.json", "r") as f:
-                return json.load(f)
+            return self.mempool.all()
         except Exception as e:
             logger.error(f"Error loading mempool: {e}")
             return []
     
-    def clear_mempool(self):
-        """Clear the mempool after successful mining"""
+    def clear_mempool(self, txs: List[Dict]):
+        """Drop the transactions of a mined block from the mempool"""
         try:
-            with open("mempool.json", "w") as f:
-                json.dump([], f)
-            logger.info("Mempool cleared")
+            removed = self.mempool.remove(tx_key(tx) for tx in txs)
+            logger.info(f"Removed {removed} confirmed transactions from mempool")
         except Exception as e:
             logger.error(f"Error clearing mempool: {e}")
     
     def validate_transactions(self, txs: List[Dict]) -> List[Dict]:
         """Validate transactions before including in block"""
-        chain = load_chain()
-        valid_txs = []
+        return select_transactions(txs)
+    
+    def build_template(self) -> Block:
+        """Snapshot the tip and mempool into a block ready for hashing"""
+        store = get_store()
+        # Stamps are taken before reading, so a change during the read is still noticed
+        self._tip_stamp = store.stamp()
+        self._mempool_stamp = self.mempool.stamp()
         
-        # Track balances for validation
-        balances = {}
+        # Highest fee rate first, capped at the block size limits
+        valid_txs = select_transactions(self.mempool)
+        logger.info(f"Loaded {len(valid_txs)} valid transactions from mempool")
         
-        for tx in txs:
-            try:
-                # Basic validation
-                if not all(k in tx for k in ['from', 'to', 'amount', 'signature']):
-                    continue
-                    
-                # Check if transaction already exists in blockchain
-                tx_hash = self._calculate_tx_hash(tx)
-                if self._tx_exists_in_chain(chain, tx_hash):
-                    continue
-                
-                # Check sender balance
-                sender = tx['from']
-                if sender not in balances:
-                    balances[sender] = self._calculate_balance(chain, sender)
-                
-                if balances[sender] >= tx['amount']:
-                    valid_txs.append(tx)
-                    balances[sender] -= tx['amount']
-                    
-            except Exception as e:
-                logger.warning(f"Invalid transaction: {e}")
-                continue
-                
-        return valid_txs
-    
-    def _calculate_tx_hash(self, tx: Dict) -> str:
-        """Calculate transaction hash"""
-        import hashlib
-        tx_copy = dict(tx)
-        tx_copy.pop('signature', None)
-        return hashlib.sha256(json.dumps(tx_copy, sort_keys=True).encode()).hexdigest()
-    
-    def _tx_exists_in_chain(self, chain: List[Dict], tx_hash: str) -> bool:
-        """Check if transaction already exists in blockchain"""
-        for block in chain:
-            for tx in block.get('txs', []):
-                if self._calculate_tx_hash(tx) == tx_hash:
-                    return True
-        return False
-    
-    def _calculate_balance(self, chain: List[Dict], address: str) -> int:
-        """Calculate balance for an address"""
-        balance = 0
-        for block in chain:
-            if block["address"] == address:
-                balance += block["reward"]
-            for tx in block.get("txs", []):
-                if tx["from"] == address:
-                    balance -= tx["amount"]
-                if tx["to"] == address:
-                    balance += tx["amount"]
-        return balance
-    
-    def mine_block(self) -> Optional[Block]:
-        """Mine a new block"""
-        logger.info("Starting block mining...")
+        tip = store.tip()
+        index = tip["index"] + 1 if tip else 0
+        previous_hash = tip["hash"] if tip else "0" * 64
         
-        # Load and validate transactions
-        txs = self.load_mempool()
-        valid_txs = self.validate_transactions(txs)
+        self._template_time = self._last_check = time.time()
+        self._stale_reason = None
+        # The header is fixed for the whole search, only the nonce changes
+        return Block(index, self._template_time, previous_hash, 0, REWARD, self.address, valid_txs,
+                     version=BLOCK_VERSION)
+    
+    def work_is_current(self) -> bool:
+        """Cheap check, run between nonce batches, that the template is still worth hashing"""
+        if not self.is_mining:
+            return False
+        now = time.time()
         
-        logger.info(f"Loaded {len(valid_txs)} valid transactions from mempool")
+        stamp = get_store().stamp()
+        if stamp != self._tip_stamp:
+            tip = get_store().tip()
+            if (tip["hash"] if tip else "0" * 64) != self.current_block.previous_hash:
+                # The tip moved at some point since the previous check
+                self.stats['stale_work_time'] += now - self._last_check
+                self.stats['stale_templates'] += 1
+                self._stale_reason = "tip"
+                return False
+            self._tip_stamp = stamp
         
-        # Get blockchain info
-        chain = load_chain()
-        index = len(chain)
-        previous_hash = chain[-1]["hash"] if chain else "0" * 64
+        if (now - self._template_time >= TEMPLATE_REFRESH
+                and self.mempool.stamp() != self._mempool_stamp):
+            self.stats['template_rebuilds'] += 1
+            self._stale_reason = "mempool"
+            return False
         
-        # Start mining
+        self._last_check = now
+        return True
+    
+    def _search(self, block: Block) -> bool:
+        """Hash the template in this process, checking for new work between batches"""
         nonce = 0
-        timestamp = time.time()
         start_time = time.time()
-        hashes_per_second = 0
+        while self.work_is_current():
+            if block.mine(DIFFICULTY, nonce, nonce + NONCE_BATCH):
+                mining_time = time.time() - start_time
+                self.stats['total_hashrate'] = (block.nonce + 1) / mining_time if mining_time > 0 else 0
+                MINER_HASHRATE.set(self.stats['total_hashrate'])
+                return True
+            
+            nonce += NONCE_BATCH
+            self.stats['total_hashrate'] = nonce / (time.time() - start_time)
+            MINER_HASHRATE.set(self.stats['total_hashrate'])
+            logger.debug(f"Nonce: {nonce}, Hashrate: {self.stats['total_hashrate']:.2f} H/s")
+        return False
+    
+    def _search_parallel(self, block: Block) -> bool:
+        """Split the nonce space of the block header across the worker pool"""
+        if self.pool is None:
+            self.pool = MiningPool(self.workers)
         
-        logger.info(f"Mining block #{index} with difficulty {DIFFICULTY}")
+        try:
+            found = self.pool.search(block.header_prefix(), DIFFICULTY, self.work_is_current)
+        except MiningPoolError as e:
+            # Start over with fresh workers on a fresh template
+            logger.error(f"Mining pool failed ({e}), restarting it")
+            self.pool.close()
+            self.pool = None
+            return False
+        worker_hashrates = self.pool.hashrates()
+        self.stats['worker_hashrates'] = worker_hashrates
+        self.stats['total_hashrate'] = sum(worker_hashrates)
+        MINER_HASHRATE.set(self.stats['total_hashrate'])
+        
+        if found is None:
+            return False
+        block.nonce, block.hash = found
+        return True
+    
+    def mine_block(self) -> Optional[Block]:
+        """Mine a new block, rebuilding the template when the tip or mempool changes"""
+        logger.info("Starting block mining...")
         
         while self.is_mining:
-            block = Block(index, timestamp, previous_hash, nonce, REWARD, self.address, valid_txs)
+            block = self.current_block = self.build_template()
+            logger.info(f"Mining block #{block.index} with difficulty {DIFFICULTY}")
             
-            if block.hash.startswith("0" * DIFFICULTY):
-                mining_time = time.time() - start_time
-                hashes_per_second = nonce / mining_time if mining_time > 0 else 0
-                
-                logger.info(f"✅ Block #{index} mined successfully!")
+            search = self._search_parallel if self.workers > 1 else self._search
+            if search(block):
+                logger.info(f"✅ Block #{block.index} mined successfully!")
                 logger.info(f"Hash: {block.hash}")
-                logger.info(f"Nonce: {nonce}")
-                logger.info(f"Mining time: {mining_time:.2f}s")
-                logger.info(f"Hashrate: {hashes_per_second:.2f} H/s")
+                logger.info(f"Nonce: {block.nonce}")
+                logger.info(f"Mining time: {time.time() - self._template_time:.2f}s")
+                logger.info(f"Hashrate: {self.stats['total_hashrate']:.2f} H/s")
                 
                 # Update stats
                 self.stats['blocks_mined'] += 1
-                self.stats['total_hashrate'] = hashes_per_second
-                
+                MINER_BLOCKS.inc()
                 return block
             
-            nonce += 1
-            
-            # Log progress every 10000 hashes
-            if nonce % 10000 == 0:
-                hashes_per_second = nonce / (time.time() - start_time)
-                logger.debug(f"Nonce: {nonce}, Hashrate: {hashes_per_second:.2f} H/s")
+            if self._stale_reason == "tip":
+                logger.info(f"Chain tip changed, abandoning block #{block.index}")
+            elif self._stale_reason == "mempool":
+                logger.info("Mempool changed, rebuilding block template")
         
         logger.info("Mining stopped")
         return None
     
     def broadcast_block(self, block: Block):
         """Broadcast new block to peers"""
-        message = {
-            "type": "new_block",
-            "data": block.to_dict()
-        }
+        message = pack_message("new_block", block.to_dict())
         
         for peer in self.peers:
             try:
@@ -178,6 +284,37 @@ class Miner:
             except Exception as e:
                 logger.error(f"Failed to broadcast to {peer}: {e}")
     
+    def submit_block(self, block: Block, broadcast: bool = True) -> bool:
+        """Save, announce and broadcast a solved block unless the tip has moved on.
+
+        With ``broadcast=False`` the caller sends it to peers itself, e.g.
+        after releasing a lock that should not be held over the network.
+        """
+        # A peer's block may have landed since the last check
+        tip = get_store().tip()
+        if (tip["hash"] if tip else "0" * 64) != block.previous_hash:
+            logger.info(f"Block #{block.index} is stale, discarding it")
+            self.stats['stale_templates'] += 1
+            return False
+        
+        # Save block locally; a peer's block can still win the race
+        try:
+            save_block(block)
+        except ValueError as e:
+            logger.info(f"{e}, discarding it")
+            self.stats['stale_templates'] += 1
+            return False
+        
+        # Clear mempool
+        self.clear_mempool(block.txs)
+        
+        # Broadcast to peers
+        if broadcast:
+            self.broadcast_block(block)
+        
+        logger.info(f"Block #{block.index} successfully mined")
+        return True
+    
     def start_mining(self):
         """Start continuous mining"""
         self.is_mining = True
@@ -192,20 +329,15 @@ class Miner:
                 block = self.mine_block()
                 
                 if block and self.is_mining:
-                    # Save block locally
-                    save_block(block)
-                    
-                    # Clear mempool
-                    self.clear_mempool()
-                    
-                    # Broadcast to peers
-                    self.broadcast_block(block)
-                    
-                    logger.info(f"Block #{block.index} successfully mined and broadcasted")
+                    self.submit_block(block)
                     
             except Exception as e:
                 logger.error(f"Error during mining: {e}")
                 time.sleep(5)  # Wait before retrying
+        
+        if self.pool:
+            self.pool.close()
+            self.pool = None
     
     def stop_mining(self):
         """Stop mining"""
@@ -234,16 +366,22 @@ class Miner:
     def get_stats(self) -> Dict:
         """Get mining statistics"""
         uptime = time.time() - self.stats['start_time']
+        stats = dict(self.stats)
+        if self.pool and self.is_mining:
+            # Live rates for the header currently being searched
+            stats['worker_hashrates'] = self.pool.hashrates()
+            stats['total_hashrate'] = sum(stats['worker_hashrates'])
         return {
-            **self.stats,
+            **stats,
+            'workers': self.workers,
             'uptime': uptime,
             'address': self.address,
             'is_mining': self.is_mining
         }
 
-def run_miner(address: str, peers: List[str] = None):
+def run_miner(address: str, peers: List[str] = None, workers: int = 1):
     """Run the miner as a standalone service"""
-    miner = Miner(address, peers)
+    miner = Miner(address, peers, workers)
     
     try:
         miner.start_mining()
@@ -257,10 +395,37 @@ def run_miner(address: str, peers: List[str] = None):
 if __name__ == "__main__":
     import argparse
     
+    # Configured here rather than on import, so that importing the miner
+    # (work server, tests) does not create miner.log in the working directory
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('miner.log'),
+            logging.StreamHandler()
+        ],
+        force=True
+    )
+    
     parser = argparse.ArgumentParser(description="ShadowLedger Miner")
-    parser.add_argument("--address", required=True, help="Miner address")
+    parser.add_argument("--address", help="Miner address")
     parser.add_argument("--peers", nargs="*", default=[], help="List of peer IPs")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Mining processes; each searches its own slice of the nonce space")
+    parser.add_argument("--pool", metavar="HOST:PORT",
+                        help="Hash work from a work server instead of building blocks locally")
     
     args = parser.parse_args()
     
-    run_miner(args.address, args.peers) 
\ No newline at end of file
+    if args.pool:
+        from workserver import WorkClient, WORK_PORT
+        host, _, port = args.pool.partition(":")
+        client = WorkClient(host, int(port or WORK_PORT), args.workers)
+        try:
+            client.run()
+        except KeyboardInterrupt:
+            client.stop()
+    elif args.address:
+        run_miner(args.address, args.peers, args.workers)
+    else:
+        parser.error("--address is required unless --pool is given") 
\ No newline at end of file
@@ -0,0 +1,103 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from functools import partial
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+from block import load_chain, get_balances
+from metrics import OFFLOAD_IN_FLIGHT
+
+logger = logging.getLogger(__name__)
+
+# Threads for quick blocking calls: indexed lookups, mempool calls, writes
+STORAGE_IO_THREADS = int(os.environ.get("STORAGE_IO_THREADS", "8"))
+
+# Processes for whole-chain reads and aggregates. Parsing and serializing a
+# large chain holds the GIL, so on a thread it would still stall the event
+# loop; a separate process returning bytes or a small summary does not.
+STORAGE_SCAN_PROCESSES = int(os.environ.get("STORAGE_SCAN_PROCESSES", "2"))
+
+
+class Offloader:
+    """Runs blocking calls from async handlers on a bounded executor.
+
+    ``await pool.run(func, *args)`` keeps the event loop free while the
+    call runs. ``in_flight`` counts jobs handed over and not yet finished,
+    queued ones included. The executor is created on first use in each
+    process, so pools built at import survive gunicorn forking workers.
+    Process pools need module-level functions and picklable arguments.
+    """
+
+    def __init__(self, name: str, workers: int, processes: bool = False):
+        self.name = name
+        self.workers = workers
+        self.processes = processes
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self._executor: Optional[Executor] = None
+        self._pid = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None or self._pid != os.getpid():
+            if self.processes:
+                # Spawned, not forked: the API process runs threads, and a
+                # forked child could inherit a lock one of them held
+                self._executor = ProcessPoolExecutor(self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=os.nice, initargs=(10,))
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix=self.name)
+            self._pid = os.getpid()
+        return self._executor
+
+    async def run(self, func: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # Only touched from the event loop thread
+        self.in_flight += 1
+        gauge = OFFLOAD_IN_FLIGHT.labels(self.name)
+        gauge.inc()
+        try:
+            return await loop.run_in_executor(self._get_executor(), partial(func, *args, **kwargs))
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            gauge.dec()
+            self.completed += 1
+
+    def stats(self) -> Dict:
+        return {
+            "workers": self.workers,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed
+        }
+
+
+io_pool = Offloader("storage-io", STORAGE_IO_THREADS)
+scan_pool = Offloader("storage-scan", STORAGE_SCAN_PROCESSES, processes=True)
+
+
+def offload_stats() -> Dict:
+    return {"io": io_pool.stats(), "scan": scan_pool.stats()}
+
+
+# Jobs for scan_pool. They live here rather than in api.py so that a
+# spawned worker can import them without starting another API.
+
+def chain_summary() -> Dict:
+    """Chain statistics for /status"""
+    chain = load_chain()
+    return {
+        "length": len(chain),
+        "total_transactions": sum(len(block.get('txs', [])) for block in chain),
+        "total_rewards": sum(block.get('reward', 0) for block in chain),
+        "last_block_hash": chain[-1]["hash"] if chain else None
+    }
+
+
+def balances(addresses) -> Dict:
+    return get_balances(addresses)
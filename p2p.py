@@ -3,9 +3,14 @@ import threading
 import json
 import time
 import os
+import base64
 import logging
 from typing import Set, List, Dict, Optional
-from block import load_chain, save_block
+from block import Block, get_store, load_chain, save_block, get_balance, get_balances, get_known_txids, DIFFICULTY
+from mempool import open_mempool, tx_key, InsufficientFunds
+from verify import verify_tx, verify_transactions, verified, mark_verified
+from codec import encode_block, decode_block, encode_tx, decode_tx, encode_blocks, decode_blocks
+from metrics import P2P_PEERS, P2P_MESSAGES
 
 # Configure logging
 logging.basicConfig(
@@ -21,7 +26,25 @@ logger = logging.getLogger(__name__)
 PEER_PORT = 8888
 PEERS: Set[str] = set()
 BLOCKCHAIN_FILE = "blockchain.json"
-MEMPOOL_FILE = "mempool.json"
+
+# Payload encoding for outgoing blocks and transactions: "json" works with
+# every peer, "binary" sends the compact codec (base64 in the JSON envelope)
+P2P_ENCODING = os.environ.get("P2P_ENCODING", "json")
+
+# Message types whose payload may be codec-encoded, with (encoder, decoder)
+BINARY_PAYLOADS = {
+    "new_block": (encode_block, decode_block),
+    "new_tx": (encode_tx, decode_tx),
+    "chain": (encode_blocks, decode_blocks),
+}
+
+# Blocks below this height predate signed txs (no "pubkey"/"scan_pubkey"
+# fields) and are accepted without signature checks; raise it to the
+# height where a network's existing chain ends before enabling checks
+SIGNED_TXS_HEIGHT = int(os.environ.get("SIGNED_TXS_HEIGHT", "0"))
+
+# Message types counted by name in metrics; anything else is "unknown"
+MESSAGE_TYPES = ("get_chain", "get_mempool", "new_block", "new_tx", "ping", "get_peers", "sync_request")
 
 # Bootstrap nodes - these should be known, stable nodes
 BOOTSTRAP_NODES = [
@@ -29,6 +52,26 @@ BOOTSTRAP_NODES = [
     # Add production bootstrap nodes here
 ]
 
+def pack_message(msg_type: str, data, encoding: Optional[str] = None) -> Dict:
+    """Build a message, codec-encoding the payload when binary encoding is used"""
+    encoding = encoding or P2P_ENCODING
+    if encoding == "binary" and msg_type in BINARY_PAYLOADS:
+        encoder = BINARY_PAYLOADS[msg_type][0]
+        return {
+            "type": msg_type,
+            "encoding": "binary",
+            "data": base64.b64encode(encoder(data)).decode()
+        }
+    return {"type": msg_type, "data": data}
+
+def unpack_message(message: Dict) -> Dict:
+    """Decode a codec-encoded payload back into plain dicts"""
+    if message.get("encoding") == "binary" and message.get("type") in BINARY_PAYLOADS:
+        decoder = BINARY_PAYLOADS[message["type"]][1]
+        message = dict(message, data=decoder(base64.b64decode(message["data"])))
+        message.pop("encoding")
+    return message
+
 class P2PNode:
     def __init__(self, port: int = PEER_PORT, bootstrap_nodes: List[str] = None):
         self.port = port
@@ -36,6 +79,8 @@ class P2PNode:
         self.peers = set()
         self.is_running = False
         self.server_socket = None
+        # Shared with the API and miner through the mempool daemon when configured
+        self.mempool = open_mempool()
         
     def start(self):
         """Start the P2P node"""
@@ -94,6 +139,7 @@ class P2PNode:
         try:
             # Add to peers list
             self.peers.add(addr)
+            P2P_PEERS.set(len(self.peers))
             
             while self.is_running:
                 data = conn.recv(8192)
@@ -117,21 +163,24 @@ class P2PNode:
         finally:
             conn.close()
             self.peers.discard(addr)
+            P2P_PEERS.set(len(self.peers))
             logger.info(f"Peer {addr} disconnected")
             
     def _process_message(self, message: Dict, addr: str) -> Optional[Dict]:
         """Process incoming P2P message"""
+        message = unpack_message(message)
         msg_type = message.get('type')
+        P2P_MESSAGES.labels("in", msg_type if msg_type in MESSAGE_TYPES else "unknown").inc()
         
         logger.info(f"Processing {msg_type} from {addr}")
         
         if msg_type == "get_chain":
             chain = load_chain()
-            return {"type": "chain", "data": chain}
+            # Peers opt in to a binary reply by sending "encoding": "binary"
+            return pack_message("chain", chain, message.get("encoding", "json"))
             
         elif msg_type == "get_mempool":
-            mempool = self._load_mempool()
-            return {"type": "mempool", "data": mempool}
+            return {"type": "mempool", "data": self.mempool.all()}
             
         elif msg_type == "new_block":
             return self._handle_new_block(message["data"])
@@ -155,27 +204,36 @@ class P2PNode:
     def _handle_new_block(self, block_data: Dict) -> Dict:
         """Handle new block from peer"""
         try:
+            # Check if we already have this block (before validation, which
+            # would reject its txs as already confirmed). Only the block at
+            # that height and the tip are read, never the whole chain.
+            store = get_store()
+            height = store.height()
+            index = block_data['index']
+            existing_block = store.get_block(index) if 0 <= index < height else None
+            if existing_block and existing_block['hash'] == block_data['hash']:
+                return {"type": "ok", "message": "Block already exists"}
+                    
+            # Only a block on top of our tip can be appended
+            tip = store.tip()
+            if index != height or block_data['previous_hash'] != (tip['hash'] if tip else "0" * 64):
+                logger.warning(f"Received block #{block_data['index']} that does not extend our tip")
+                return {"type": "error", "message": "Block does not extend the tip"}
+                
             # Validate block
             if not self._validate_block(block_data):
                 logger.warning("Received invalid block from peer")
                 return {"type": "error", "message": "Invalid block"}
                 
-            # Check if we already have this block
-            chain = load_chain()
-            if len(chain) >= block_data['index']:
-                existing_block = chain[block_data['index'] - 1]
-                if existing_block['hash'] == block_data['hash']:
-                    return {"type": "ok", "message": "Block already exists"}
-                    
             # Save block
             save_block(block_data)
             logger.info(f"New block #{block_data['index']} saved")
             
+            # Confirmed transactions leave the mempool
+            self.mempool.remove(tx_key(tx) for tx in block_data.get("txs", []))
+            
             # Broadcast to other peers
-            self._broadcast_to_peers({
-                "type": "new_block",
-                "data": block_data
-            }, exclude_peers=set())
+            self._broadcast_to_peers(pack_message("new_block", block_data), exclude_peers=set())
             
             return {"type": "ok", "message": "Block accepted"}
             
@@ -186,30 +244,23 @@ class P2PNode:
     def _handle_new_transaction(self, tx_data: Dict) -> Dict:
         """Handle new transaction from peer"""
         try:
-            # Validate transaction
-            if not self._validate_transaction(tx_data):
+            # Validate transaction and its signature
+            if not self._validate_transaction(tx_data) or not verify_tx(tx_data):
                 logger.warning("Received invalid transaction from peer")
                 return {"type": "error", "message": "Invalid transaction"}
                 
-            # Add to mempool
-            mempool = self._load_mempool()
-            
-            # Check for duplicates
-            tx_hash = self._calculate_tx_hash(tx_data)
-            for tx in mempool:
-                if self._calculate_tx_hash(tx) == tx_hash:
+            # Add to mempool, skipping duplicates and over-spends
+            try:
+                if not self.mempool.add(tx_data, balance=get_balance(tx_data['from'])):
                     return {"type": "ok", "message": "Transaction already in mempool"}
-                    
-            mempool.append(tx_data)
-            self._save_mempool(mempool)
+            except InsufficientFunds:
+                logger.warning("Rejected transaction over-spending its sender")
+                return {"type": "error", "message": "Insufficient balance"}
             
             logger.info(f"New transaction added to mempool")
             
             # Broadcast to other peers
-            self._broadcast_to_peers({
-                "type": "new_tx",
-                "data": tx_data
-            }, exclude_peers=set())
+            self._broadcast_to_peers(pack_message("new_tx", tx_data), exclude_peers=set())
             
             return {"type": "ok", "message": "Transaction accepted"}
             
@@ -221,7 +272,7 @@ class P2PNode:
         """Handle blockchain sync request"""
         try:
             chain = load_chain()
-            mempool = self._load_mempool()
+            mempool = self.mempool.all()
             
             return {
                 "type": "sync_response",
@@ -242,11 +293,27 @@ class P2PNode:
             if not all(field in block for field in required_fields):
                 return False
                 
-            # Basic hash validation
-            if not block['hash'].startswith('0' * 4):  # DIFFICULTY
+            # Recompute the header hash (and tx commitment for v2 blocks)
+            if not Block.from_dict(block).is_valid(DIFFICULTY):
                 return False
-                
-            return True
+            
+            # Every tx must be signed by its sender. Txs pending in our mempool
+            # with identical content were verified when they were admitted
+            # (possibly by an API worker), so only the rest pay for ECDSA.
+            txs = block.get('txs', [])
+            
+            # Txids derived from signed content: a tx already confirmed, or
+            # twice in the block, is a replay whatever txid it carries
+            txids = [tx_key(tx) for tx in txs]
+            known_txids = get_known_txids()
+            if len(set(txids)) != len(txids) or any(txid in known_txids for txid in txids):
+                return False
+            
+            if block['index'] < SIGNED_TXS_HEIGHT:
+                return True
+            pending = self.mempool.get_many(txids)
+            mark_verified(tx for tx, known in zip(txs, pending) if known == tx)
+            return all(verify_transactions(txs))
         except Exception:
             return False
             
@@ -265,32 +332,6 @@ class P2PNode:
         except Exception:
             return False
             
-    def _calculate_tx_hash(self, tx: Dict) -> str:
-        """Calculate transaction hash"""
-        import hashlib
-        tx_copy = dict(tx)
-        tx_copy.pop('signature', None)
-        return hashlib.sha256(json.dumps(tx_copy, sort_keys=True).encode()).hexdigest()
-        
-    def _load_mempool(self) -> List[Dict]:
-        """Load mempool from file"""
-        if not os.path.exists(MEMPOOL_FILE):
-            return []
-        try:
-            with open(MEMPOOL_FILE, "r") as f:
-                return json.load(f)
-        except Exception as e:
-            logger.error(f"Error loading mempool: {e}")
-            return []
-            
-    def _save_mempool(self, mempool: List[Dict]):
-        """Save mempool to file"""
-        try:
-            with open(MEMPOOL_FILE, "w") as f:
-                json.dump(mempool, f, indent=2)
-        except Exception as e:
-            logger.error(f"Error saving mempool: {e}")
-            
     def _bootstrap(self):
         """Bootstrap with known nodes"""
         logger.info("Bootstrapping with known nodes...")
@@ -312,12 +353,14 @@ class P2PNode:
             # Send ping to verify connection
             ping_msg = {"type": "ping", "timestamp": time.time()}
             s.send(json.dumps(ping_msg).encode())
+            P2P_MESSAGES.labels("out", "ping").inc()
             
             response = s.recv(1024).decode()
             if response:
                 response_data = json.loads(response)
                 if response_data.get('type') == 'pong':
                     self.peers.add(ip)
+                    P2P_PEERS.set(len(self.peers))
                     logger.info(f"Successfully connected to peer {ip}")
                     
             s.close()
@@ -339,6 +382,7 @@ class P2PNode:
                     
                     ping_msg = {"type": "ping", "timestamp": time.time()}
                     s.send(json.dumps(ping_msg).encode())
+                    P2P_MESSAGES.labels("out", "ping").inc()
                     
                     response = s.recv(1024).decode()
                     s.close()
@@ -353,6 +397,8 @@ class P2PNode:
             for peer in dead_peers:
                 self.peers.discard(peer)
                 logger.info(f"Removed dead peer: {peer}")
+            # Also picks up peers learned during syncs
+            P2P_PEERS.set(len(self.peers))
                 
     def _broadcast_to_peers(self, message: Dict, exclude_peers: Set[str] = None):
         """Broadcast message to all peers except excluded ones"""
@@ -372,6 +418,7 @@ class P2PNode:
             s.connect((ip, self.port))
             s.send(json.dumps(message).encode())
             s.close()
+            P2P_MESSAGES.labels("out", message.get("type", "unknown")).inc()
         except Exception as e:
             logger.error(f"Failed to send to {ip}: {e}")
             
@@ -386,7 +433,7 @@ class P2PNode:
                     data = response['data']
                     
                     # Update blockchain if peer has longer chain
-                    if len(data['chain']) > len(load_chain()):
+                    if len(data['chain']) > get_store().height():
                         # TODO: Implement proper chain validation and replacement
                         logger.info(f"Peer {peer} has longer chain: {len(data['chain'])} blocks")
                         
@@ -410,6 +457,7 @@ class P2PNode:
             
             sync_msg = {"type": "sync_request"}
             s.send(json.dumps(sync_msg).encode())
+            P2P_MESSAGES.labels("out", "sync_request").inc()
             
             response = s.recv(8192).decode()
             s.close()
@@ -424,20 +472,11 @@ class P2PNode:
         
     def _merge_mempool(self, peer_mempool: List[Dict]):
         """Merge peer mempool with local mempool"""
-        local_mempool = self._load_mempool()
-        
-        # Create set of existing transaction hashes
-        existing_hashes = {self._calculate_tx_hash(tx) for tx in local_mempool}
-        
-        # Add new transactions
-        for tx in peer_mempool:
-            tx_hash = self._calculate_tx_hash(tx)
-            if tx_hash not in existing_hashes:
-                local_mempool.append(tx)
-                existing_hashes.add(tx_hash)
-                
-        self._save_mempool(local_mempool)
-        logger.info(f"Merged mempool: {len(local_mempool)} transactions")
+        candidates = verified(tx for tx in peer_mempool if self._validate_transaction(tx))
+        # Same over-spend check as a single relayed tx, with one balance query
+        balances = get_balances(tx['from'] for tx in candidates)
+        added = self.mempool.add_many(candidates, balances=balances)
+        logger.info(f"Merged mempool: {added} new transactions")
 
 # Global node instance
 node = P2PNode()
@@ -0,0 +1,138 @@
+import os
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import threading
+from hashlib import blake2b
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# Sustained requests per client, and how many may arrive at once
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "60"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", str(RATE_LIMIT_PER_MINUTE)))
+
+# Table shared by every API worker on the host; 24 bytes per slot
+RATE_LIMIT_FILE = os.environ.get("RATE_LIMIT_FILE",
+                                 os.path.join(os.environ.get("DATA_DIR", "data"), "ratelimit.bin"))
+RATE_LIMIT_SLOTS = int(os.environ.get("RATE_LIMIT_SLOTS", "65536"))
+
+# Slots a client may occupy, starting at its hash
+PROBE = 8
+
+MAGIC = b"SLRATE01"
+# magic, slot count
+HEADER = struct.Struct("<8sQ")
+# client key, tokens, last update
+SLOT = struct.Struct("<Qdd")
+WINDOW = struct.Struct("<" + "Qdd" * PROBE)
+
+
+def client_key(client: str) -> int:
+    """Non-zero 64-bit key of a client address; 0 marks an empty slot"""
+    return int.from_bytes(blake2b(client.encode(), digest_size=8).digest(), "little") or 1
+
+
+class RateLimiter:
+    """Token buckets for API clients, shared by all workers through a memory-mapped file.
+
+    Each client gets ``burst`` tokens refilled at ``requests_per_minute``;
+    a request takes one. Buckets live in a fixed table of ``slots`` entries
+    in RATE_LIMIT_FILE, so memory stays the same however many clients
+    come by, and gunicorn workers see each other's requests; a byte-range
+    lock on the client's slots serializes updates. A client may sit in any of the PROBE slots from
+    its hash. A slot whose bucket has refilled is as good as empty and
+    is reused, which is how idle clients are forgotten. If all of them
+    are busy, the one with the most tokens is taken over, and that
+    client starts again from a full bucket.
+    """
+
+    def __init__(self, requests_per_minute: float = RATE_LIMIT_PER_MINUTE, burst: float = RATE_LIMIT_BURST,
+                 path: str = RATE_LIMIT_FILE, slots: int = RATE_LIMIT_SLOTS):
+        self.requests_per_minute = requests_per_minute
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self.path = path
+        self.slots = slots
+        self.allowed = 0
+        self.limited = 0
+        self._file = None
+        self._map = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Opened again in each forked worker, which also re-checks the layout
+        if self._map is not None and self._pid == os.getpid():
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = HEADER.size + (self.slots + PROBE) * SLOT.size
+        header = HEADER.pack(MAGIC, self.slots)
+        # Whole file, excluding every worker's slot updates while it is laid out
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != size or os.pread(fd, HEADER.size, 0) != header:
+                # New file, or one laid out for another table size
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, header, 0)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        if self._file is not None:
+            # Inherited from the parent
+            self._map.close()
+            os.close(self._file)
+        self._file = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+
+    def is_allowed(self, client_ip: str) -> bool:
+        key = client_key(client_ip)
+        now = time.time()
+        with self._lock:
+            self._open()
+            offset = HEADER.size + (key % self.slots) * SLOT.size
+            # Only this client's slots are locked, so workers serving
+            # different clients do not wait on each other
+            fcntl.lockf(self._file, fcntl.LOCK_EX, WINDOW.size, offset)
+            try:
+                fields = WINDOW.unpack_from(self._map, offset)
+                victim, victim_level = 0, -1.0
+                for i in range(PROBE):
+                    slot_key, tokens, updated = fields[3 * i:3 * i + 3]
+                    if slot_key == key:
+                        break
+                    level = tokens + max(now - updated, 0) * self.rate if slot_key else self.burst
+                    if level > victim_level:
+                        victim, victim_level = i, level
+                else:
+                    i, tokens, updated = victim, self.burst, now
+
+                tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                SLOT.pack_into(self._map, offset + i * SLOT.size, key, tokens, now)
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, WINDOW.size, offset)
+
+            if allowed:
+                self.allowed += 1
+            else:
+                self.limited += 1
+            return allowed
+
+    def stats(self) -> Dict:
+        """Limits, and this worker's decisions"""
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "burst": self.burst,
+            "slots": self.slots,
+            "allowed": self.allowed,
+            "limited": self.limited
+        }
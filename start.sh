@@ -12,6 +12,18 @@ mkdir -p logs data
 # Set environment variables
 export PYTHONUNBUFFERED=1
 export LOG_LEVEL=${LOG_LEVEL:-INFO}
+export MEMPOOL_SOCKET=${MEMPOOL_SOCKET:-data/mempool.sock}
+export MEMPOOL_FILE=${MEMPOOL_FILE:-data/mempool.json}
+export METRICS_DIR=${METRICS_DIR:-data/metrics}
+
+# Metric files of the previous run; counters start from zero again
+rm -rf "$METRICS_DIR"
+
+# Start the shared mempool daemon before anything that uses it
+echo "📥 Starting mempool daemon..."
+python mempoold.py --socket "$MEMPOOL_SOCKET" --snapshot "$MEMPOOL_FILE" &
+MEMPOOL_PID=$!
+while [ ! -S "$MEMPOOL_SOCKET" ]; do sleep 0.1; done
 
 # Start P2P node in background
 echo "📡 Starting P2P node..."
@@ -36,6 +48,6 @@ gunicorn api:app \
     --max-requests-jitter 100
 
 # Cleanup on exit
-trap "echo '🛑 Shutting down...'; kill $P2P_PID 2>/dev/null || true; exit 0" SIGTERM SIGINT
+trap "echo '🛑 Shutting down...'; kill $P2P_PID $MEMPOOL_PID 2>/dev/null || true; exit 0" SIGTERM SIGINT
 
 wait
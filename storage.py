@@ -0,0 +1,644 @@
+import os
+import copy
+import json
+import mmap
+import fcntl
+import struct
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+from codec import encode_block, decode_block, is_encoded
+from mempool import tx_fee
+
+logger = logging.getLogger(__name__)
+
+# Number of blocks per log segment file
+SEGMENT_BLOCKS = 1000
+
+# Offset index entry of the binary block file: record offset and length
+INDEX_ENTRY = struct.Struct(">QI")
+
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive flock on path for writers across processes"""
+    with open(path, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def file_stamp(path: str):
+    """(inode, mtime, size) of a file, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class ChainStore:
+    """Base class for chain storage backends.
+
+    Subclasses implement ``append`` and ``iter_blocks``; the remaining
+    lookups have correct (if linear) defaults built on top of them.
+    """
+
+    def append(self, block: Dict):
+        """Append a block dict to the end of the chain"""
+        raise NotImplementedError
+
+    def iter_blocks(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict]:
+        """Yield blocks with start <= index < stop in height order"""
+        raise NotImplementedError
+
+    def pop(self) -> Optional[Dict]:
+        """Remove and return the latest block, or None for an empty chain"""
+        raise NotImplementedError
+
+    def iter_blocks_reversed(self, start: int = 0, stop: Optional[int] = None,
+                             chunk: int = 256) -> Iterator[Dict]:
+        """Yield blocks with start <= index < stop newest first, reading chunk blocks at a time"""
+        height = self.height()
+        stop = height if stop is None else min(stop, height)
+        start = max(start, 0)
+        while stop > start:
+            window = list(self.iter_blocks(max(start, stop - chunk), stop))
+            yield from reversed(window)
+            stop -= chunk
+
+    def load_chain(self) -> List[Dict]:
+        """Return the whole chain as a list of block dicts"""
+        return list(self.iter_blocks())
+
+    def height(self) -> int:
+        """Return the number of blocks in the chain"""
+        return len(self.load_chain())
+
+    def get_block(self, index: int) -> Optional[Dict]:
+        """Return the block at the given height, or None"""
+        if index < 0:
+            return None
+        for block in self.iter_blocks(index, index + 1):
+            return block
+        return None
+
+    def tip(self) -> Optional[Dict]:
+        """Return the latest block, or None for an empty chain"""
+        height = self.height()
+        return self.get_block(height - 1) if height else None
+
+    def stamp(self):
+        """Cheap token that changes whenever blocks are appended or popped"""
+        tip = self.tip()
+        return tip["hash"] if tip else None
+
+    def get_block_by_hash(self, block_hash: str) -> Optional[Dict]:
+        """Return the block with the given hash, or None"""
+        for block in self.iter_blocks():
+            if block["hash"] == block_hash:
+                return block
+        return None
+
+    def find_transaction(self, txid: str) -> Optional[Tuple[Dict, Dict]]:
+        """Return (block, tx) for a confirmed transaction, or None"""
+        for block in self.iter_blocks():
+            for tx in block.get("txs", []):
+                if tx.get("txid") == txid:
+                    return block, tx
+        return None
+
+    def get_balance(self, address: str):
+        """Return the confirmed balance of an address"""
+        balance = 0
+        for block in self.iter_blocks():
+            if block["address"] == address:
+                balance += block["reward"]
+            for tx in block.get("txs", []):
+                if tx["from"] == address:
+                    balance -= tx["amount"]
+                if tx["to"] == address:
+                    balance += tx["amount"]
+                # Fees are paid by the sender to the block's miner
+                fee = tx_fee(tx)
+                if fee and tx["from"] == address:
+                    balance -= fee
+                if fee and block["address"] == address:
+                    balance += fee
+        return balance
+
+
+class JsonChainStore(ChainStore):
+    """Legacy single-file store: the whole chain as one JSON array.
+
+    Every append rewrites the file, so this is only meant for small
+    development chains.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # (file stamp, height, tip) of the last read or write, so height and
+        # tip do not re-parse an unchanged file
+        self._summary = None
+
+    def load_chain(self) -> List[Dict]:
+        stamp = file_stamp(self.path)
+        if stamp is None:
+            chain = []
+        else:
+            with open(self.path, "r") as f:
+                chain = json.load(f)
+        self._summary = (stamp, len(chain), copy.deepcopy(chain[-1]) if chain else None)
+        return chain
+
+    def _summarize(self) -> Tuple[int, Optional[Dict]]:
+        stamp = file_stamp(self.path)
+        if self._summary is None or self._summary[0] != stamp:
+            self.load_chain()
+        return self._summary[1], self._summary[2]
+
+    def height(self) -> int:
+        return self._summarize()[0]
+
+    def iter_blocks(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict]:
+        return iter(self.load_chain()[start:stop])
+
+    def iter_blocks_reversed(self, start: int = 0, stop: Optional[int] = None,
+                             chunk: int = 256) -> Iterator[Dict]:
+        # One read of the file instead of one per chunk
+        return reversed(self.load_chain()[max(start, 0):stop])
+
+    def get_block(self, index: int) -> Optional[Dict]:
+        chain = self.load_chain()
+        if 0 <= index < len(chain):
+            return chain[index]
+        return None
+
+    def tip(self) -> Optional[Dict]:
+        tip = self._summarize()[1]
+        # Callers get their own copy, as with a fresh read
+        return copy.deepcopy(tip)
+
+    def stamp(self):
+        return file_stamp(self.path)
+
+    def append(self, block: Dict):
+        chain = self.load_chain()
+        chain.append(block)
+        self._write(chain)
+
+    def pop(self) -> Optional[Dict]:
+        chain = self.load_chain()
+        if not chain:
+            return None
+        block = chain.pop()
+        self._write(chain)
+        return block
+
+    def _write(self, chain: List[Dict]):
+        # Replace rather than truncate, so readers never see a half-written file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(chain, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._summary = (file_stamp(self.path), len(chain), copy.deepcopy(chain[-1]) if chain else None)
+
+
+class BlockLogStore(ChainStore):
+    """Append-only segmented block log.
+
+    Blocks are stored one compact JSON record per line in segment files
+    of ``SEGMENT_BLOCKS`` blocks each (``blk00000.log``, ``blk00001.log``,
+    ...). A small ``tip.json`` records the chain height, tip hash and the
+    byte positions of the tip record, and is replaced atomically after
+    each append. Anything past the recorded segment size is a torn write
+    and gets truncated on the next append.
+    """
+
+    def __init__(self, directory: str, segment_blocks: int = SEGMENT_BLOCKS):
+        self.directory = directory
+        self.segment_blocks = segment_blocks
+        self.tip_path = os.path.join(directory, "tip.json")
+        self.lock_path = os.path.join(directory, "LOCK")
+        os.makedirs(directory, exist_ok=True)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"blk{segment:05d}.log")
+
+    def _read_tip(self) -> Dict:
+        try:
+            with open(self.tip_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"height": 0, "hash": None, "offset": 0, "size": 0}
+
+    def _write_tip(self, tip: Dict):
+        tmp_path = self.tip_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(tip, f)
+        os.replace(tmp_path, self.tip_path)
+
+    def height(self) -> int:
+        return self._read_tip()["height"]
+
+    def append(self, block: Dict):
+        record = (json.dumps(block, separators=(",", ":")) + "\n").encode()
+
+        with file_lock(self.lock_path):
+            tip = self._read_tip()
+            height = tip["height"]
+            segment = height // self.segment_blocks
+            # First block of a segment starts a fresh file
+            size = tip["size"] if height % self.segment_blocks else 0
+
+            with open(self._segment_path(segment), "ab") as f:
+                f.truncate(size)
+                f.write(record)
+
+            self._write_tip({
+                "height": height + 1,
+                "hash": block.get("hash"),
+                "offset": size,
+                "size": size + len(record)
+            })
+
+    def pop(self) -> Optional[Dict]:
+        with file_lock(self.lock_path):
+            tip = self._read_tip()
+            height = tip["height"]
+            if not height:
+                return None
+
+            with open(self._segment_path((height - 1) // self.segment_blocks), "rb") as f:
+                f.seek(tip["offset"])
+                block = json.loads(f.read(tip["size"] - tip["offset"]))
+
+            if height == 1:
+                self._write_tip({"height": 0, "hash": None, "offset": 0, "size": 0})
+                return block
+
+            # The new tip record ends where the popped one started, or at the
+            # end of the previous segment when the popped block opened a segment
+            segment = (height - 2) // self.segment_blocks
+            with open(self._segment_path(segment), "rb") as f:
+                data = f.read() if (height - 1) % self.segment_blocks == 0 else f.read(tip["offset"])
+            start = data.rfind(b"\n", 0, len(data) - 1) + 1
+            self._write_tip({
+                "height": height - 1,
+                "hash": json.loads(data[start:])["hash"],
+                "offset": start,
+                "size": len(data)
+            })
+            # The stale record is truncated by the next append
+            return block
+
+    def iter_blocks(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict]:
+        tip = self._read_tip()
+        height = tip["height"]
+        stop = height if stop is None else min(stop, height)
+        start = max(start, 0)
+        if start >= stop:
+            return
+
+        for segment in range(start // self.segment_blocks, (stop - 1) // self.segment_blocks + 1):
+            first = segment * self.segment_blocks
+            with open(self._segment_path(segment), "rb") as f:
+                for i, line in enumerate(f):
+                    index = first + i
+                    if index >= stop:
+                        return
+                    if index >= start:
+                        yield json.loads(line)
+
+    def tip(self) -> Optional[Dict]:
+        tip = self._read_tip()
+        if not tip["height"]:
+            return None
+        segment = (tip["height"] - 1) // self.segment_blocks
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(tip["offset"])
+            return json.loads(f.read(tip["size"] - tip["offset"]))
+
+    def stamp(self):
+        # tip.json is replaced on every append and pop
+        return file_stamp(self.tip_path)
+
+
+class SQLiteDatabase:
+    """Per-thread SQLite connections to one WAL-mode database file"""
+
+    def __init__(self, path: str, schema: str):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connect().executescript(schema)
+
+    def connect(self) -> sqlite3.Connection:
+        # Connections must not be shared across threads or forked workers
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run a write transaction, holding the database write lock throughout"""
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class SQLiteChainStore(ChainStore):
+    """Embedded SQLite store with height, hash, txid and address indexes.
+
+    The database runs in WAL mode so API workers can read while the node
+    or miner appends. Each thread gets its own connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS blocks (
+            height INTEGER PRIMARY KEY,
+            hash TEXT NOT NULL UNIQUE,
+            address TEXT,
+            reward,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS blocks_address ON blocks(address);
+
+        CREATE TABLE IF NOT EXISTS txs (
+            height INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            txid TEXT,
+            sender TEXT,
+            recipient TEXT,
+            amount,
+            fee NOT NULL DEFAULT 0,
+            PRIMARY KEY (height, position)
+        );
+        CREATE INDEX IF NOT EXISTS txs_txid ON txs(txid);
+        CREATE INDEX IF NOT EXISTS txs_sender ON txs(sender);
+        CREATE INDEX IF NOT EXISTS txs_recipient ON txs(recipient);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = SQLiteDatabase(path, self.SCHEMA)
+        self._add_fee_column()
+
+    def _add_fee_column(self):
+        # Databases written before fees were charged lack the column; it is
+        # added and filled in from the stored blocks
+        conn = self.db.connect()
+        if "fee" in [row[1] for row in conn.execute("PRAGMA table_info(txs)")]:
+            return
+        with self.db.transaction() as conn:
+            conn.execute("ALTER TABLE txs ADD COLUMN fee NOT NULL DEFAULT 0")
+            for height, data in conn.execute("SELECT height, data FROM blocks ORDER BY height").fetchall():
+                conn.executemany(
+                    "UPDATE txs SET fee = ? WHERE height = ? AND position = ?",
+                    [
+                        (tx_fee(tx), height, position)
+                        for position, tx in enumerate(self._decode(data).get("txs", []))
+                        if tx_fee(tx)
+                    ]
+                )
+        logger.info(f"Added the fee column to {self.path}")
+
+    def append(self, block: Dict):
+        with self.db.transaction() as conn:
+            height = self._height(conn)
+            conn.execute(
+                "INSERT INTO blocks (height, hash, address, reward, data) VALUES (?, ?, ?, ?, ?)",
+                (height, block["hash"], block.get("address"), block.get("reward"),
+                 encode_block(block))
+            )
+            conn.executemany(
+                "INSERT INTO txs (height, position, txid, sender, recipient, amount, fee) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (height, position, tx.get("txid"), tx.get("from"), tx.get("to"), tx.get("amount"),
+                     tx_fee(tx))
+                    for position, tx in enumerate(block.get("txs", []))
+                ]
+            )
+
+    def pop(self) -> Optional[Dict]:
+        with self.db.transaction() as conn:
+            height = self._height(conn)
+            if not height:
+                return None
+            row = conn.execute("SELECT data FROM blocks WHERE height = ?", (height - 1,)).fetchone()
+            conn.execute("DELETE FROM txs WHERE height = ?", (height - 1,))
+            conn.execute("DELETE FROM blocks WHERE height = ?", (height - 1,))
+            return self._decode(row[0])
+
+    def _height(self, conn: sqlite3.Connection) -> int:
+        return conn.execute("SELECT COALESCE(MAX(height) + 1, 0) FROM blocks").fetchone()[0]
+
+    def height(self) -> int:
+        return self._height(self.db.connect())
+
+    def iter_blocks(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict]:
+        if stop is None:
+            stop = self.height()
+        cursor = self.db.connect().execute(
+            "SELECT data FROM blocks WHERE height >= ? AND height < ? ORDER BY height",
+            (start, stop)
+        )
+        for (data,) in cursor:
+            yield self._decode(data)
+
+    def _decode(self, data) -> Dict:
+        # Rows written before the codec existed hold JSON text
+        if isinstance(data, str):
+            return json.loads(data)
+        return decode_block(data)
+
+    def _fetch_block(self, query: str, params: Tuple) -> Optional[Dict]:
+        row = self.db.connect().execute(query, params).fetchone()
+        return self._decode(row[0]) if row else None
+
+    def get_block(self, index: int) -> Optional[Dict]:
+        return self._fetch_block("SELECT data FROM blocks WHERE height = ?", (index,))
+
+    def tip(self) -> Optional[Dict]:
+        return self._fetch_block("SELECT data FROM blocks ORDER BY height DESC LIMIT 1", ())
+
+    def stamp(self):
+        # data_version moves on commits by other connections, total_changes on our own
+        conn = self.db.connect()
+        return conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes
+
+    def get_block_by_hash(self, block_hash: str) -> Optional[Dict]:
+        return self._fetch_block("SELECT data FROM blocks WHERE hash = ?", (block_hash,))
+
+    def find_transaction(self, txid: str) -> Optional[Tuple[Dict, Dict]]:
+        row = self.db.connect().execute(
+            "SELECT height, position FROM txs WHERE txid = ? ORDER BY height LIMIT 1", (txid,)
+        ).fetchone()
+        if not row:
+            return None
+        block = self.get_block(row[0])
+        return block, block["txs"][row[1]]
+
+    def get_balance(self, address: str):
+        conn = self.db.connect()
+        rewards = conn.execute(
+            "SELECT COALESCE(SUM(reward), 0) FROM blocks WHERE address = ?", (address,)
+        ).fetchone()[0]
+        received = conn.execute(
+            "SELECT COALESCE(SUM(amount), 0) FROM txs WHERE recipient = ?", (address,)
+        ).fetchone()[0]
+        sent = conn.execute(
+            "SELECT COALESCE(SUM(amount + fee), 0) FROM txs WHERE sender = ?", (address,)
+        ).fetchone()[0]
+        fees = conn.execute(
+            "SELECT COALESCE(SUM(txs.fee), 0) FROM blocks JOIN txs USING (height) WHERE blocks.address = ?",
+            (address,)
+        ).fetchone()[0]
+        return rewards + received + fees - sent
+
+
+class MmapBlockStore(ChainStore):
+    """Binary block file with a fixed-width offset index.
+
+    ``blocks.dat`` holds codec-encoded block records back to back and
+    ``blocks.idx`` one ``INDEX_ENTRY`` per height pointing into it. Readers
+    ``mmap`` both files, so fetching a block by height (or the tip) is a
+    constant-time slice, and every process shares the same page cache
+    instead of holding its own parsed chain. The index entry is written
+    after the record, so a block only becomes visible once complete.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.data_path = os.path.join(directory, "blocks.dat")
+        self.index_path = os.path.join(directory, "blocks.idx")
+        self.lock_path = os.path.join(directory, "LOCK")
+        os.makedirs(directory, exist_ok=True)
+        for path in (self.data_path, self.index_path):
+            open(path, "ab").close()
+        self._maps = {}
+        self._map_lock = threading.Lock()
+
+    def _map(self, path: str, needed: int) -> Optional[mmap.mmap]:
+        """Return a read-only map of path covering at least needed bytes"""
+        current = self._maps.get(path)
+        if current is not None and len(current) >= needed:
+            return current
+        with self._map_lock:
+            current = self._maps.get(path)
+            if current is not None and len(current) >= needed:
+                return current
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < needed or size == 0:
+                    return None
+                # Old maps are left to the GC since other threads may still be reading them
+                current = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[path] = current
+            return current
+
+    def _encode(self, block: Dict) -> bytes:
+        return encode_block(block)
+
+    def _decode(self, record) -> Dict:
+        # Files written before the codec existed hold compact JSON records
+        if is_encoded(record):
+            return decode_block(record)
+        return json.loads(bytes(record))
+
+    def _entry(self, index: int) -> Tuple[int, int]:
+        end = (index + 1) * INDEX_ENTRY.size
+        return INDEX_ENTRY.unpack_from(self._map(self.index_path, end), index * INDEX_ENTRY.size)
+
+    def height(self) -> int:
+        return os.stat(self.index_path).st_size // INDEX_ENTRY.size
+
+    def append(self, block: Dict):
+        record = self._encode(block)
+
+        with file_lock(self.lock_path):
+            with open(self.index_path, "r+b") as idx, open(self.data_path, "r+b") as dat:
+                height = os.fstat(idx.fileno()).st_size // INDEX_ENTRY.size
+                offset = 0
+                if height:
+                    idx.seek((height - 1) * INDEX_ENTRY.size)
+                    last_offset, last_length = INDEX_ENTRY.unpack(idx.read(INDEX_ENTRY.size))
+                    offset = last_offset + last_length
+
+                # Drop anything left over from an interrupted append
+                dat.truncate(offset)
+                dat.seek(offset)
+                dat.write(record)
+                dat.flush()
+
+                idx.truncate(height * INDEX_ENTRY.size)
+                idx.seek(height * INDEX_ENTRY.size)
+                idx.write(INDEX_ENTRY.pack(offset, len(record)))
+
+    def pop(self) -> Optional[Dict]:
+        with file_lock(self.lock_path):
+            height = self.height()
+            if not height:
+                return None
+            block = self.get_block(height - 1)
+            # Dropping the index entry is enough, the record is overwritten by the next append
+            with open(self.index_path, "r+b") as idx:
+                idx.truncate((height - 1) * INDEX_ENTRY.size)
+            return block
+
+    def get_block(self, index: int) -> Optional[Dict]:
+        if index < 0 or index >= self.height():
+            return None
+        offset, length = self._entry(index)
+        data = self._map(self.data_path, offset + length)
+        return self._decode(memoryview(data)[offset:offset + length])
+
+    def tip(self) -> Optional[Dict]:
+        height = self.height()
+        return self.get_block(height - 1) if height else None
+
+    def stamp(self):
+        return file_stamp(self.index_path)
+
+    def iter_blocks(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Dict]:
+        height = self.height()
+        stop = height if stop is None else min(stop, height)
+        for index in range(max(start, 0), stop):
+            yield self.get_block(index)
+
+
+def migrate_json_chain(json_path: str, store: ChainStore) -> int:
+    """Copy a legacy blockchain.json into an empty store.
+
+    Returns the number of blocks migrated.
+    """
+    if store.height():
+        raise ValueError("Target store is not empty")
+    if not os.path.exists(json_path):
+        return 0
+
+    with open(json_path, "r") as f:
+        chain = json.load(f)
+
+    for block in chain:
+        store.append(block)
+
+    logger.info(f"Migrated {len(chain)} blocks from {json_path}")
+    return len(chain)
@@ -0,0 +1,111 @@
+import json
+import time
+import pytest
+from block import Block, BLOCK_VERSION
+
+ALICE = "shadow1" + "aa" * 16
+BOB = "shadow1" + "bb" * 16
+HEIGHT = 12
+
+@pytest.fixture
+def client(empty_chain, monkeypatch):
+    """The API over a HEIGHT block chain in a scratch directory.
+
+    Block i pays the reward to ALICE and, from block 1 on, holds one tx of
+    i coins from ALICE to BOB. Everything the API and the pools it spawns
+    write lands in the scratch directory.
+    """
+    import block
+    import metrics
+    from fastapi.testclient import TestClient
+    from httpcache import TipCache
+    from ratelimit import RateLimiter
+    from verify import LRUCache
+
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(empty_chain / "metrics"))
+    monkeypatch.setattr(metrics, "_values", None)
+
+    import api
+    monkeypatch.setattr(api, "rate_limiter", RateLimiter(10 ** 6, 10 ** 6, path=str(empty_chain / "ratelimit.bin")))
+    monkeypatch.setattr(api, "tip_cache", TipCache(block.get_store))
+    monkeypatch.setattr(api, "final_blocks", LRUCache(100))
+    monkeypatch.setattr(api, "CACHE_FINAL_DEPTH", 5)
+
+    previous_hash = "0" * 64
+    for i in range(HEIGHT):
+        txs = [{"from": ALICE, "to": BOB, "amount": i, "timestamp": time.time()}] if i else []
+        blk = Block(i, time.time(), previous_hash, 0, 10, ALICE, txs, version=BLOCK_VERSION)
+        block.save_block(blk)
+        previous_hash = blk.hash
+    return TestClient(api.app)
+
+def test_history_pages_follow_the_cursor(client):
+    page = client.get(f"/wallet/{BOB}/history", params={"limit": 5}).json()
+    assert [entry["height"] for entry in page["history"]] == [11, 10, 9, 8, 7]
+    assert page["history"][0]["direction"] == "in" and page["history"][0]["counterparty"] == ALICE
+
+    rest = client.get(f"/wallet/{BOB}/history", params={"limit": 50, "cursor": page["next_cursor"]}).json()
+    assert [entry["height"] for entry in rest["history"]] == [6, 5, 4, 3, 2, 1]
+    assert rest["next_cursor"] is None
+
+    assert client.get(f"/wallet/{BOB}/history", params={"cursor": "garbage"}).status_code == 400
+    assert client.get("/wallet/nope/history").status_code == 400
+
+def test_batch_balances(client):
+    response = client.post("/wallet/balances", json={"addresses": [ALICE, BOB, "shadow1nobody"]})
+    assert response.status_code == 200
+    sent = sum(range(HEIGHT))
+    assert response.json()["balances"] == {ALICE: 10 * HEIGHT - sent, BOB: sent, "shadow1nobody": 0}
+
+    assert client.post("/wallet/balances", json={"addresses": ["nope"]}).status_code == 422
+
+def test_blockchain_pages_and_ndjson(client):
+    # Without a limit the whole chain comes back, as before paging
+    whole = client.get("/blockchain").json()
+    assert whole["length"] == HEIGHT and [b["index"] for b in whole["blocks"]] == list(range(HEIGHT))
+    assert whole["next"] is None
+
+    page = client.get("/blockchain", params={"limit": 5}).json()
+    assert page["length"] == HEIGHT
+    assert [b["index"] for b in page["blocks"]] == [0, 1, 2, 3, 4]
+    assert page["next"] == {"from": 5, "to": None}
+
+    page = client.get("/blockchain", params={"limit": 5, "reverse": "true"}).json()
+    assert [b["index"] for b in page["blocks"]] == [11, 10, 9, 8, 7]
+    page = client.get("/blockchain", params=page["next"] | {"limit": 5, "reverse": "true"}).json()
+    assert [b["index"] for b in page["blocks"]] == [6, 5, 4, 3, 2]
+
+    response = client.get("/blockchain", params={"from": 3, "to": 9, "format": "ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["index"] for line in response.text.splitlines()] == [3, 4, 5, 6, 7, 8]
+
+    response = client.get("/blockchain", params={"reverse": "true", "limit": 3},
+                          headers={"Accept": "application/x-ndjson"})
+    assert [json.loads(line)["index"] for line in response.text.splitlines()] == [11, 10, 9]
+
+def test_etags_answer_304(client):
+    latest = client.get("/blockchain/latest")
+    assert latest.json()["index"] == HEIGHT - 1
+    tag = latest.headers["etag"]
+    assert client.get("/blockchain/latest", headers={"If-None-Match": tag}).status_code == 304
+
+    # Deep enough below the tip to be final
+    final = client.get("/blockchain/2")
+    assert final.headers["cache-control"].endswith("immutable")
+    response = client.get("/blockchain/2", headers={"If-None-Match": final.headers["etag"]})
+    assert response.status_code == 304 and not response.content
+
+    recent = client.get("/blockchain/10")
+    assert recent.headers["cache-control"] == "no-cache"
+    assert client.get("/blockchain/10", headers={"If-None-Match": tag}).status_code == 200
+    assert client.get("/blockchain/99").status_code == 404
+
+def test_metrics_endpoint(client):
+    client.get("/blockchain/latest")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert f"shadowledger_chain_height {HEIGHT}" in text
+    assert 'shadowledger_http_requests_total{method="GET",route="/blockchain/latest",status="200"}' in text
+    assert "# TYPE shadowledger_http_request_duration_seconds histogram" in text
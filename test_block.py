@@ -0,0 +1,86 @@
+import time
+from block import Block, BLOCK_VERSION, tx_commitment
+from codec import encode_block, decode_block
+
+def sample_txs(count):
+    return [
+        {"from": "A", "to": "B", "amount": i + 1, "timestamp": time.time(), "signature": "ab" * 32, "txid": f"tx{i}"}
+        for i in range(count)
+    ]
+
+def test_header_hash_commits_to_txs():
+    blk = Block(1, time.time(), "0" * 64, 0, 10, "shadow1" + "12" * 16, sample_txs(3), version=BLOCK_VERSION)
+    assert blk.mine(2)
+    assert blk.hash.startswith("00")
+    assert blk.is_valid(2)
+
+    data = blk.to_dict()
+    assert data["tx_root"] == tx_commitment(data["txs"])
+    assert Block.from_dict(decode_block(encode_block(data))).is_valid(2)
+
+    data["txs"][0]["amount"] = 1000
+    assert not Block.from_dict(data).is_valid(2)
+
+    data = blk.to_dict()
+    data["nonce"] += 1
+    assert not Block.from_dict(data).is_valid(2)
+
+def test_header_size_does_not_depend_on_txs():
+    small = Block(1, time.time(), "0" * 64, 0, 10, "miner", sample_txs(1), version=BLOCK_VERSION)
+    large = Block(1, time.time(), "0" * 64, 0, 10, "miner", sample_txs(500), version=BLOCK_VERSION)
+    assert len(small.header_prefix()) == len(large.header_prefix())
+
+def test_v1_blocks_still_validate():
+    blk = Block(0, time.time(), "0" * 64, 0, 10, "miner", sample_txs(2))
+    assert blk.mine(1)
+    data = blk.to_dict()
+    assert "version" not in data
+    assert Block.from_dict(data).is_valid(1)
+
+def signer():
+    """A key and the shadow1 address it signs for"""
+    from ecdsa import SigningKey, SECP256k1
+    from verify import get_address
+    key = SigningKey.generate(curve=SECP256k1)
+    return key, get_address(key.get_verifying_key().to_string().hex())
+
+def signed(key, tx):
+    from verify import signing_payload
+    return dict(tx, signature=key.sign(signing_payload(tx)).hex(),
+                pubkey=key.get_verifying_key().to_string().hex())
+
+def test_select_transactions_tracks_sender_spends(empty_chain):
+    import block
+    key, sender = signer()
+    block.save_block(Block(0, time.time(), "0" * 64, 0, 10, sender, [], version=BLOCK_VERSION))
+
+    txs = [
+        signed(key, {"from": sender, "to": "B", "amount": 5.5, "timestamp": time.time()}),
+        signed(key, {"from": sender, "to": "B", "amount": 5, "timestamp": time.time()}),
+        signed(key, {"from": sender, "to": "C", "amount": 3, "timestamp": time.time(), "fee": 1}),
+        signed(key, {"from": sender, "to": "C", "amount": -3, "timestamp": time.time()}),
+        # Fits the balance, but is dropped for its signature
+        dict(signed(key, {"from": sender, "to": "D", "amount": 0.5, "timestamp": time.time()}), signature="ab"),
+    ]
+    assert block.select_transactions(txs) == [txs[0], txs[2]]
+    assert block.select_transactions(txs, max_txs=1) == [txs[0]]
+
+    # A forged tx ahead of valid ones takes neither their balance nor their slots
+    forged = dict(signed(key, {"from": sender, "to": "D", "amount": 9, "timestamp": time.time()}), signature="ab")
+    valid = [signed(key, {"from": sender, "to": "E", "amount": amount, "timestamp": time.time()}) for amount in (6, 3)]
+    assert block.select_transactions([forged] + valid, max_txs=2) == valid
+
+def test_save_block_only_extends_the_tip(empty_chain):
+    import pytest
+    import block
+    genesis = Block(0, time.time(), "0" * 64, 0, 10, "A", [], version=BLOCK_VERSION)
+    block.save_block(genesis)
+
+    with pytest.raises(ValueError):
+        block.save_block(Block(5, time.time(), genesis.hash, 0, 10, "A", [], version=BLOCK_VERSION))
+    with pytest.raises(ValueError):
+        block.save_block(Block(1, time.time(), "ff" * 32, 0, 10, "A", [], version=BLOCK_VERSION))
+    assert block.get_store().height() == 1
+
+    block.save_block(Block(1, time.time(), genesis.hash, 0, 10, "A", [], version=BLOCK_VERSION))
+    assert block.get_balance("A") == 20
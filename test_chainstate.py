@@ -0,0 +1,161 @@
+from chainstate import ChainState, KnownTxids
+from storage import BlockLogStore, JsonChainStore, SQLiteChainStore
+from mempool import tx_key
+from test_storage import make_chain
+
+def txid(blk):
+    """Txid of a block's only tx, derived from its signed fields"""
+    return tx_key(blk["txs"][0])
+
+def test_balances_follow_appends_and_pops(tmp_path):
+    store = BlockLogStore(str(tmp_path / "blocks"))
+    state = ChainState(str(tmp_path / "state.db"))
+    chain = make_chain(4)
+
+    for blk in chain:
+        store.append(blk)
+        assert state.apply_block(blk)
+    # Applying the same block twice is a no-op
+    assert not state.apply_block(chain[-1])
+
+    for address in ("A", "B", "miner123"):
+        assert state.balance(address) == store.get_balance(address)
+    assert state.balance("nobody") == 0
+
+    assert state.revert_block(store.pop())
+    assert state.height() == 3
+    assert state.tip_hash() == chain[2]["hash"]
+    assert state.balance("B") == store.get_balance("B")
+
+def test_fees_are_charged_to_sender_and_paid_to_miner(tmp_path):
+    state = ChainState(str(tmp_path / "state.db"))
+    store = SQLiteChainStore(str(tmp_path / "chain.db"))
+    reference = BlockLogStore(str(tmp_path / "blocks"))
+    chain = make_chain(3)
+    chain[2] = dict(chain[2], address="other", txs=[dict(chain[2]["txs"][0], fee=0.5)])
+    for blk in chain:
+        store.append(blk)
+        reference.append(blk)
+        state.apply_block(blk)
+
+    # A pays 0 + 1 + 2 plus the fee, which goes to the miner of block 2
+    assert state.balance("A") == -3.5
+    assert state.balance("other") == 10.5
+    for address in ("A", "B", "miner123", "other"):
+        assert state.balance(address) == store.get_balance(address) == reference.get_balance(address)
+
+    entries, _ = state.history("A", limit=2)
+    assert [(e["direction"], e["amount"], e["counterparty"]) for e in entries] == [
+        ("out", 2, "B"), ("fee_out", 0.5, "other")]
+    entries, _ = state.history("other", limit=10)
+    assert [e["direction"] for e in entries] == ["fee_in", "reward"]
+
+    assert state.revert_block(chain[2])
+    assert state.balance("A") == -1 and state.balance("other") == 0
+
+def test_sync_catches_up_and_rebuilds(tmp_path):
+    store = BlockLogStore(str(tmp_path / "blocks"))
+    state = ChainState(str(tmp_path / "state.db"))
+    for blk in make_chain(3):
+        store.append(blk)
+
+    state.sync(store)
+    assert state.height() == 3
+    assert state.balance("miner123") == 30
+
+    # A different, shorter chain forces a rebuild
+    other = BlockLogStore(str(tmp_path / "other"))
+    for blk in make_chain(2):
+        other.append(blk)
+    state.sync(other)
+    assert state.height() == 2
+    assert state.tip_hash() == other.tip()["hash"]
+    assert state.balance("miner123") == 20
+
+def test_repeated_lookups_do_not_reread_the_json_chain(tmp_path, monkeypatch):
+    store = JsonChainStore(str(tmp_path / "blockchain.json"))
+    state = ChainState(str(tmp_path / "state.db"))
+    chain = make_chain(3)
+    for blk in chain[:2]:
+        store.append(blk)
+
+    reads = []
+    load_chain = store.load_chain
+    monkeypatch.setattr(store, "load_chain", lambda: reads.append(1) or load_chain())
+    state.sync(store)
+    before = len(reads)
+    for _ in range(20):
+        state.sync(store)
+        assert state.balance("miner123") == 20
+    assert len(reads) == before
+    assert store.height() == 2 and store.tip()["hash"] == chain[1]["hash"]
+    assert len(reads) == before
+
+    # An append through another handle is still picked up
+    JsonChainStore(store.path).append(chain[2])
+    state.sync(store)
+    assert state.height() == 3 and state.balance("miner123") == 30
+
+def test_history_pages_newest_first(tmp_path):
+    state = ChainState(str(tmp_path / "state.db"))
+    chain = make_chain(5)
+    state.rebuild(chain)
+
+    entries, cursor = state.history("B", limit=2)
+    assert [(e["height"], e["direction"]) for e in entries] == [(4, "in"), (3, "in")]
+    assert entries[0]["counterparty"] == "A"
+    assert entries[0]["txid"] == txid(chain[4])
+
+    rest, cursor = state.history("B", cursor=cursor, limit=10)
+    assert [e["height"] for e in rest] == [2, 1, 0]
+    assert cursor is None
+
+    miner, _ = state.history("miner123", limit=10)
+    assert {e["direction"] for e in miner} == {"reward"}
+    assert len(miner) == 5
+
+    state.revert_block(chain[-1])
+    assert state.history("B", limit=1)[0][0]["height"] == 3
+
+def test_txid_index(tmp_path):
+    state = ChainState(str(tmp_path / "state.db"))
+    chain = make_chain(3)
+    state.rebuild(chain)
+
+    assert state.locate_tx(txid(chain[1])) == (1, 0)
+    assert state.locate_tx("missing") is None
+    state.revert_block(chain[-1])
+    assert state.locate_tx(txid(chain[2])) is None
+
+def test_batch_balances(tmp_path):
+    state = ChainState(str(tmp_path / "state.db"))
+    state.rebuild(make_chain(3))
+    addresses = ["A", "B", "miner123", "nobody", "A"]
+    assert state.balances(addresses) == {a: state.balance(a) for a in addresses}
+    assert list(state.balances(addresses)) == ["A", "B", "miner123", "nobody"]
+
+def test_known_txids_snapshot_and_sync(tmp_path):
+    state = ChainState(str(tmp_path / "state.db"))
+    chain = make_chain(4)
+    state.rebuild(chain[:2])
+
+    known = KnownTxids(state, str(tmp_path / "txids.bloom"))
+    known.sync()
+    assert txid(chain[1]) in known
+    assert txid(chain[3]) not in known
+
+    state.apply_block(chain[2])
+    state.apply_block(chain[3])
+    known.sync()
+    assert txid(chain[3]) in known
+
+    # A fresh process picks the filter up from the snapshot
+    reloaded = KnownTxids(state, str(tmp_path / "txids.bloom"))
+    assert reloaded.height == 4
+    assert all(txid(blk) in reloaded.filter for blk in chain)
+
+    # Rolled back txids are no longer known, even though the filter still has them
+    state.revert_block(chain[3])
+    assert txid(chain[3]) not in known
+    known.sync()
+    assert known.height == 3
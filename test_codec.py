@@ -0,0 +1,36 @@
+import json
+import time
+from block import Block
+from codec import encode_block, decode_block, encode_tx, decode_tx, encode_blocks, decode_blocks
+
+def sample_txs():
+    return [
+        {
+            "from": "shadow1" + "ab" * 16,
+            "to": "stealth1" + "cd" * 16,
+            "amount": 2.5,
+            "timestamp": time.time(),
+            "signature": "9f" * 64,
+            "txid": "0e" * 32
+        },
+        {"from": "A", "to": "B", "amount": 5, "timestamp": time.time(), "signature": None, "memo": ["x", 1]},
+    ]
+
+def test_block_roundtrip_keeps_hash():
+    blk = Block(7, time.time(), "00" * 32, 123456, 10, "shadow1" + "12" * 16, sample_txs())
+    data = blk.to_dict()
+
+    encoded = encode_block(data)
+    decoded = decode_block(encoded)
+    assert decoded == data
+    assert json.dumps(decoded, sort_keys=True) == json.dumps(data, sort_keys=True)
+    assert Block(**decoded).calculate_hash() == blk.hash
+    assert len(encoded) < len(json.dumps(data, separators=(",", ":")))
+
+def test_tx_and_chain_roundtrip():
+    for tx in sample_txs():
+        assert decode_tx(encode_tx(tx)) == tx
+
+    chain = [Block(i, time.time(), "0" * 64, i, 10, "miner123", sample_txs()).to_dict() for i in range(3)]
+    assert decode_blocks(encode_blocks(chain)) == chain
+    assert decode_blocks(encode_blocks([])) == []
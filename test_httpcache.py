@@ -0,0 +1,42 @@
+from storage import JsonChainStore
+from httpcache import TipCache, etag, etag_matches
+
+def block(index):
+    return {"index": index, "hash": f"{index:064x}", "txs": []}
+
+def test_tip_cache_follows_the_tip(tmp_path):
+    store = JsonChainStore(str(tmp_path / "chain.json"))
+    cache = TipCache(lambda: store)
+    assert not cache.current()
+    cache.refresh()
+    assert cache.current() and cache.tip_hash is None and cache.height == 0
+
+    store.append(block(0))
+    assert not cache.current()
+    cache.refresh()
+    assert cache.tip_hash == block(0)["hash"] and cache.height == 1
+    cache.put("summary", {"length": 1}, cache.tip_hash)
+    assert cache.get("summary") == {"length": 1}
+
+    # Computed at a tip the cache no longer holds
+    cache.put("latest", "stale", block(5)["hash"])
+    assert cache.get("latest") is None
+
+    store.append(block(1))
+    cache.refresh()
+    assert cache.height == 2 and cache.get("summary") is None
+
+    # A reorg back to the same height is a new tip too
+    cache.put("summary", {"length": 2}, cache.tip_hash)
+    store.pop()
+    store.append(dict(block(1), hash="ff" * 32))
+    cache.refresh()
+    assert cache.tip_hash == "ff" * 32 and cache.get("summary") is None
+
+def test_etag_matching():
+    tag = etag("ab" * 32, "json")
+    assert etag_matches(tag, tag)
+    assert etag_matches(f'"other", W/{tag}', tag)
+    assert etag_matches("*", tag)
+    assert not etag_matches(None, tag)
+    assert not etag_matches(etag("ab" * 32, "bin"), tag)
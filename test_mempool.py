@@ -0,0 +1,156 @@
+import json
+import time
+import pytest
+from mempool import Mempool, MempoolError, MempoolFull, InsufficientFunds, tx_key, tx_size
+
+now = time.time()
+
+def memos(txs):
+    """Labels of txs; their txids are derived from the signed fields"""
+    return [tx["memo"] for tx in txs]
+
+def test_mempool_index_and_external_changes(tmp_path):
+    path = str(tmp_path / "mempool.json")
+    pool = Mempool(path)
+    tx = {"from": "A", "to": "B", "amount": 1, "timestamp": now + 1, "memo": "t1"}
+    txid = tx_key(tx)
+
+    assert pool.get(txid) is None
+    assert pool.add(tx)
+    assert not pool.add(dict(tx))
+    # A txid supplied by the sender is neither trusted nor kept
+    assert not pool.add(dict(tx, txid="replayed"))
+    assert pool.get(txid) == dict(tx, txid=txid)
+
+    # Another process rewrites the file
+    other = {"from": "B", "to": "C", "amount": 2, "timestamp": now + 2, "signature": "ab"}
+    with open(path, "w") as f:
+        json.dump([tx, other], f)
+    assert len(pool) == 2
+    assert pool.get(tx_key(other)) == other
+
+    assert pool.remove([txid, "nope"]) == 1
+    assert [t["from"] for t in Mempool(path).all()] == ["B"]
+
+def test_select_by_fee_rate_then_arrival_within_limits(tmp_path):
+    pool = Mempool(str(tmp_path / "mempool.json"))
+    txs = [
+        {"from": "A", "to": "B", "amount": 1, "timestamp": now + 1, "memo": "plain1"},
+        {"from": "A", "to": "B", "amount": 1, "timestamp": now + 2, "memo": "low", "fee": 0.1},
+        {"from": "A", "to": "B", "amount": 1, "timestamp": now + 3, "memo": "plain2"},
+        {"from": "A", "to": "B", "amount": 1, "timestamp": now + 4, "memo": "high", "fee": 5},
+    ]
+    for tx in txs:
+        pool.add(tx)
+
+    assert memos(pool.select(10, 10 ** 6, lambda tx: True)) == ["high", "low", "plain1", "plain2"]
+    assert memos(pool.select(2, 10 ** 6, lambda tx: True)) == ["high", "low"]
+    assert memos(pool.select(10, 10 ** 6, lambda tx: tx["memo"] != "low"))[:2] == ["high", "plain1"]
+
+    # The byte cap stops the template at the first tx that does not fit
+    one = tx_size(pool.get(tx_key(txs[3])))
+    assert memos(pool.select(10, one, lambda tx: True)) == ["high"]
+
+    pool.remove([tx_key(txs[3]), tx_key(txs[0])])
+    assert memos(Mempool(pool.path).select(10, 10 ** 6, lambda tx: True)) == ["low", "plain2"]
+
+def test_daemon_shares_one_mempool_and_snapshots(tmp_path):
+    from mempool import MempoolClient
+    from mempoold import MempoolDaemon
+
+    old = {"from": "A", "to": "B", "amount": 1, "timestamp": now + 1, "memo": "old"}
+    new = {"from": "A", "to": "C", "amount": 2, "timestamp": now + 2, "memo": "new", "fee": 1}
+    others = [{"from": "B", "to": "C", "amount": 3, "timestamp": now + 3 + i, "memo": f"b{i}"} for i in range(3)]
+    snapshot = str(tmp_path / "mempool.json")
+    with open(snapshot, "w") as f:
+        json.dump([old], f)
+
+    daemon = MempoolDaemon(str(tmp_path / "mempool.sock"), snapshot, interval=3600)
+    daemon.start()
+    try:
+        api, miner = MempoolClient(daemon.socket_path), MempoolClient(daemon.socket_path)
+        stamp = miner.stamp()
+        assert api.add(new)
+        assert not api.add(new)
+        assert api.add_many(others) == 3
+
+        assert miner.stamp() != stamp
+        assert len(miner) == 5
+        assert tx_key(new) in miner and miner.get("nope") is None
+        assert memos(miner.by_sender("A")) == ["old", "new"]
+        assert memos(miner.select(3, 10 ** 6, lambda tx: True)) == ["new", "old", "b0"]
+
+        assert miner.remove([tx_key(old), tx_key(others[1])]) == 2
+        assert memos(api.all()) == ["new", "b0", "b2"]
+    finally:
+        daemon.stop()
+
+    with open(snapshot) as f:
+        assert memos(json.load(f)) == ["new", "b0", "b2"]
+
+
+def test_bounded_mempool_evicts_lowest_priority_and_expires(tmp_path, monkeypatch):
+    pool = Mempool(str(tmp_path / "mempool.json"), max_txs=3, ttl=60)
+    assert pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now, "memo": "plain1"})
+    assert pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now, "memo": "fee1", "fee": 1})
+    assert pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now - 30, "memo": "plain2"})
+
+    # A full pool makes room by dropping the newest fee-less tx
+    assert pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now, "memo": "fee2", "fee": 2})
+    assert sorted(memos(pool.all())) == ["fee1", "fee2", "plain1"]
+    # ...and turns away newcomers that would rank last
+    with pytest.raises(MempoolFull):
+        pool.add({"from": "A", "to": "B", "amount": 2, "timestamp": now, "memo": "plain3"})
+    with pytest.raises(MempoolError):
+        pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now - 61, "memo": "stale"})
+
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    late = {"from": "A", "to": "B", "amount": 1, "timestamp": now + 61, "memo": "late", "fee": 1}
+    pool.add(late)
+    assert memos(pool.all()) == ["late"]
+    assert pool.bytes == tx_size(pool.get(tx_key(late)))
+
+    stats = pool.stats()
+    assert (stats["evicted_full"], stats["rejected_full"], stats["evicted_expired"]) == (1, 1, 3)
+    assert len(Mempool(pool.path, max_txs=3, ttl=60)) == 1
+
+def test_future_dated_txs_are_refused_or_expire_on_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(time, "time", lambda: now)
+    pool = Mempool(str(tmp_path / "mempool.json"), ttl=60, max_future=30)
+    with pytest.raises(MempoolError):
+        pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now + 10 ** 9, "memo": "forever"})
+    assert pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now + 20, "memo": "ahead"})
+
+    # Expires TTL seconds after arrival, not after its own timestamp
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert pool.add({"from": "A", "to": "B", "amount": 1, "timestamp": now + 61, "memo": "later"})
+    assert memos(pool.all()) == ["later"]
+
+def test_pending_debits_reject_overspends(tmp_path):
+    pool = Mempool(str(tmp_path / "mempool.json"))
+    t1 = {"from": "A", "to": "B", "amount": 6, "timestamp": now}
+    t2 = {"from": "A", "to": "B", "amount": 4, "timestamp": now, "fee": 1}
+    t3 = {"from": "A", "to": "B", "amount": 3, "timestamp": now, "fee": 1}
+    assert pool.add(t1, balance=10)
+    with pytest.raises(InsufficientFunds):
+        pool.add(t2, balance=10)
+    assert pool.add(t3, balance=10)
+    assert pool.pending_debit("A") == 10
+    # Duplicates are not over-spends
+    assert not pool.add(t1, balance=10)
+
+    # Confirming (removing) a tx releases its debit
+    pool.remove([tx_key(t1)])
+    assert pool.pending_debit("A") == 4
+    assert pool.add(t2, balance=9)
+    pool.remove([tx_key(t2), tx_key(t3)])
+    assert pool.pending_debit("A") == 0 and Mempool(pool.path).pending_debit("A") == 0
+
+def test_add_many_checks_balances(tmp_path):
+    pool = Mempool(str(tmp_path / "mempool.json"))
+    txs = [{"from": "A", "to": "B", "amount": amount, "timestamp": now + i, "memo": f"a{i}"}
+           for i, amount in enumerate((4, 5, 2))]
+    txs.append({"from": "C", "to": "B", "amount": 1, "timestamp": now, "memo": "c"})
+    # A can cover the first and last of its txs; C is not in the balances at all
+    assert pool.add_many(txs, balances={"A": 7}) == 2
+    assert memos(pool.all()) == ["a0", "a2"]
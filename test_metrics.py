@@ -0,0 +1,59 @@
+import os
+import metrics
+from metrics import HTTP_REQUESTS, HTTP_LATENCY, HTTP_IN_FLIGHT, CHAIN_HEIGHT, P2P_PEERS
+
+def use_dir(monkeypatch, path):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(path))
+    monkeypatch.setattr(metrics, "_values", None)
+
+def test_samples_add_up_across_processes(tmp_path, monkeypatch):
+    use_dir(monkeypatch, tmp_path)
+    HTTP_REQUESTS.labels("GET", "/health", 200).inc()
+    HTTP_IN_FLIGHT.inc()
+
+    pid = os.fork()
+    if pid == 0:
+        HTTP_REQUESTS.labels("GET", "/health", 200).inc(2)
+        HTTP_IN_FLIGHT.inc()
+        P2P_PEERS.set(3)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    samples = metrics.collect()
+    # Counters of the exited child are kept, its gauges are not
+    assert samples['["shadowledger_http_requests_total", [["method", "GET"], ["route", "/health"], ["status", "200"]]]'] == 3
+    assert samples['["shadowledger_http_requests_in_flight", []]'] == 1
+    assert '["shadowledger_p2p_peers", []]' not in samples
+    assert sorted(os.listdir(tmp_path)) == sorted([".lock", os.path.basename(metrics._values.path), "archive.db"])
+    HTTP_IN_FLIGHT.dec()
+
+def test_liveness_follows_the_file_lock_not_the_pid(tmp_path, monkeypatch):
+    use_dir(monkeypatch, tmp_path)
+    key = '["shadowledger_miner_blocks_total", []]'
+    # Two containers sharing the directory, both running as pid 1
+    live = metrics.ValueFile(str(tmp_path / "miner-1-aaaa.metrics"), owned=True)
+    live.add(live.offset(key), 5)
+    exited = metrics.ValueFile(str(tmp_path / "node-1-bbbb.metrics"), owned=True)
+    exited.add(exited.offset(key), 2)
+    exited.close()
+
+    assert metrics.collect()[key] == 7
+    assert os.path.exists(live.path) and not os.path.exists(exited.path)
+    live.close()
+
+def test_exposition_format(tmp_path, monkeypatch):
+    use_dir(monkeypatch, tmp_path)
+    latency = HTTP_LATENCY.labels("GET", '/odd "route"')
+    for value in (0.0005, 0.003, 0.003, 20):
+        latency.observe(value)
+    CHAIN_HEIGHT.set(42)
+
+    text = metrics.generate_latest().decode()
+    series = 'shadowledger_http_request_duration_seconds_bucket{method="GET",route="/odd \\"route\\""'
+    assert f'{series},le="0.001"}} 1' in text
+    assert f'{series},le="0.005"}} 3' in text
+    assert f'{series},le="10"}} 3' in text
+    assert f'{series},le="+Inf"}} 4' in text
+    assert 'shadowledger_http_request_duration_seconds_count{method="GET",route="/odd \\"route\\""} 4' in text
+    assert "# TYPE shadowledger_http_request_duration_seconds histogram" in text
+    assert "shadowledger_chain_height 42" in text
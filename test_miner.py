@@ -0,0 +1,54 @@
+import time
+from block import Block, BLOCK_VERSION
+from miner import MiningPool
+
+def test_pool_finds_valid_nonce_and_stops_workers():
+    pool = MiningPool(2)
+    try:
+        blk = Block(1, time.time(), "0" * 64, 0, 10, "miner", [], version=BLOCK_VERSION)
+        found = pool.search(blk.header_prefix(), 3, lambda: True)
+        blk.nonce, blk.hash = found
+        assert blk.is_valid(3)
+        assert len(pool.hashrates()) == 2
+
+        # An aborted search returns once every worker has stopped
+        assert pool.search(blk.header_prefix(), 64, lambda: False) is None
+    finally:
+        pool.close()
+
+def test_search_fails_when_a_worker_dies():
+    import pytest
+    from miner import MiningPoolError
+    pool = MiningPool(2)
+    try:
+        pool.processes[1].kill()
+        blk = Block(1, time.time(), "0" * 64, 0, 10, "miner", [], version=BLOCK_VERSION)
+        with pytest.raises(MiningPoolError):
+            pool.search(blk.header_prefix(), 64, lambda: True)
+    finally:
+        pool.close()
+
+def test_template_goes_stale_on_new_tip_and_mempool(empty_chain, monkeypatch):
+    import block
+    import miner
+    monkeypatch.setattr(miner, "TEMPLATE_REFRESH", 0)
+
+    m = miner.Miner("shadow1" + "00" * 16)
+    m.is_mining = True
+    m.current_block = m.build_template()
+    assert m.work_is_current()
+
+    # A peer's block lands on top of the same tip
+    peer = Block(0, time.time(), "0" * 64, 0, 10, "peer", [], version=BLOCK_VERSION)
+    peer.mine(1)
+    block.save_block(peer)
+    assert not m.work_is_current()
+    assert m.stats["stale_templates"] == 1
+
+    m.current_block = m.build_template()
+    assert m.current_block.previous_hash == peer.hash
+    assert m.work_is_current()
+
+    m.mempool.add({"from": "peer", "to": "B", "amount": 1, "timestamp": time.time(), "signature": "ab"})
+    assert not m.work_is_current()
+    assert m.stats["template_rebuilds"] == 1
@@ -0,0 +1,41 @@
+import time
+import asyncio
+from offload import Offloader, chain_summary
+
+def test_offloaded_calls_keep_the_loop_free(tmp_path, monkeypatch):
+    import metrics
+    # The in-flight gauge records to a value file
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "_values", None)
+    pool = Offloader("test", 2)
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        jobs = [asyncio.create_task(pool.run(time.sleep, 0.2)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert pool.stats()["in_flight"] == 3
+        await asyncio.gather(*jobs)
+        task.cancel()
+        return ticks
+
+    # Two threads for three jobs: ~0.4s, during which the loop kept ticking
+    assert asyncio.run(main()) > 10
+    assert pool.stats() == {"workers": 2, "in_flight": 0, "completed": 3, "failed": 0}
+
+def test_scan_jobs_run_in_a_process(empty_chain):
+    import block
+    from block import Block, BLOCK_VERSION
+    block.save_block(Block(0, time.time(), "0" * 64, 0, 10, "A", [], version=BLOCK_VERSION))
+
+    pool = Offloader("test-scan", 1, processes=True)
+    summary = asyncio.run(pool.run(chain_summary))
+    assert summary == chain_summary()
+    assert summary["length"] == 1 and summary["total_rewards"] == 10
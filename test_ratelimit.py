@@ -0,0 +1,52 @@
+import multiprocessing
+import ratelimit
+from ratelimit import RateLimiter, PROBE, client_key
+
+def test_token_bucket(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    limiter = RateLimiter(60, burst=3, path=str(tmp_path / "rl.bin"), slots=64)
+
+    assert [limiter.is_allowed("1.2.3.4") for _ in range(4)] == [True, True, True, False]
+    assert limiter.is_allowed("5.6.7.8")
+    # One token per second
+    now[0] += 1.5
+    assert limiter.is_allowed("1.2.3.4")
+    assert not limiter.is_allowed("1.2.3.4")
+    assert limiter.stats()["limited"] == 2
+
+def _drain(path, count):
+    limiter = RateLimiter(60, burst=10, path=path, slots=64)
+    for _ in range(count):
+        limiter.is_allowed("1.2.3.4")
+
+def test_buckets_are_shared_across_processes(tmp_path):
+    path = str(tmp_path / "rl.bin")
+    limiter = RateLimiter(60, burst=10, path=path, slots=64)
+    assert limiter.is_allowed("1.2.3.4")
+    process = multiprocessing.get_context("fork").Process(target=_drain, args=(path, 9))
+    process.start()
+    process.join()
+    assert not limiter.is_allowed("1.2.3.4")
+
+def test_table_is_bounded_and_forgets_idle_clients(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    path = tmp_path / "rl.bin"
+    # One slot, so every client hashes into the same PROBE slots
+    limiter = RateLimiter(60, burst=2, path=str(path), slots=1)
+    clients = [f"10.0.0.{i}" for i in range(PROBE)]
+    for client in clients:
+        assert [limiter.is_allowed(client) for _ in range(3)] == [True, True, False]
+    size = path.stat().st_size
+
+    # All slots busy: a newcomer takes one over instead of growing the table
+    assert limiter.is_allowed("10.0.1.1")
+    assert path.stat().st_size == size
+    # Once refilled, slots go to whoever comes next
+    now[0] += 10
+    newcomers = [f"10.1.0.{i}" for i in range(PROBE)]
+    for client in newcomers:
+        assert limiter.is_allowed(client)
+    table = ratelimit.WINDOW.unpack_from(limiter._map, ratelimit.HEADER.size)
+    assert set(table[0::3]) == {client_key(client) for client in newcomers}
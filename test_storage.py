@@ -0,0 +1,127 @@
+import json
+import time
+from block import Block
+from storage import BlockLogStore, JsonChainStore, SQLiteChainStore, MmapBlockStore, migrate_json_chain
+
+def make_chain(length):
+    chain = []
+    previous_hash = "0" * 64
+    for i in range(length):
+        txs = [{"from": "A", "to": "B", "amount": i, "timestamp": time.time(), "txid": f"tx{i}"}]
+        blk = Block(i, time.time(), previous_hash, i, 10, "miner123", txs)
+        chain.append(blk.to_dict())
+        previous_hash = blk.hash
+    return chain
+
+def test_block_log_append_and_read(tmp_path):
+    store = BlockLogStore(str(tmp_path / "blocks"), segment_blocks=3)
+    chain = make_chain(7)
+    for blk in chain:
+        store.append(blk)
+
+    assert store.height() == 7
+    assert store.load_chain() == chain
+    assert store.tip() == chain[-1]
+    assert store.get_block(4) == chain[4]
+    assert store.get_block(7) is None
+    assert list(store.iter_blocks(2, 5)) == chain[2:5]
+
+def test_block_log_discards_torn_write(tmp_path):
+    store = BlockLogStore(str(tmp_path / "blocks"), segment_blocks=3)
+    chain = make_chain(2)
+    store.append(chain[0])
+    with open(store._segment_path(0), "ab") as f:
+        f.write(b'{"index": 1, "trunc')
+
+    store.append(chain[1])
+    assert store.load_chain() == chain
+
+def test_migrate_json_chain(tmp_path):
+    chain = make_chain(4)
+    json_path = tmp_path / "blockchain.json"
+    json_path.write_text(json.dumps(chain, indent=2))
+
+    store = BlockLogStore(str(tmp_path / "blocks"))
+    assert migrate_json_chain(str(json_path), store) == 4
+    assert store.load_chain() == JsonChainStore(str(json_path)).load_chain()
+
+def test_sqlite_point_lookups(tmp_path):
+    store = SQLiteChainStore(str(tmp_path / "chain.db"))
+    reference = JsonChainStore(str(tmp_path / "blockchain.json"))
+    chain = make_chain(5)
+    for blk in chain:
+        store.append(blk)
+        reference.append(blk)
+
+    assert store.load_chain() == chain
+    assert store.tip() == chain[-1]
+    assert store.get_block(2) == chain[2]
+    assert store.get_block_by_hash(chain[3]["hash"]) == chain[3]
+    assert store.find_transaction("tx4") == (chain[4], chain[4]["txs"][0])
+    assert store.find_transaction("missing") is None
+    for address in ("A", "B", "miner123"):
+        assert store.get_balance(address) == reference.get_balance(address)
+
+def test_mmap_store_constant_time_fetch(tmp_path):
+    store = MmapBlockStore(str(tmp_path / "blockfile"))
+    assert store.tip() is None
+    chain = make_chain(6)
+    for blk in chain[:3]:
+        store.append(blk)
+    assert store.tip() == chain[2]
+
+    # Readers remap as the files grow
+    for blk in chain[3:]:
+        store.append(blk)
+    assert store.height() == 6
+    assert store.get_block(4) == chain[4]
+    assert store.tip() == chain[-1]
+    assert store.load_chain() == chain
+
+    # A record written without its index entry is discarded
+    with open(store.data_path, "ab") as f:
+        f.write(b"garbage")
+    extra = make_chain(7)[-1]
+    store.append(extra)
+    assert store.get_block(6) == extra
+
+def test_pop_restores_previous_tip(tmp_path):
+    stores = [
+        JsonChainStore(str(tmp_path / "blockchain.json")),
+        BlockLogStore(str(tmp_path / "blocks"), segment_blocks=2),
+        SQLiteChainStore(str(tmp_path / "chain.db")),
+        MmapBlockStore(str(tmp_path / "blockfile")),
+    ]
+    chain = make_chain(5)
+    for store in stores:
+        for blk in chain:
+            store.append(blk)
+        stamp = store.stamp()
+        assert store.pop() == chain[4]
+        assert store.stamp() != stamp
+        assert store.pop() == chain[3]
+        assert store.tip() == chain[2]
+        stamp = store.stamp()
+        store.append(chain[3])
+        assert store.stamp() != stamp
+        assert store.load_chain() == chain[:4]
+        for _ in range(4):
+            store.pop()
+        assert store.pop() is None
+        assert store.height() == 0
+
+def test_iter_blocks_reversed_in_chunks(tmp_path):
+    stores = [
+        JsonChainStore(str(tmp_path / "blockchain.json")),
+        BlockLogStore(str(tmp_path / "blocks"), segment_blocks=2),
+        SQLiteChainStore(str(tmp_path / "chain.db")),
+        MmapBlockStore(str(tmp_path / "blockfile")),
+    ]
+    chain = make_chain(7)
+    for store in stores:
+        for blk in chain:
+            store.append(blk)
+        assert list(store.iter_blocks_reversed(chunk=3)) == chain[::-1]
+        assert list(store.iter_blocks_reversed(2, 6, chunk=3)) == chain[5:1:-1]
+        assert list(store.iter_blocks_reversed(5, 50, chunk=3)) == chain[:4:-1]
+        assert list(store.iter_blocks_reversed(4, 4)) == []
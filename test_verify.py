@@ -0,0 +1,93 @@
+import verify
+from ecdsa import SigningKey, SECP256k1
+from transaction import Transaction
+from verify import get_address, verify_tx, verify_transactions
+
+def signed_tx(key, amount=1, recipient="shadow1" + "ab" * 16):
+    sender = get_address(key.get_verifying_key().to_string().hex())
+    tx = Transaction(sender, recipient, amount, key.to_string().hex())
+    assert tx.sign()
+    return tx.to_dict()
+
+def test_verify_tx_checks_signature_and_sender():
+    key, other = SigningKey.generate(curve=SECP256k1), SigningKey.generate(curve=SECP256k1)
+    tx = signed_tx(key)
+    assert verify_tx(tx)
+    # The txid and pubkey are not signed, but the transfer is
+    assert not verify_tx(dict(tx, amount=2))
+    assert not verify_tx(dict(tx, pubkey=other.get_verifying_key().to_string().hex()))
+    assert not verify_tx(dict(tx, signature="ab"))
+    assert not verify_tx({k: v for k, v in tx.items() if k != "pubkey"})
+
+def test_stealth_senders_prove_both_keys():
+    scan, spend, other = (SigningKey.generate(curve=SECP256k1) for _ in range(3))
+    scan_hex = scan.get_verifying_key().to_string().hex()
+    sender = verify.get_stealth_address(scan_hex, spend.get_verifying_key().to_string().hex())
+    tx = Transaction(sender, "shadow1" + "ab" * 16, 1, spend.to_string().hex(), scan_pubkey=scan_hex)
+    assert tx.sign()
+    tx = tx.to_dict()
+    assert verify_tx(tx)
+
+    # Any key's signature used to pass for a stealth sender
+    forged = Transaction(sender, "shadow1" + "ab" * 16, 1, other.to_string().hex(), scan_pubkey=scan_hex)
+    assert forged.sign() and not verify_tx(forged.to_dict())
+    assert not verify_tx({k: v for k, v in tx.items() if k != "scan_pubkey"})
+    # Senders of no known address type never verify
+    plain = Transaction("A", "shadow1" + "ab" * 16, 1, other.to_string().hex())
+    assert plain.sign() and not verify_tx(plain.to_dict())
+
+def test_batch_results_keep_order_across_workers(monkeypatch):
+    monkeypatch.setattr(verify, "VERIFY_WORKERS", 2)
+    monkeypatch.setattr(verify, "VERIFY_PARALLEL_MIN", 4)
+    key = SigningKey.generate(curve=SECP256k1)
+    txs = [signed_tx(key, amount=i + 1) for i in range(10)]
+    txs[3] = dict(txs[3], amount=100)
+    txs[8] = dict(txs[8], signature="zz")
+
+    expected = [i not in (3, 8) for i in range(10)]
+    assert verify_transactions(txs) == expected
+    assert verify.verified(txs) == [tx for i, tx in enumerate(txs) if expected[i]]
+
+def test_key_cache_counts_and_precomputes_hot_keys(monkeypatch):
+    monkeypatch.setattr(verify, "_verifying_keys", verify.LRUCache(2))
+    # Every check reaches the key cache
+    monkeypatch.setattr(verify, "_verified", verify.LRUCache(0))
+    keys = [SigningKey.generate(curve=SECP256k1) for _ in range(3)]
+    txs = [signed_tx(key) for key in keys]
+
+    for _ in range(3):
+        assert verify_tx(txs[0])
+    stats = verify.cache_stats()["verifying_keys"]
+    assert (stats["hits"], stats["misses"]) == (2, 1)
+    # Precomputed keys still reject forgeries
+    assert not verify_tx(dict(txs[0], amount=5))
+
+    # The least recently used key is evicted
+    assert verify_tx(txs[1]) and verify_tx(txs[2])
+    assert len(verify._verifying_keys) == 2
+    assert verify_tx(txs[0])
+    assert verify.cache_stats()["verifying_keys"]["misses"] == 4
+
+def test_signature_cache_skips_repeat_checks(monkeypatch):
+    monkeypatch.setattr(verify, "_verified", verify.LRUCache(100))
+    checked = []
+    check = verify._check_tx
+    monkeypatch.setattr(verify, "_check_tx", lambda tx: checked.append(tx["amount"]) or check(tx))
+
+    key = SigningKey.generate(curve=SECP256k1)
+    admitted = signed_tx(key, amount=1)
+    assert verify_tx(admitted)
+    block_txs = [dict(admitted), signed_tx(key, amount=2)]
+    assert verify_transactions(block_txs) == [True, True]
+    assert checked == [1, 2]
+
+    # The cache vouches for the signed content, not for the txid it claims
+    forged = dict(admitted, amount=50)
+    assert verify_transactions([forged, dict(admitted, txid="other")]) == [False, True]
+    assert checked == [1, 2, 50]
+
+    relayed = signed_tx(key, amount=3)
+    verify.mark_verified([relayed])
+    assert verify_transactions([dict(relayed)]) == [True]
+    assert checked == [1, 2, 50]
+    assert verify.cache_stats()["signatures"]["hits"] == 3
@@ -0,0 +1,48 @@
+import json
+import time
+import socket
+import threading
+import block
+from workserver import WorkServer, WorkClient
+
+def test_remote_miner_solves_server_work(empty_chain):
+
+    server = WorkServer("shadow1" + "00" * 16, port=0, range_size=50000)
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.port:
+        time.sleep(0.01)
+
+    first = server._assign()
+    second = server._assign()
+    assert first["nonce_end"] == second["nonce_start"]
+
+    client = WorkClient("127.0.0.1", server.port)
+    threading.Thread(target=client.run, daemon=True).start()
+    try:
+        deadline = time.time() + 30
+        while server.stats["accepted"] < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        chain = block.load_chain()
+        assert len(chain) >= 2
+        assert chain[1]["previous_hash"] == chain[0]["hash"]
+        assert all(block.Block.from_dict(b).is_valid() for b in chain)
+        assert server.stats["accepted"] >= 2
+        # The accepted block moved the tip, so its job is gone
+        assert server._submit(first["job_id"], 0)["reason"] == "stale"
+        # Nonces that do not fit the header are refused, not raised on
+        for nonce in (-1, block.MAX_NONCE):
+            assert server._submit(server.job_id, nonce)["reason"] == "invalid"
+
+        # Malformed submissions get a protocol error and the connection stays up
+        client.stop()
+        with socket.create_connection(("127.0.0.1", server.port)) as conn:
+            replies = (json.loads(line) for line in conn.makefile("rb"))
+            for nonce in ("abc", 1.5, True, None, -1, block.MAX_NONCE):
+                conn.sendall((json.dumps({"type": "submitwork", "job_id": server.job_id, "nonce": nonce}) + "\n").encode())
+                # Skip work pushed for a block the client found just before stopping
+                assert next(r for r in replies if r["type"] != "work")["type"] == "error"
+            conn.sendall(b'{"type": "getwork"}\n')
+            assert next(replies)["type"] == "work"
+    finally:
+        client.stop()
+        server.stop()
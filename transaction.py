@@ -1,15 +1,14 @@
-import json
 import time
-import os
 from hashlib import sha256
-from ecdsa import SigningKey, VerifyingKey, SECP256k1, BadSignatureError
+from ecdsa import SigningKey, SECP256k1
 from mnemonic import Mnemonic
-from block import load_chain
-
-MEMPOOL_FILE = "mempool.json"
+from block import get_balance
+from mempool import open_mempool, MempoolError, InsufficientFunds
+from verify import get_address, signing_payload, signing_key, verify_tx
 
 class Transaction:
-    def __init__(self, sender: str, recipient: str, amount: float, private_key: str):
+    def __init__(self, sender: str, recipient: str, amount: float, private_key: str,
+                 scan_pubkey: str = None):
         self.sender = sender
         self.recipient = recipient
         self.amount = amount
@@ -17,6 +16,9 @@ class Transaction:
         self.timestamp = time.time()
         self.txid = None
         self.signature = None
+        self.pubkey = None
+        # Stealth senders sign with their spend key and carry the scan key
+        self.scan_pubkey = scan_pubkey
         
     def sign(self):
         """Sign the transaction"""
@@ -30,12 +32,14 @@ class Transaction:
             }
             
             # Sign the transaction
-            tx_string = json.dumps(tx_data, sort_keys=True)
-            private_key_obj = SigningKey.from_string(bytes.fromhex(self.private_key), curve=SECP256k1)
-            self.signature = private_key_obj.sign(tx_string.encode()).hex()
+            payload = signing_payload(tx_data)
+            private_key_obj = signing_key(self.private_key)
+            self.signature = private_key_obj.sign(payload).hex()
+            # Carried so nodes can verify without the sender's wallet
+            self.pubkey = private_key_obj.get_verifying_key().to_string().hex()
             
             # Generate transaction ID
-            self.txid = sha256(tx_string.encode()).hexdigest()
+            self.txid = sha256(payload).hexdigest()
             
             return True
         except Exception as e:
@@ -57,9 +61,10 @@ class Transaction:
                 "amount": self.amount,
                 "timestamp": self.timestamp
             }
+            if self.scan_pubkey:
+                tx_data["scan_pubkey"] = self.scan_pubkey
             
-            tx_string = json.dumps(tx_data, sort_keys=True)
-            public_key = SigningKey.from_string(bytes.fromhex(self.private_key), curve=SECP256k1).get_verifying_key()
+            public_key = signing_key(self.private_key).get_verifying_key()
             pub_hex = public_key.to_string().hex()
             
             if not verify_signature(tx_data, self.signature, pub_hex):
@@ -77,40 +82,22 @@ class Transaction:
     
     def to_dict(self) -> dict:
         """Convert transaction to dictionary"""
-        return {
+        data = {
             "from": self.sender,
             "to": self.recipient,
             "amount": self.amount,
             "timestamp": self.timestamp,
             "signature": self.signature,
-            "txid": self.txid
+            "txid": self.txid,
+            "pubkey": self.pubkey
         }
-
-def get_address(pub_hex):
-    return "shadow1" + sha256(bytes.fromhex(pub_hex)).hexdigest()[:32]
-
-def get_balance(address):
-    chain = load_chain()
-    balance = 0
-    for block in chain:
-        if block["address"] == address:
-            balance += block["reward"]
-        for tx in block.get("txs", []):
-            if tx["from"] == address:
-                balance -= tx["amount"]
-            if tx["to"] == address:
-                balance += tx["amount"]
-    return balance
+        if self.scan_pubkey:
+            data["scan_pubkey"] = self.scan_pubkey
+        return data
 
 def verify_signature(tx, signature, pubkey_hex):
-    tx_copy = dict(tx)
-    tx_copy.pop("signature", None)
-    tx_string = json.dumps(tx_copy, sort_keys=True).encode()
-    try:
-        vk = VerifyingKey.from_string(bytes.fromhex(pubkey_hex), curve=SECP256k1)
-        return vk.verify(bytes.fromhex(signature), tx_string)
-    except BadSignatureError:
-        return False
+    # Goes through the signature cache, so relays and blocks carrying this tx skip ECDSA
+    return verify_tx(dict(tx, signature=signature, pubkey=pubkey_hex))
 
 def handle_transaction_commands(args):
     if args.action == "send":
@@ -141,24 +128,29 @@ def handle_transaction_commands(args):
             "timestamp": time.time()
         }
 
-        tx_string = json.dumps(tx, sort_keys=True)
-        signature = private_key.sign(tx_string.encode()).hex()
+        payload = signing_payload(tx)
+        signature = private_key.sign(payload).hex()
         tx["signature"] = signature
 
         # Optional: add txid for traceability
-        tx["txid"] = sha256(tx_string.encode()).hexdigest()
+        tx["txid"] = sha256(payload).hexdigest()
+        tx["pubkey"] = pub_hex
 
         if not verify_signature(tx, signature, pub_hex):
             print("❌ Signature verification failed!")
             return
 
         # Save to mempool
-        mempool = []
-        if os.path.exists(MEMPOOL_FILE):
-            with open(MEMPOOL_FILE, "r") as f:
-                mempool = json.load(f)
-        mempool.append(tx)
-        with open(MEMPOOL_FILE, "w") as f:
-            json.dump(mempool, f, indent=2)
+        try:
+            added = open_mempool().add(tx, balance=balance)
+        except InsufficientFunds:
+            print(f"❌ Not enough balance once pending transactions are counted. You have {balance} ShadowCoin.")
+            return
+        except MempoolError as e:
+            print(f"❌ Transaction rejected by mempool: {e}")
+            return
+        if not added:
+            print("❌ Transaction already in mempool!")
+            return
 
         print(f"✅ Transaction of {amount} ShadowCoin added to mempool.")
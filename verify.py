@@ -0,0 +1,265 @@
+import os
+import json
+import logging
+import threading
+import multiprocessing
+from hashlib import sha256
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, List
+from ecdsa import SigningKey, VerifyingKey, SECP256k1
+from ecdsa.ellipticcurve import Point, PointJacobi
+
+logger = logging.getLogger(__name__)
+
+# Processes used for batch signature checks; below 2, batches are checked inline
+VERIFY_WORKERS = int(os.environ.get("VERIFY_WORKERS", str(os.cpu_count() or 1)))
+
+# Most txs handed to a worker per task
+VERIFY_CHUNK = 256
+
+# Smaller batches are checked inline; the round trip to the pool costs more
+VERIFY_PARALLEL_MIN = 64
+
+# Fields covered by a signature; the fee is too when a tx offers one
+SIGNED_FIELDS = ("from", "to", "amount", "timestamp")
+
+# Parsed keys kept per process (each of verifying and signing keys)
+KEY_CACHE_SIZE = int(os.environ.get("KEY_CACHE_SIZE", "4096"))
+
+# Txs whose signature already checked out, kept per process
+SIG_CACHE_SIZE = int(os.environ.get("SIG_CACHE_SIZE", "100000"))
+
+_executor = None
+_executor_pid = None
+
+
+class LRUCache:
+    """Bounded mapping that drops the least recently used entry, with hit and miss counters"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> Dict:
+        return {"size": len(self.entries), "max_size": self.size, "hits": self.hits, "misses": self.misses}
+
+
+# key bytes -> [VerifyingKey, precomputed]
+_verifying_keys = LRUCache(KEY_CACHE_SIZE)
+# key bytes -> SigningKey
+_signing_keys = LRUCache(KEY_CACHE_SIZE)
+# (txid, signature, pubkey, scan_pubkey) -> True, for txs that verified
+_verified = LRUCache(SIG_CACHE_SIZE)
+
+
+def _precomputed_key(vk: VerifyingKey) -> VerifyingKey:
+    # from_string drops the point order that precompute() needs
+    point = vk.pubkey.point
+    affine = Point(SECP256k1.curve, point.x(), point.y(), SECP256k1.order)
+    vk = VerifyingKey.from_public_point(PointJacobi.from_affine(affine, generator=True), curve=SECP256k1)
+    vk.precompute()
+    return vk
+
+
+def verifying_key(pubkey_hex: str) -> VerifyingKey:
+    """Parse a public key through the cache.
+
+    Building the point tables costs a few verifications, so a key only
+    gets them once it is seen a second time; from then on checks against
+    it skip both decoding and most of the point arithmetic.
+    """
+    raw = bytes.fromhex(pubkey_hex)
+    entry = _verifying_keys.get(raw)
+    if entry is None:
+        entry = [VerifyingKey.from_string(raw, curve=SECP256k1), False]
+        _verifying_keys.put(raw, entry)
+    elif not entry[1]:
+        entry[0] = _precomputed_key(entry[0])
+        entry[1] = True
+    return entry[0]
+
+
+def signing_key(private_key_hex: str) -> SigningKey:
+    """Parse a private key through the cache, skipping the public point derivation on repeats"""
+    raw = bytes.fromhex(private_key_hex)
+    sk = _signing_keys.get(raw)
+    if sk is None:
+        sk = SigningKey.from_string(raw, curve=SECP256k1)
+        _signing_keys.put(raw, sk)
+    return sk
+
+
+def cache_stats() -> Dict:
+    """Counters of this process's key and signature caches"""
+    return {
+        "verifying_keys": _verifying_keys.stats(),
+        "signing_keys": _signing_keys.stats(),
+        "signatures": _verified.stats()
+    }
+
+
+def get_address(pub_hex: str) -> str:
+    return "shadow1" + sha256(bytes.fromhex(pub_hex)).hexdigest()[:32]
+
+
+def get_stealth_address(pub_scan_hex: str, pub_spend_hex: str) -> str:
+    """Same derivation as stealth.generate_stealth_address: the hex strings are hashed as text"""
+    return "stealth1" + sha256((pub_scan_hex + pub_spend_hex).encode()).hexdigest()[:32]
+
+
+def signing_payload(tx: Dict) -> bytes:
+    """Bytes a transaction's signature covers (their sha256 is its txid)"""
+    data = {field: tx.get(field) for field in SIGNED_FIELDS}
+    if "fee" in tx:
+        data["fee"] = tx["fee"]
+    return json.dumps(data, sort_keys=True).encode()
+
+
+def tx_hash(tx: Dict) -> str:
+    """Txid of a transaction: the sha256 of what its signature covers.
+
+    The "txid" field a tx carries is not signed, so it is never trusted
+    for identity; a copy with another txid is still the same tx.
+    """
+    return sha256(signing_payload(tx)).hexdigest()
+
+
+def _cache_key(tx: Dict):
+    # The txid is recomputed rather than read from the tx, so a cached
+    # result can never vouch for fields that were changed afterwards
+    try:
+        return tx_hash(tx), tx["signature"], tx["pubkey"], tx.get("scan_pubkey")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _sender_key_matches(tx: Dict) -> bool:
+    """True if the key the tx is signed with is the one its sender address commits to"""
+    sender, pubkey = tx["from"], tx["pubkey"]
+    if sender.startswith("shadow1"):
+        return get_address(pubkey) == sender
+    if sender.startswith("stealth1"):
+        # Signed with the spend key; the address also needs the scan key
+        return get_stealth_address(tx["scan_pubkey"], pubkey) == sender
+    return False
+
+
+def _check_tx(tx: Dict) -> bool:
+    try:
+        if not _sender_key_matches(tx):
+            return False
+        return verifying_key(tx["pubkey"]).verify(bytes.fromhex(tx["signature"]), signing_payload(tx))
+    except Exception:
+        # Missing fields, malformed hex or keys, and bad signatures alike
+        return False
+
+
+def verify_tx(tx: Dict) -> bool:
+    """Check a transaction's signature against the public key it carries.
+
+    The key must also be the one the sender address commits to: for
+    shadow1 senders it hashes to the address, stealth1 senders carry
+    their scan key as "scan_pubkey" so the address can be rebuilt. Other
+    senders never verify. Txs that verified before are answered from the
+    signature cache.
+    """
+    key = _cache_key(tx)
+    if key is not None and _verified.get(key):
+        return True
+    ok = _check_tx(tx)
+    if ok:
+        _verified.put(key, True)
+    return ok
+
+
+def mark_verified(txs: Iterable[Dict]):
+    """Record txs as verified, e.g. ones this node already checked on admission"""
+    for tx in txs:
+        key = _cache_key(tx)
+        if key is not None:
+            _verified.put(key, True)
+
+
+def _verify_chunk(txs: List[Dict]) -> List[bool]:
+    return [_check_tx(tx) for tx in txs]
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor, _executor_pid
+    # A forked child (gunicorn worker, mining worker) starts its own pool.
+    # Workers are spawned: forking a threaded API or P2P process could copy
+    # a lock some other thread held, and the child would hang on it.
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ProcessPoolExecutor(VERIFY_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def verify_transactions(txs: Iterable[Dict]) -> List[bool]:
+    """Verify many signatures, one result per tx in order.
+
+    Txs found in the signature cache are not checked again. The rest, if
+    there are many, are split into chunks spread over a process pool of
+    VERIFY_WORKERS processes, so a block of thousands of txs is checked
+    on every core instead of one.
+    """
+    txs = list(txs)
+    keys = [_cache_key(tx) for tx in txs]
+    results = [key is not None and bool(_verified.get(key)) for key in keys]
+    misses = [i for i, ok in enumerate(results) if not ok]
+    for i, ok in zip(misses, _verify_batch([txs[i] for i in misses])):
+        if ok:
+            results[i] = True
+            _verified.put(keys[i], True)
+    return results
+
+
+def _verify_batch(txs: List[Dict]) -> List[bool]:
+    global _executor
+    if VERIFY_WORKERS < 2 or len(txs) < VERIFY_PARALLEL_MIN:
+        return _verify_chunk(txs)
+
+    # Small enough chunks that every worker gets a share
+    size = min(VERIFY_CHUNK, -(-len(txs) // VERIFY_WORKERS))
+    chunks = [txs[start:start + size] for start in range(0, len(txs), size)]
+    try:
+        results = []
+        for chunk_results in _get_executor().map(_verify_chunk, chunks):
+            results.extend(chunk_results)
+        return results
+    except BrokenProcessPool:
+        logger.warning("Signature verification pool died; verifying inline")
+        _executor = None
+        return _verify_chunk(txs)
+
+
+def verified(txs: Iterable[Dict]) -> List[Dict]:
+    """The txs whose signatures verify, in order"""
+    txs = list(txs)
+    return [tx for tx, ok in zip(txs, verify_transactions(txs)) if ok]
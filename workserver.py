@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from typing import Dict, Optional
+from block import Block, search_nonces, DIFFICULTY, MAX_NONCE
+from miner import Miner, MiningPool, NONCE_BATCH
+
+logger = logging.getLogger(__name__)
+
+WORK_PORT = int(os.getenv("WORK_PORT", "8889"))
+
+# Nonces handed out per getwork; ~10s of hashing for one core
+WORK_RANGE = 2 ** 24
+
+# How often the server checks the tip and mempool for new work
+WORK_POLL_INTERVAL = 0.005
+
+
+def _is_int(value) -> bool:
+    # JSON true/false decode to bools, which are ints to Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _send(conn: socket.socket, lock: threading.Lock, message: Dict):
+    with lock:
+        conn.sendall((json.dumps(message) + "\n").encode())
+
+
+class WorkServer:
+    """Builds one block template and hands out disjoint nonce ranges of it.
+
+    Remote miners speak newline-delimited JSON over TCP:
+
+    - ``{"type": "getwork"}`` returns a ``work`` message with the job id,
+      the serialized header prefix, the difficulty and a nonce range.
+    - ``{"type": "submitwork", "job_id": ..., "nonce": ...}`` returns a
+      ``result`` message; valid solutions are saved and broadcast. A
+      missing or malformed job id or nonce gets an ``error`` message.
+
+    When the tip or mempool changes, every connected miner is pushed a
+    range of the new job, so miners only hash and never touch storage.
+    """
+
+    def __init__(self, address: str, port: int = WORK_PORT, range_size: int = WORK_RANGE,
+                 peers=None):
+        self.port = port
+        self.range_size = range_size
+        self.miner = Miner(address, peers)
+        self.miner.is_mining = True
+        self.template: Optional[Block] = None
+        self.prefix = None
+        self.job_id = 0
+        self.next_nonce = 0
+        # conn -> send lock
+        self.clients: Dict[socket.socket, threading.Lock] = {}
+        self.lock = threading.RLock()
+        self.is_running = False
+        self.server_socket = None
+        self.watcher = None
+        self.stats = {
+            'jobs': 0,
+            'ranges_issued': 0,
+            'accepted': 0,
+            'stale': 0,
+            'invalid': 0
+        }
+
+    def _new_job(self):
+        with self.lock:
+            self.template = self.miner.current_block = self.miner.build_template()
+            self.prefix = self.template.header_prefix().hex()
+            self.job_id += 1
+            self.next_nonce = 0
+            self.stats['jobs'] += 1
+            logger.info(f"New work #{self.job_id} for block #{self.template.index} "
+                        f"with {len(self.template.txs)} txs")
+
+    def _assign(self) -> Dict:
+        """Hand out the next unassigned nonce range of the current job"""
+        with self.lock:
+            start = self.next_nonce
+            end = min(start + self.range_size, MAX_NONCE)
+            self.next_nonce = end
+            self.stats['ranges_issued'] += 1
+            return {
+                "type": "work",
+                "job_id": self.job_id,
+                "height": self.template.index,
+                "header": self.prefix,
+                "difficulty": DIFFICULTY,
+                "nonce_start": start,
+                "nonce_end": end
+            }
+
+    def _submit(self, job_id: int, nonce: int) -> Dict:
+        # The header packs the nonce as an unsigned 64-bit integer
+        if isinstance(nonce, bool) or not isinstance(nonce, int) or not 0 <= nonce < MAX_NONCE:
+            with self.lock:
+                self.stats['invalid'] += 1
+            return {"type": "result", "job_id": job_id, "accepted": False, "reason": "invalid"}
+
+        with self.lock:
+            if job_id != self.job_id:
+                self.stats['stale'] += 1
+                return {"type": "result", "job_id": job_id, "accepted": False, "reason": "stale"}
+
+            block = Block.from_dict(self.template.to_dict())
+            block.nonce = nonce
+            block.hash = block.calculate_hash()
+            if not block.is_valid(DIFFICULTY):
+                self.stats['invalid'] += 1
+                return {"type": "result", "job_id": job_id, "accepted": False, "reason": "invalid"}
+
+            # Peers are slow to reach; they get the block once the lock is free
+            if not self.miner.submit_block(block, broadcast=False):
+                self.stats['stale'] += 1
+                return {"type": "result", "job_id": job_id, "accepted": False, "reason": "stale"}
+
+            self.stats['accepted'] += 1
+            self.miner.stats['blocks_mined'] += 1
+            self._new_job()
+        self.miner.broadcast_block(block)
+        self._push_work()
+        return {"type": "result", "job_id": job_id, "accepted": True, "hash": block.hash}
+
+    def _push_work(self):
+        """Give every connected miner a range of the current job"""
+        with self.lock:
+            clients = list(self.clients.items())
+        for conn, send_lock in clients:
+            try:
+                _send(conn, send_lock, self._assign())
+            except OSError:
+                self._drop(conn)
+
+    def _drop(self, conn: socket.socket):
+        with self.lock:
+            self.clients.pop(conn, None)
+        conn.close()
+
+    def _watch(self):
+        """Replace the job as soon as the tip or mempool changes"""
+        while self.is_running:
+            time.sleep(WORK_POLL_INTERVAL)
+            try:
+                with self.lock:
+                    current = self.miner.work_is_current()
+                    if not current:
+                        self._new_job()
+                if not current:
+                    self._push_work()
+            except Exception as e:
+                logger.error(f"Error refreshing work: {e}")
+
+    def _handle_miner(self, conn: socket.socket, addr: str):
+        send_lock = threading.Lock()
+        with self.lock:
+            self.clients[conn] = send_lock
+        logger.info(f"Miner connected from {addr}")
+
+        try:
+            for line in conn.makefile("rb"):
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Invalid JSON from {addr}")
+                    continue
+
+                msg_type = message.get("type")
+                if msg_type == "getwork":
+                    response = self._assign()
+                elif msg_type == "submitwork":
+                    job_id, nonce = message.get("job_id"), message.get("nonce")
+                    # The header packs the nonce as an unsigned 64-bit integer
+                    if not _is_int(job_id) or not _is_int(nonce) or not 0 <= nonce < MAX_NONCE:
+                        response = {"type": "error",
+                                    "message": "submitwork needs an integer job_id and a nonce in [0, 2**64)"}
+                    else:
+                        response = self._submit(job_id, nonce)
+                else:
+                    response = {"type": "error", "message": f"Unknown message type: {msg_type}"}
+                _send(conn, send_lock, response)
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f"Error handling miner {addr}: {e}")
+        finally:
+            self._drop(conn)
+            logger.info(f"Miner {addr} disconnected")
+
+    def start(self):
+        """Build the first job and serve miners until stopped"""
+        self.is_running = True
+        self._new_job()
+        self.watcher = threading.Thread(target=self._watch, daemon=True)
+        self.watcher.start()
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(('', self.port))
+        self.server_socket.listen(64)
+        # Port 0 picks a free port
+        self.port = self.server_socket.getsockname()[1]
+        logger.info(f"Work server listening on port {self.port}")
+
+        while self.is_running:
+            try:
+                conn, addr = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle_miner, args=(conn, addr[0]), daemon=True).start()
+
+    def stop(self):
+        self.is_running = False
+        if self.server_socket:
+            self.server_socket.close()
+        if self.watcher:
+            self.watcher.join()
+
+
+class WorkClient:
+    """Hashes nonce ranges from a work server; never reads the chain or mempool"""
+
+    def __init__(self, host: str, port: int = WORK_PORT, workers: int = 1):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.pool = MiningPool(workers) if workers > 1 else None
+        self.work = None
+        self.is_running = False
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.stats = {
+            'submitted': 0,
+            'accepted': 0,
+            'total_hashrate': 0
+        }
+
+    def _read(self):
+        """Track the latest work pushed by the server"""
+        for line in self.conn.makefile("rb"):
+            message = json.loads(line)
+            if message.get("type") == "work":
+                self.work = message
+            elif message.get("type") == "result":
+                if message.get("accepted"):
+                    self.stats['accepted'] += 1
+                    logger.info(f"✅ Solution accepted: {message['hash']}")
+                else:
+                    logger.info(f"Solution rejected: {message.get('reason')}")
+        self.is_running = False
+
+    def _search(self, work: Dict):
+        prefix = bytes.fromhex(work["header"])
+        keep_going = lambda: self.is_running and self.work is work
+        if self.pool:
+            return self.pool.search(prefix, work["difficulty"], keep_going,
+                                    work["nonce_start"], work["nonce_end"])
+
+        nonce = work["nonce_start"]
+        while nonce < work["nonce_end"] and keep_going():
+            batch_end = min(nonce + NONCE_BATCH, work["nonce_end"])
+            found = search_nonces(prefix, work["difficulty"], nonce, batch_end)
+            if found:
+                return found
+            nonce = batch_end
+        return None
+
+    def run(self):
+        self.conn = socket.create_connection((self.host, self.port))
+        self.is_running = True
+        threading.Thread(target=self._read, daemon=True).start()
+        logger.info(f"Connected to work server {self.host}:{self.port}")
+
+        try:
+            _send(self.conn, self.send_lock, {"type": "getwork"})
+            while self.is_running:
+                work = self.work
+                if work is None:
+                    time.sleep(0.001)
+                    continue
+
+                start_time = time.time()
+                found = self._search(work)
+                elapsed = time.time() - start_time
+                hashes = (found[0] + 1 if found else work["nonce_end"]) - work["nonce_start"]
+                if elapsed > 0 and (found or self.work is work):
+                    self.stats['total_hashrate'] = hashes / elapsed
+
+                if found:
+                    self.stats['submitted'] += 1
+                    _send(self.conn, self.send_lock,
+                          {"type": "submitwork", "job_id": work["job_id"], "nonce": found[0]})
+                if self.work is work:
+                    # Solved or exhausted this range; ask for a new one
+                    self.work = None
+                    _send(self.conn, self.send_lock, {"type": "getwork"})
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.is_running = False
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+        if self.conn:
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="ShadowLedger work server")
+    parser.add_argument("--address", required=True, help="Address receiving block rewards")
+    parser.add_argument("--port", type=int, default=WORK_PORT, help="Port for miners to connect to")
+    parser.add_argument("--peers", nargs="*", default=[], help="List of peer IPs")
+    args = parser.parse_args()
+
+    server = WorkServer(args.address, args.port, peers=args.peers)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()